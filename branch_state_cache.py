@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from llama_cpp.llama import Llama, LlamaSeqState
+
+class BranchStateCache:
+    # LRU store of per-sequence kv snapshots for the exploration tree, keyed by the token path
+    # the snapshot was taken at. A branch that is resumed restores the snapshot sharing its longest
+    # prefix (a memcpy of the kv cells) and only evaluates the tokens after it, instead of re-decoding
+    # the whole prompt. Snapshots are evicted least recently used first to stay under capacity_bytes.
+    def __init__(self, capacity_bytes: int = (2 << 30)):
+        self.capacity_bytes = capacity_bytes
+        self.states: "OrderedDict[Tuple[int, ...], LlamaSeqState]" = OrderedDict()
+        self.cache_size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        return tuple(key) in self.states
+
+    def __setitem__(self, key: Sequence[int], state: LlamaSeqState):
+        key = tuple(key)
+        if key in self.states:
+            self.cache_size -= self.states.pop(key).nbytes
+        if state.nbytes > self.capacity_bytes:
+            return
+        self.states[key] = state
+        self.cache_size += state.nbytes
+        while self.cache_size > self.capacity_bytes and len(self.states) > 0:
+            _, evicted = self.states.popitem(last=False)
+            self.cache_size -= evicted.nbytes
+
+    def clear(self):
+        self.states.clear()
+        self.cache_size = 0
+
+    # snapshot sequence seq_id of the model, tokens defaults to the evaluated tokens of sequence 0
+    def save(self, llm: Llama, seq_id: int = 0, tokens: Optional[Sequence[int]] = None):
+        key = tuple(llm._input_ids.tolist() if tokens is None else tokens)
+        if len(key) == 0:
+            return
+        if key in self.states:
+            self.states.move_to_end(key)
+            return
+        self[key] = llm.save_seq_state(seq_id, input_ids=tokens)
+
+    # key with the longest common prefix with tokens and the prefix length
+    def find(self, tokens: Sequence[int]) -> Tuple[Optional[Tuple[int, ...]], int]:
+        tokens = np.asarray(tokens, dtype=np.intc)
+        best_key = None
+        best_prefix = 0
+        for key, state in self.states.items():
+            n = min(state.n_tokens, tokens.size)
+            if n <= best_prefix:
+                continue
+            mismatch = np.flatnonzero(state.input_ids[:n] != tokens[:n])
+            prefix = int(mismatch[0]) if mismatch.size > 0 else n
+            if prefix > best_prefix:
+                best_key = key
+                best_prefix = prefix
+        return best_key, best_prefix
+
+    # restore the snapshot sharing the longest prefix with tokens into seq_id if it covers more than
+    # min_prefix tokens, returns the number of tokens of tokens that are now in the kv cache
+    def restore(self, llm: Llama, tokens: Sequence[int], min_prefix: int = 0, seq_id: int = 0) -> int:
+        key, prefix = self.find(tokens)
+        if key is None or prefix <= min_prefix:
+            self.misses += 1
+            return min_prefix
+        self.hits += 1
+        self.states.move_to_end(key)
+        llm.load_seq_state(self.states[key], seq_id)
+        return prefix
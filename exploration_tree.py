@@ -0,0 +1,206 @@
+import numpy as np
+
+from typing import Dict, List, Optional
+
+from llm_generator import ResponseTrace, SampleData
+from util.growable_array import GrowableArray
+
+class ExplorationTree:
+    # token-id trie of everything explored from one prompt, the source of truth the node widgets view.
+    # Nodes are rows of growable numpy columns indexed by node id, children are linked through
+    # first_child/next_sibling so adding a branch is O(1), and a path (tokens or text) is rebuilt
+    # by walking parents in O(depth). Common prefixes are stored once, every node only keeps its
+    # own token, its piece bytes and where its sample lives (trace, sample index, candidate index).
+    # Lanes are the display rows, a lane holds one branch and lane_order is their top to bottom order.
+    ROOT = 0
+
+    def __init__(self, prompt: str = "", capacity: int = 256):
+        self.prompt = prompt
+        self.traces: List[ResponseTrace] = []
+        self._trace_ids: Dict[int, int] = {} # id(trace) -> index into traces
+        # per node
+        self._token_ids = GrowableArray(np.intc, capacity)
+        self._parents = GrowableArray(np.int32, capacity)
+        self._depths = GrowableArray(np.int32, capacity)
+        self._first_child = GrowableArray(np.int32, capacity)
+        self._last_child = GrowableArray(np.int32, capacity)
+        self._next_sibling = GrowableArray(np.int32, capacity)
+        self._node_traces = GrowableArray(np.int32, capacity)
+        self._sample_indices = GrowableArray(np.int32, capacity)
+        self._candidate_indices = GrowableArray(np.int32, capacity)
+        self._lanes = GrowableArray(np.int32, capacity)
+        self._text_offsets = GrowableArray(np.int64, capacity + 1)
+        self._text = GrowableArray(np.uint8, capacity * 4)
+        # display rows
+        self.lane_order: List[int] = []
+        self._lane_rows = np.empty(0, dtype=np.int32)
+
+        self._text_offsets.append(0)
+        self._append_node(-1, -1, b"", -1, -1, -1, -1)
+
+    def __len__(self) -> int:
+        return len(self._token_ids)
+
+    # the node columns by name, no copies
+    def columns(self) -> Dict[str, np.ndarray]:
+        return {name[1:]: column.values for name, column in self.__dict__.items() if isinstance(column, GrowableArray)}
+
+    # tree over existing columns (e.g. memory mapped from a session file), nothing is copied until
+    # the tree is changed
+    @classmethod
+    def from_columns(cls, prompt: str, columns: Dict[str, np.ndarray], traces: List[ResponseTrace],
+                     lane_order: List[int]) -> "ExplorationTree":
+        tree = cls(prompt, capacity=1)
+        for name, values in columns.items():
+            if isinstance(getattr(tree, "_" + name, None), GrowableArray):
+                setattr(tree, "_" + name, GrowableArray.from_array(values))
+        for trace in traces:
+            tree.add_trace(trace)
+        tree.lane_order = list(lane_order)
+        tree._lane_rows = np.empty(len(tree.lane_order), dtype=np.int32)
+        tree._lane_rows[tree.lane_order] = np.arange(len(tree.lane_order), dtype=np.int32)
+        return tree
+
+    def _append_node(self, parent: int, token: int, piece: bytes, trace_id: int, sample_index: int,
+                     candidate_index: int, lane: int) -> int:
+        node = len(self)
+        self._parents.append(parent)
+        self._depths.append(self._depths[parent] + 1 if parent >= 0 else 0)
+        self._first_child.append(-1)
+        self._last_child.append(-1)
+        self._next_sibling.append(-1)
+        self._node_traces.append(trace_id)
+        self._sample_indices.append(sample_index)
+        self._candidate_indices.append(candidate_index)
+        self._lanes.append(lane)
+        self._text.extend(np.frombuffer(piece, dtype=np.uint8))
+        self._text_offsets.append(len(self._text))
+        if parent >= 0:
+            if self._last_child[parent] < 0:
+                self._first_child.set(parent, node)
+            else:
+                self._next_sibling.set(self._last_child[parent], node)
+            self._last_child.set(parent, node)
+        # the token id goes last, len(tree) only grows once the node is complete
+        self._token_ids.append(token)
+        return node
+
+    def add_trace(self, trace: ResponseTrace) -> int:
+        trace_id = self._trace_ids.get(id(trace))
+        if trace_id is None:
+            trace_id = len(self.traces)
+            self.traces.append(trace)
+            self._trace_ids[id(trace)] = trace_id
+        return trace_id
+
+    # child of parent for a generated sample, the sample's selected token
+    def add_sample(self, parent: int, sample_data: SampleData, lane: int) -> int:
+        trace = sample_data.trace
+        i = sample_data.sample_index
+        return self._append_node(parent, sample_data.token, trace.decoded_bytes(i, i + 1), self.add_trace(trace),
+                                 i, sample_data.token_index, lane)
+
+    # sibling of node for candidate candidate_index of node's sample, the node's sample is shared.
+    # Returns the existing child if the candidate was explored before
+    def add_alternative(self, node: int, candidate_index: int, piece: bytes, lane: int) -> int:
+        sample_data = self.sample(node)
+        token = int(sample_data.candidate_ids[candidate_index])
+        parent = self.parent(node)
+        existing = self.find_child(parent, token)
+        if existing >= 0:
+            return existing
+        return self._append_node(parent, token, piece, int(self._node_traces[node]), int(self._sample_indices[node]),
+                                 candidate_index, lane)
+
+    def find_child(self, parent: int, token: int) -> int:
+        child = int(self._first_child[parent])
+        while child >= 0:
+            if self._token_ids[child] == token:
+                return child
+            child = int(self._next_sibling[child])
+        return -1
+
+    def children(self, node: int) -> List[int]:
+        result = []
+        child = int(self._first_child[node])
+        while child >= 0:
+            result.append(child)
+            child = int(self._next_sibling[child])
+        return result
+
+    def parent(self, node: int) -> int:
+        return int(self._parents[node])
+
+    def depth(self, node: int) -> int:
+        return int(self._depths[node])
+
+    def token(self, node: int) -> int:
+        return int(self._token_ids[node])
+
+    def candidate_index(self, node: int) -> int:
+        return int(self._candidate_indices[node])
+
+    def sample(self, node: int) -> Optional[SampleData]:
+        trace_id = self._node_traces[node]
+        return self.traces[trace_id].sample(int(self._sample_indices[node])) if trace_id >= 0 else None
+
+    # a trace column ("p", "entropy", ...) per node, gathered trace by trace. An alternative's p is its
+    # candidate's, nodes without a sample (the root) are nan
+    def sample_values(self, nodes: np.ndarray, column: str) -> np.ndarray:
+        nodes = np.asarray(nodes, dtype=np.int64)
+        values = np.full(nodes.size, np.nan, dtype=np.single)
+        node_traces = self._node_traces.values[nodes]
+        sample_indices = self._sample_indices.values[nodes]
+        candidate_indices = self._candidate_indices.values[nodes]
+        for trace_id in np.unique(node_traces[node_traces >= 0]).tolist():
+            in_trace = node_traces == trace_id
+            trace = self.traces[trace_id]
+            values[in_trace] = getattr(trace, column)[sample_indices[in_trace]]
+            alternative = in_trace & (candidate_indices >= 0)
+            if column == "p" and alternative.any():
+                offsets = trace.candidate_offsets[sample_indices[alternative]]
+                values[alternative] = trace.columns()["candidate_p"][offsets + candidate_indices[alternative]]
+        return values
+
+    def decoded_bytes(self, node: int) -> bytes:
+        return self._text.values[self._text_offsets[node]:self._text_offsets[node + 1]].tobytes()
+
+    def decoded_token(self, node: int) -> str:
+        return self.decoded_bytes(node).decode("utf-8", errors="replace")
+
+    # nodes from the first response token down to node
+    def path(self, node: int) -> np.ndarray:
+        nodes = np.empty(self.depth(node), dtype=np.int32)
+        parents = self._parents.values
+        for i in range(nodes.size - 1, -1, -1):
+            nodes[i] = node
+            node = parents[node]
+        return nodes
+
+    def path_tokens(self, node: int) -> np.ndarray:
+        return self._token_ids.values[self.path(node)]
+
+    # response text from the root down to node
+    def text(self, node: int) -> str:
+        text = self._text.values
+        offsets = self._text_offsets.values
+        pieces = [text[offsets[i]:offsets[i + 1]].tobytes() for i in self.path(node).tolist()]
+        return b"".join(pieces).decode("utf-8", errors="replace")
+
+    # lanes
+    def new_lane(self, after_lane: int = -1) -> int:
+        lane = len(self._lane_rows)
+        if after_lane < 0:
+            self.lane_order.append(lane)
+        else:
+            self.lane_order.insert(self.lane_order.index(after_lane) + 1, lane)
+        # rows of every lane, rebuilt per new lane (O(lanes)) so rows are plain lookups
+        self._lane_rows = np.empty(lane + 1, dtype=np.int32)
+        self._lane_rows[self.lane_order] = np.arange(len(self.lane_order), dtype=np.int32)
+        return lane
+
+    def lane(self, node: int) -> int:
+        return int(self._lanes[node])
+
+    def row(self, node: int) -> int:
+        return int(self._lane_rows[self._lanes[node]])
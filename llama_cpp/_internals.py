@@ -18,6 +18,7 @@ import numpy.typing as npt
 from .llama_types import *
 from .llama_grammar import LlamaGrammar
 from ._utils import suppress_stdout_stderr
+from .llama_numpy_sampler import LlamaNumpySampler
 
 import llama_cpp.llama_cpp as llama_cpp
 
@@ -42,6 +43,7 @@ class _LlamaModel:
         self._exit_stack = ExitStack()
 
         self.model = None
+        self._vocab: Optional[_LlamaVocab] = None
 
         if not os.path.exists(path_model):
             raise ValueError(f"Model path does not exist: {path_model}")
@@ -141,6 +143,14 @@ class _LlamaModel:
         assert self.model is not None
         return llama_cpp.llama_token_get_attr(self.model, token)
 
+    def vocab(self) -> _LlamaVocab:
+        """Per-token lookup tables of the vocabulary, built on first use and kept
+        for the lifetime of the model."""
+        assert self.model is not None
+        if self._vocab is None:
+            self._vocab = _LlamaVocab(self)
+        return self._vocab
+
     # Special tokens
 
     def token_bos(self) -> int:
@@ -209,22 +219,11 @@ class _LlamaModel:
         return list(tokens[:n_tokens])
 
     def token_to_piece(self, token: int, special: bool = False) -> bytes:
-        assert self.model is not None
-        buf = ctypes.create_string_buffer(32)
-        llama_cpp.llama_token_to_piece(self.model, token, buf, 32, 0, special)
-        return bytes(buf)
+        return self.vocab().pieces_for(special)[token]
 
     def detokenize(self, tokens: List[int], special: bool = False) -> bytes:
-        assert self.model is not None
-        output = b""
-        size = 32
-        buffer = (ctypes.c_char * size)()
-        for token in tokens:
-            n = llama_cpp.llama_token_to_piece(
-                self.model, llama_cpp.llama_token(token), buffer, size, 0, special
-            )
-            assert n <= size
-            output += bytes(buffer[:n])
+        pieces = self.vocab().pieces_for(special)
+        output = b"".join([pieces[token] for token in tokens])
         # NOTE: Llama1 models automatically added a space at the start of the prompt
         # this line removes a leading space if the first token is a beginning of sentence token
         return (
@@ -272,6 +271,61 @@ class _LlamaModel:
         return llama_cpp.llama_model_default_params()
 
 
+class _LlamaVocab:
+    """Lookup tables over every token of a model's vocabulary.
+
+    Built once per model with one pass of llama_token_to_piece, after which
+    detokenizing is a list lookup plus b"".join instead of a ctypes call per token.
+
+    Attributes:
+        pieces: Piece bytes of each token, control tokens render empty.
+        special_pieces: Piece bytes of each token with control tokens rendered.
+        text: Each piece decoded on its own as utf-8, invalid bytes dropped.
+        attrs: llama_token_attr flags of each token.
+        is_eog: Whether each token ends generation."""
+
+    def __init__(self, model: _LlamaModel):
+        assert model.model is not None
+        n_vocab = model.n_vocab()
+        buffer = ctypes.create_string_buffer(64)
+
+        def piece(token: int, special: bool) -> bytes:
+            nonlocal buffer
+            n = llama_cpp.llama_token_to_piece(
+                model.model, token, buffer, len(buffer), 0, special
+            )
+            if n < 0:
+                buffer = ctypes.create_string_buffer(-n)
+                n = llama_cpp.llama_token_to_piece(
+                    model.model, token, buffer, len(buffer), 0, special
+                )
+            return buffer.raw[:n]
+
+        self.pieces: List[bytes] = [piece(token, False) for token in range(n_vocab)]
+        self.special_pieces: List[bytes] = [
+            piece(token, True) for token in range(n_vocab)
+        ]
+        self.text: List[str] = [
+            p.decode("utf-8", errors="ignore") for p in self.pieces
+        ]
+        self.attrs: npt.NDArray[np.int32] = np.fromiter(
+            (llama_cpp.llama_token_get_attr(model.model, t) for t in range(n_vocab)),
+            dtype=np.int32,
+            count=n_vocab,
+        )
+        self.is_eog: npt.NDArray[np.bool_] = np.fromiter(
+            (llama_cpp.llama_token_is_eog(model.model, t) for t in range(n_vocab)),
+            dtype=np.bool_,
+            count=n_vocab,
+        )
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    def pieces_for(self, special: bool) -> List[bytes]:
+        return self.special_pieces if special else self.pieces
+
+
 class _LlamaContext:
     """Intermediate Python wrapper for a llama.cpp llama_context.
     NOTE: For stability it's recommended you use the Llama class instead."""
@@ -323,6 +377,10 @@ class _LlamaContext:
         assert self.ctx is not None
         llama_cpp.llama_kv_cache_clear(self.ctx)
 
+    def n_seq_max(self) -> int:
+        assert self.ctx is not None
+        return llama_cpp.llama_n_seq_max(self.ctx)
+
     def kv_cache_seq_rm(self, seq_id: int, p0: int, p1: int):
         assert self.ctx is not None
         llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, p0, p1)
@@ -347,6 +405,24 @@ class _LlamaContext:
 
     # TODO: set_state_data
 
+    def state_seq_get_size(self, seq_id: int) -> int:
+        assert self.ctx is not None
+        return llama_cpp.llama_state_seq_get_size(self.ctx, seq_id)
+
+    def state_seq_get_data(self, seq_id: int) -> bytes:
+        assert self.ctx is not None
+        state_size = self.state_seq_get_size(seq_id)
+        state = (ctypes.c_uint8 * int(state_size))()
+        n_bytes = llama_cpp.llama_state_seq_get_data(self.ctx, state, state_size, seq_id)
+        if int(n_bytes) > int(state_size):
+            raise RuntimeError("Failed to copy sequence state data")
+        return ctypes.string_at(state, int(n_bytes))
+
+    def state_seq_set_data(self, data: bytes, seq_id: int) -> int:
+        assert self.ctx is not None
+        state = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        return llama_cpp.llama_state_seq_set_data(self.ctx, state, len(data), seq_id)
+
     # TODO: llama_load_session_file
 
     # TODO: llama_save_session_file
@@ -565,18 +641,32 @@ class _LlamaBatch:
         assert self.batch is not None
         self.batch.n_tokens = 0
 
-    def set_batch(self, batch: Sequence[int], n_past: int, logits_all: bool):
+    def set_batch(
+        self, batch: Sequence[int], n_past: int, logits_all: bool, seq_id: int = 0
+    ):
         assert self.batch is not None
         n_tokens = len(batch)
         self.batch.n_tokens = n_tokens
         for i in range(n_tokens):
             self.batch.token[i] = batch[i]
             self.batch.pos[i] = n_past + i
-            self.batch.seq_id[i][0] = 0
+            self.batch.seq_id[i][0] = seq_id
             self.batch.n_seq_id[i] = 1
             self.batch.logits[i] = logits_all
         self.batch.logits[n_tokens - 1] = True
 
+    def add_token(self, token: int, pos: int, seq_ids: Sequence[int], logits: bool):
+        """Append a single token at position `pos` of every sequence in `seq_ids`."""
+        assert self.batch is not None
+        i = self.batch.n_tokens
+        self.batch.token[i] = token
+        self.batch.pos[i] = pos
+        for j, seq_id in enumerate(seq_ids):
+            self.batch.seq_id[i][j] = seq_id
+        self.batch.n_seq_id[i] = len(seq_ids)
+        self.batch.logits[i] = logits
+        self.batch.n_tokens += 1
+
     def add_sequence(self, batch: Sequence[int], seq_id: int, logits_all: bool):
         assert self.batch is not None
         n_tokens = len(batch)
@@ -592,6 +682,44 @@ class _LlamaBatch:
         self.batch.logits[n_tokens - 1] = True
 
 
+class _LlamaSeqIdPool:
+    """Sequence ids `1 .. n_seq_max - 1` of a context for short lived sequences that fork
+    off sequence 0 and are dropped once the batch with their last token is decoded.
+
+    Every sequence in flight has a token in the pending batch, so at most `n_batch` ids
+    are handed out. `take` clears the sequence it returns, `finish` marks a sequence whose
+    last token is in the pending batch and `release`, called once that batch is decoded,
+    clears the finished sequences and returns their ids. When the pool `is_empty` the
+    caller decodes the pending batch and calls `release` before taking another id."""
+
+    def __init__(self, ctx: _LlamaContext, n_batch: int):
+        n_seq_max = ctx.n_seq_max()
+        if n_seq_max < 2:
+            raise ValueError(
+                f"context has n_seq_max={n_seq_max}, sequences forked off sequence 0 need at least 2"
+            )
+        self.ctx = ctx
+        self.free = list(range(min(n_seq_max - 1, n_batch), 0, -1))
+        self.finished: List[int] = []
+
+    def is_empty(self) -> bool:
+        return len(self.free) == 0
+
+    def take(self) -> int:
+        seq_id = self.free.pop()
+        self.ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        return seq_id
+
+    def finish(self, seq_id: int):
+        self.finished.append(seq_id)
+
+    def release(self):
+        for seq_id in self.finished:
+            self.ctx.kv_cache_seq_rm(seq_id, -1, -1)
+            self.free.append(seq_id)
+        self.finished.clear()
+
+
 class _LlamaTokenDataArray:
     def __init__(self, *, n_vocab: int):
         self.n_vocab = n_vocab
@@ -747,6 +875,12 @@ class _LlamaSamplingContext:
     cur: list[llama_cpp.llama_token_data] = field(default_factory=list)
     #JW
     _token_data_array:_LlamaTokenDataArray = None
+    # reused by every sample, the penalty window is copied into a fixed buffer
+    _penalty_window: Optional[npt.NDArray[np.intc]] = None
+    _penalty_window_p: Optional[llama_cpp.llama_token_p] = None  # type: ignore
+    # samples with this instead of the native sampler of ctx_main, grammars stay native
+    sampler: Optional[LlamaNumpySampler] = None
+
     def reset(self):
         self.prev = []
         self.cur = []
@@ -760,6 +894,7 @@ class _LlamaSamplingContext:
             grammar=self.grammar,
             prev=self.prev.copy(),
             cur=self.cur.copy(),
+            sampler=self.sampler,
         )
 
     def last(self) -> Optional[int]:
@@ -776,10 +911,16 @@ class _LlamaSamplingContext:
         ctx_main: _LlamaContext,
         idx: int = 0,
         logits_array: Optional[npt.NDArray[np.single]] = None,
+        last_tokens: Optional[npt.NDArray[np.intc]] = None,
     ):
+        """Sample a token, `last_tokens` is the penalty history to use instead of `prev`."""
         n_vocab = ctx_main.model.n_vocab()
         id: int = 0
 
+        sampler = ctx_main if self.sampler is None else self.sampler
+        if self.sampler is not None:
+            self.sampler.clear_stages()
+
         if logits_array is None:
             logits = ctx_main.get_logits_ith(idx)
             logits_array = np.array(
@@ -791,20 +932,25 @@ class _LlamaSamplingContext:
         for token, logit_bias in self.params.logit_bias.items():
             logits_array[token] += logit_bias
 
-        self._token_data_array = _LlamaTokenDataArray(
-            n_vocab=n_vocab
-        )  # TODO: Only create this once
+        if (
+            self._token_data_array is None
+            or self._token_data_array.n_vocab != n_vocab
+        ):
+            self._token_data_array = _LlamaTokenDataArray(n_vocab=n_vocab)
         self._token_data_array.copy_logits(logits_array)
 
         # apply penalties
-        if len(self.prev) > 0:
+        n_prev = len(self.prev) if last_tokens is None else len(last_tokens)
+        if n_prev > 0:
             nl_token = ctx_main.model.token_nl()
             nl_logit = logits_array[nl_token]
-            last_tokens = self.prev[-self.params.penalty_last_n :]
-            last_tokens_size = min(len(last_tokens), self.params.penalty_last_n)
+            last_tokens_size = min(n_prev, self.params.penalty_last_n)
             if last_tokens_size > 0:
-                last_tokens_p = (llama_cpp.llama_token * len(last_tokens))(*last_tokens)
-                ctx_main.sample_repetition_penalties(
+                last_tokens_p = self._fill_penalty_window(
+                    self.prev if last_tokens is None else last_tokens,
+                    last_tokens_size,
+                )
+                sampler.sample_repetition_penalties(
                     self._token_data_array,
                     last_tokens_p,
                     last_tokens_size,
@@ -819,15 +965,15 @@ class _LlamaSamplingContext:
             ctx_main.sample_grammar(self._token_data_array, self.grammar)
 
         if self.params.temp < 0:
-            ctx_main.sample_softmax(self._token_data_array)
+            sampler.sample_softmax(self._token_data_array)
             id = self._token_data_array.candidates_data.id[0]
         elif self.params.temp == 0:
-            id = ctx_main.sample_token_greedy(self._token_data_array)
+            id = sampler.sample_token_greedy(self._token_data_array)
         else:
             if self.params.mirostat == 1:
                 mirostat_m = 100
-                ctx_main.sample_temp(self._token_data_array, self.params.temp)
-                id = ctx_main.sample_token_mirostat(
+                sampler.sample_temp(self._token_data_array, self.params.temp)
+                id = sampler.sample_token_mirostat(
                     self._token_data_array,
                     self.params.mirostat_tau,
                     self.params.mirostat_eta,
@@ -835,8 +981,8 @@ class _LlamaSamplingContext:
                     ctypes.pointer(self.mirostat_mu),
                 )
             elif self.params.mirostat == 2:
-                ctx_main.sample_temp(self._token_data_array, self.params.temp)
-                id = ctx_main.sample_token_mirostat_v2(
+                sampler.sample_temp(self._token_data_array, self.params.temp)
+                id = sampler.sample_token_mirostat_v2(
                     self._token_data_array,
                     self.params.mirostat_tau,
                     self.params.mirostat_eta,
@@ -844,26 +990,37 @@ class _LlamaSamplingContext:
                 )
             else:
                 min_keep = max(1, self.params.n_probs)
-                ctx_main.sample_top_k(
+                sampler.sample_top_k(
                     self._token_data_array, self.params.top_k, min_keep=min_keep
                 )
-                ctx_main.sample_tail_free(
+                sampler.sample_tail_free(
                     self._token_data_array, self.params.tfs_z, min_keep=min_keep
                 )
-                ctx_main.sample_typical(
+                sampler.sample_typical(
                     self._token_data_array, self.params.typical_p, min_keep=min_keep
                 )
-                ctx_main.sample_top_p(
+                sampler.sample_top_p(
                     self._token_data_array, self.params.top_p, min_keep=min_keep
                 )
-                ctx_main.sample_min_p(
+                sampler.sample_min_p(
                     self._token_data_array, self.params.min_p, min_keep=min_keep
                 )
-                ctx_main.sample_temp(self._token_data_array, self.params.temp)
-                id = ctx_main.sample_token(self._token_data_array)
+                sampler.sample_temp(self._token_data_array, self.params.temp)
+                id = sampler.sample_token(self._token_data_array)
 
         return id
 
+    def _fill_penalty_window(self, tokens, size: int):
+        if self._penalty_window is None or self._penalty_window.shape[0] < size:
+            self._penalty_window = np.zeros(
+                (max(size, self.params.penalty_last_n),), dtype=np.intc
+            )
+            self._penalty_window_p = self._penalty_window.ctypes.data_as(
+                llama_cpp.llama_token_p
+            )
+        self._penalty_window[:size] = tokens[-size:]
+        return self._penalty_window_p
+
     def accept(self, ctx_main: _LlamaContext, id: int, apply_grammar: bool):
         if apply_grammar and self.grammar is not None:
             ctx_main.grammar_accept_token(self.grammar, id)
@@ -24,6 +24,7 @@ from typing import (
     Deque,
     Callable,
     Dict,
+    Tuple,
 )
 from collections import deque
 from pathlib import Path
@@ -37,7 +38,13 @@ from .llama_cache import (
     LlamaDiskCache,  # type: ignore
     LlamaRAMCache,  # type: ignore
 )
-from .llama_tokenizer import BaseLlamaTokenizer, LlamaTokenizer
+from .llama_tokenizer import (
+    BaseLlamaTokenizer,
+    LlamaTokenizer,
+    LlamaStreamingDetokenizer,
+)
+from .llama_logits import LlamaLogitsStore, LogitsRetention
+from .llama_numpy_sampler import LlamaNumpySampler
 import llama_cpp.llama_cpp as llama_cpp
 import llama_cpp.llama_chat_format as llama_chat_format
 
@@ -50,6 +57,7 @@ from ._internals import (
     _LlamaModel,  # type: ignore
     _LlamaContext,  # type: ignore
     _LlamaBatch,  # type: ignore
+    _LlamaSeqIdPool,  # type: ignore
     _LlamaTokenDataArray,  # type: ignore
     _LlamaSamplingParams,  # type: ignore
     _LlamaSamplingContext,  # type: ignore
@@ -82,6 +90,7 @@ class Llama:
         seed: int = llama_cpp.LLAMA_DEFAULT_SEED,
         n_ctx: int = 512,
         n_batch: int = 512,
+        n_seq_max: int = 1,
         n_threads: Optional[int] = None,
         n_threads_batch: Optional[int] = None,
         rope_scaling_type: Optional[
@@ -96,11 +105,15 @@ class Llama:
         yarn_beta_slow: float = 1.0,
         yarn_orig_ctx: int = 0,
         logits_all: bool = False,
+        logits_retention: LogitsRetention = "dense",
+        logits_top_k: int = 64,
         embedding: bool = False,
         offload_kqv: bool = True,
         flash_attn: bool = False,
         # Sampling Params
         last_n_tokens_size: int = 64,
+        sampler_backend: Literal["native", "numpy"] = "native",
+        capture_sampler_stages: bool = False,
         # LoRA Params
         lora_base: Optional[str] = None,
         lora_scale: float = 1.0,
@@ -163,6 +176,7 @@ class Llama:
             seed: RNG seed, -1 for random
             n_ctx: Text context, 0 = from model
             n_batch: Prompt processing maximum batch size
+            n_seq_max: Maximum number of sequences (distinct KV states), `score` needs at least 2
             n_threads: Number of threads to use for generation
             n_threads_batch: Number of threads to use for batch processing
             rope_scaling_type: RoPE scaling type, from `enum llama_rope_scaling_type`. ref: https://github.com/ggerganov/llama.cpp/pull/2054
@@ -175,10 +189,14 @@ class Llama:
             yarn_beta_slow: YaRN high correction dim
             yarn_orig_ctx: YaRN original context size
             logits_all: Return logits for all tokens, not just the last token. Must be True for completion to return logprobs.
+            logits_retention: How the logits of evaluated tokens are kept. "dense" keeps full rows in `scores` (n_ctx x n_vocab float32), "last" only the last row, "top_k" the `logits_top_k` largest logits of every row with the row's logsumexp.
+            logits_top_k: Logits kept per position with logits_retention="top_k".
             embedding: Embedding mode only.
             offload_kqv: Offload K, Q, V to GPU.
             flash_attn: Use flash attention.
             last_n_tokens_size: Maximum number of tokens to keep in the last_n_tokens deque.
+            sampler_backend: "native" samples with llama.cpp, "numpy" with the same chain in NumPy, which samples the same tokens for a seed as a libstdc++ build of llama.cpp (not the bundled MSVC built Windows DLL).
+            capture_sampler_stages: With sampler_backend="numpy", keep the token ids that survive each sampler stage of the last `sample` in `sampler_stages`.
             lora_base: Optional path to base model, useful if using a quantized base model and you want to apply LoRA to an f16 model.
             lora_path: Path to a LoRA file to apply to the model.
             numa: numa policy
@@ -314,6 +332,7 @@ class Llama:
         self.context_params.seed = seed
         self.context_params.n_ctx = n_ctx
         self.context_params.n_batch = self.n_batch
+        self.context_params.n_seq_max = n_seq_max
         self.context_params.n_threads = self.n_threads
         self.context_params.n_threads_batch = self.n_threads_batch
         self.context_params.rope_scaling_type = (
@@ -344,6 +363,10 @@ class Llama:
         self.context_params.logits_all = (
             logits_all if draft_model is None else True
         )  # Must be set to True for speculative decoding
+        if draft_model is not None and logits_retention == "last":
+            raise ValueError(
+                "speculative decoding samples earlier positions, logits_retention='last' is not supported"
+            )
         self.context_params.embeddings = embedding  # TODO: Rename to embeddings
         self.context_params.offload_kqv = offload_kqv
         self.context_params.flash_attn = flash_attn
@@ -354,6 +377,11 @@ class Llama:
             self.context_params.type_v = type_v
         # Sampling Params
         self.last_n_tokens_size = last_n_tokens_size
+        if sampler_backend not in ("native", "numpy"):
+            raise ValueError(
+                f"sampler_backend must be 'native' or 'numpy', got {sampler_backend!r}"
+            )
+        self.sampler_backend = sampler_backend
 
         self.cache: Optional[BaseLlamaCache] = None
 
@@ -441,6 +469,7 @@ class Llama:
 
         self.chat_format = chat_format
         self.chat_handler = chat_handler
+        self._chat_formatters: Dict[str, llama_chat_format.ChatFormatter] = {}
         self._chat_handlers: Dict[str, llama_chat_format.LlamaChatCompletionHandler] = (
             {}
         )
@@ -454,11 +483,22 @@ class Llama:
         self._token_eos = self.token_eos()
 
         self._candidates = _LlamaTokenDataArray(n_vocab=self._n_vocab)
+        # one sampler for every `sample` call, it samples into `_candidates`
+        self._sampling_context = _LlamaSamplingContext(
+            _token_data_array=self._candidates
+        )
+        if sampler_backend == "numpy":
+            self._sampling_context.sampler = LlamaNumpySampler(
+                n_vocab=self._n_vocab,
+                seed=seed,
+                capture_stages=capture_sampler_stages,
+            )
 
         self.n_tokens = 0
         self.input_ids: npt.NDArray[np.intc] = np.ndarray((n_ctx,), dtype=np.intc)
-        self.scores: npt.NDArray[np.single] = np.ndarray(
-            (n_ctx, self._n_vocab), dtype=np.single
+        self.logits_retention = logits_retention
+        self._logits = LlamaLogitsStore(
+            n_ctx, self._n_vocab, retention=logits_retention, top_k=logits_top_k
         )
 
         self._mirostat_mu = ctypes.c_float(
@@ -504,12 +544,13 @@ class Llama:
             )
 
         for name, template in template_choices.items():
-            self._chat_handlers[name] = llama_chat_format.Jinja2ChatFormatter(
+            self._chat_formatters[name] = llama_chat_format.Jinja2ChatFormatter(
                 template=template,
                 eos_token=eos_token,
                 bos_token=bos_token,
                 stop_token_ids=[eos_token_id],
-            ).to_chat_handler()
+            )
+            self._chat_handlers[name] = self._chat_formatters[name].to_chat_handler()
 
         if (
             self.chat_format is None
@@ -556,9 +597,38 @@ class Llama:
     def _input_ids(self) -> npt.NDArray[np.intc]:
         return self.input_ids[: self.n_tokens]
 
+    @property
+    def scores(self) -> npt.NDArray[np.single]:
+        """The dense `(n_ctx, n_vocab)` logits matrix, only kept with logits_retention="dense"."""
+        if self._logits.dense is None:
+            raise ValueError(
+                f"scores is only kept with logits_retention='dense' (is {self.logits_retention!r}), use logits_row"
+            )
+        return self._logits.dense
+
     @property
     def _scores(self) -> npt.NDArray[np.single]:
-        return self.scores[: self.n_tokens, :]
+        return self._logits.rows(0, self.n_tokens)
+
+    @property
+    def capture_sampler_stages(self) -> bool:
+        sampler = self._sampling_context.sampler
+        return sampler is not None and sampler.capture_stages
+
+    @property
+    def sampler_stages(self) -> List[Tuple[str, npt.NDArray[np.intc]]]:
+        """`(stage, token ids)` of the candidates that survived each stage of the last
+        `sample`, only recorded with sampler_backend="numpy" and capture_sampler_stages."""
+        sampler = self._sampling_context.sampler
+        return [] if sampler is None else sampler.stages
+
+    def logits_row(self, pos: int) -> npt.NDArray[np.single]:
+        """The logits row of an evaluated position, see `LlamaLogitsStore.row`."""
+        return self._logits.row(pos)
+
+    def logprobs_rows(self, start: int, stop: int) -> npt.NDArray[np.single]:
+        """Log probabilities of the positions `start .. stop - 1`, see `LlamaLogitsStore.logprobs`."""
+        return self._logits.logprobs(start, stop)
 
     @property
     def eval_tokens(self) -> Deque[int]:
@@ -566,8 +636,9 @@ class Llama:
 
     @property
     def eval_logits(self) -> Deque[List[float]]:
+        start = self.n_tokens - 1 if self.logits_retention == "last" else 0
         return deque(
-            self.scores[: self.n_tokens, :].tolist(),
+            self._logits.rows(max(0, start), self.n_tokens).tolist(),
             maxlen=self._n_ctx if self.context_params.logits_all else 1,
         )
 
@@ -601,6 +672,23 @@ class Llama:
         """
         return self.tokenizer_.detokenize(tokens, prev_tokens=prev_tokens)
 
+    def _top_logprob_dict(
+        self,
+        top: List[Tuple[float, int]],
+        prev_tokens: Optional[List[int]] = None,
+    ) -> Dict[str, float]:
+        """Map the text of each (logprob, token) pair to its logprob, the text is a
+        vocab table lookup when the model's own tokenizer is used."""
+        if isinstance(self.tokenizer_, LlamaTokenizer):
+            vocab_text = self._model.vocab().text
+            return {vocab_text[i]: logprob for logprob, i in top}
+        return {
+            self.detokenize([i], prev_tokens=prev_tokens).decode(
+                "utf-8", errors="ignore"
+            ): logprob
+            for logprob, i in top
+        }
+
     def set_cache(self, cache: Optional[BaseLlamaCache]):
         """Set the cache.
 
@@ -617,6 +705,8 @@ class Llama:
         """
         assert self._ctx.ctx is not None
         llama_cpp.llama_set_rng_seed(self._ctx.ctx, seed)
+        if self._sampling_context.sampler is not None:
+            self._sampling_context.sampler.set_rng_seed(seed)
 
     def reset(self):
         """Reset the model state."""
@@ -646,16 +736,16 @@ class Llama:
                 rows = n_tokens
                 cols = self._n_vocab
                 logits = np.ctypeslib.as_array(
-                    self._ctx.get_logits(), shape=(rows * cols,)
+                    self._ctx.get_logits(), shape=(rows, cols)
                 )
-                self.scores[n_past : n_past + n_tokens, :].reshape(-1)[::] = logits
+                self._logits.store(n_past, logits)
             else:
                 rows = 1
                 cols = self._n_vocab
                 logits = np.ctypeslib.as_array(
-                    self._ctx.get_logits(), shape=(rows * cols,)
+                    self._ctx.get_logits(), shape=(rows, cols)
                 )
-                self.scores[n_past + n_tokens - 1, :].reshape(-1)[::] = logits
+                self._logits.store(n_past + n_tokens - 1, logits)
             # Update n_tokens
             self.n_tokens += n_tokens
 
@@ -693,9 +783,9 @@ class Llama:
         assert self.n_tokens > 0
 
         if idx is None:
-            logits: npt.NDArray[np.single] = self._scores[-1, :]
+            logits: npt.NDArray[np.single] = self.logits_row(self.n_tokens - 1)
         else:
-            logits = self._scores[idx, :]
+            logits = self.logits_row(idx)
 
         if logits_processor is not None:
             logits[:] = (
@@ -704,33 +794,34 @@ class Llama:
                 else logits_processor(self._input_ids[: idx + 1], logits)
             )
 
-        sampling_params = _LlamaSamplingParams(
-            top_k=top_k,
-            top_p=top_p,
-            min_p=min_p,
-            tfs_z=tfs_z,
-            typical_p=typical_p,
-            temp=temp,
-            penalty_last_n=self.last_n_tokens_size,
-            penalty_repeat=repeat_penalty,
-            penalty_freq=frequency_penalty,
-            penalty_present=presence_penalty,
-            mirostat=mirostat_mode,
-            mirostat_tau=mirostat_tau,
-            mirostat_eta=mirostat_eta,
-            penalize_nl=penalize_nl,
-        )
-        sampling_context = _LlamaSamplingContext(
-            params=sampling_params,
-            grammar=grammar,
-        )
-        sampling_context.prev = list(self.eval_tokens)
-        id = sampling_context.sample(ctx_main=self._ctx, logits_array=logits)
-        sampling_context.accept(
-            ctx_main=self._ctx,
-            id=id,
-            apply_grammar=grammar is not None,
+        sampling_context = self._sampling_context
+        sampling_params = sampling_context.params
+        sampling_params.top_k = top_k
+        sampling_params.top_p = top_p
+        sampling_params.min_p = min_p
+        sampling_params.tfs_z = tfs_z
+        sampling_params.typical_p = typical_p
+        sampling_params.temp = temp
+        sampling_params.penalty_last_n = self.last_n_tokens_size
+        sampling_params.penalty_repeat = repeat_penalty
+        sampling_params.penalty_freq = frequency_penalty
+        sampling_params.penalty_present = presence_penalty
+        sampling_params.mirostat = mirostat_mode
+        sampling_params.mirostat_tau = mirostat_tau
+        sampling_params.mirostat_eta = mirostat_eta
+        sampling_params.penalize_nl = penalize_nl
+        sampling_context.grammar = grammar
+        # mu starts from 0 on every call, as it did with a new context per call
+        sampling_context.mirostat_mu.value = 0.0
+        # the penalty window is a view of the evaluated tokens
+        last_tokens = self.input_ids[
+            max(0, self.n_tokens - self.last_n_tokens_size) : self.n_tokens
+        ]
+        id = sampling_context.sample(
+            ctx_main=self._ctx, logits_array=logits, last_tokens=last_tokens
         )
+        if grammar is not None:
+            self._ctx.grammar_accept_token(grammar, id)
         #JW
         self.token_data_array = sampling_context.get_token_data_array()
         return id
@@ -830,7 +921,7 @@ class Llama:
 
                 sample_idx += 1
                 if stopping_criteria is not None and stopping_criteria(
-                    self._input_ids, self._scores[-1, :]
+                    self._input_ids, self.logits_row(self.n_tokens - 1)
                 ):
                     return
                 tokens_or_none = yield token
@@ -1192,6 +1283,10 @@ class Llama:
             raise ValueError(
                 "logprobs is not supported for models created with logits_all=False"
             )
+        if logprobs is not None and self.logits_retention == "last":
+            raise ValueError(
+                "logprobs is not supported for models created with logits_retention='last'"
+            )
 
         if self.cache:
             try:
@@ -1211,10 +1306,16 @@ class Llama:
                     print("Llama._create_completion: cache miss", file=sys.stderr)
 
         if seed is not None:
-            self._ctx.set_rng_seed(seed)
+            self.set_seed(seed)
 
         finish_reason = "length"
-        multibyte_fix = 0
+        # the completion is detokenized as it grows, a stop sequence can only begin
+        # in the last max_stop_length - 1 bytes of what was already searched
+        detokenizer = LlamaStreamingDetokenizer(
+            self.tokenizer_, prev_tokens=prompt_tokens
+        )
+        max_stop_length = max((len(s) for s in stop_sequences), default=0)
+        searched_length = 0
         for token in self.generate(
             prompt_tokens,
             top_k=top_k,
@@ -1234,42 +1335,31 @@ class Llama:
             grammar=grammar,
         ):
             assert self._model.model is not None
-            if llama_cpp.llama_token_is_eog(self._model.model, token):
-                text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+            if self._model.vocab().is_eog[token]:
+                text = bytes(detokenizer.text)
                 finish_reason = "stop"
                 break
 
             completion_tokens.append(token)
-
-            all_text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
-
-            # Contains multi-byte UTF8
-            for k, char in enumerate(all_text[-3:]):
-                k = 3 - k
-                for num, pattern in [(2, 192), (3, 224), (4, 240)]:
-                    # Bitwise AND check
-                    if num > k and pattern & char == pattern:
-                        multibyte_fix = num - k
+            detokenizer.append(token)
+            all_text = detokenizer.text
 
             # Stop incomplete bytes from passing
-            if multibyte_fix > 0:
-                multibyte_fix -= 1
+            if not detokenizer.is_complete:
                 continue
 
-            any_stop = [s for s in stop_sequences if s in all_text]
+            search_start = max(0, searched_length - max_stop_length + 1)
+            searched_length = len(all_text)
+            stop_positions = [all_text.find(s, search_start) for s in stop_sequences]
+            any_stop = [i for i in stop_positions if i >= 0]
             if len(any_stop) > 0:
-                first_stop = any_stop[0]
-                text = all_text[: all_text.index(first_stop)]
+                text = bytes(all_text[: any_stop[0]])
                 finish_reason = "stop"
                 break
 
             if stream:
                 remaining_tokens = completion_tokens[returned_tokens:]
-                remaining_text = self.detokenize(
-                    remaining_tokens,
-                    prev_tokens=prompt_tokens + completion_tokens[:returned_tokens],
-                )
-                remaining_length = len(remaining_text)
+                remaining_length = len(all_text) - detokenizer.offset(returned_tokens)
 
                 # We want to avoid yielding any characters from
                 # the generated text if they are part of a stop
@@ -1277,7 +1367,7 @@ class Llama:
                 first_stop_position = 0
                 for s in stop_sequences:
                     for i in range(min(len(s), remaining_length), 0, -1):
-                        if remaining_text.endswith(s[:i]):
+                        if all_text.endswith(s[:i]):
                             if i > first_stop_position:
                                 first_stop_position = i
                             break
@@ -1287,57 +1377,36 @@ class Llama:
                 if logprobs is not None:
                     # not sure how to handle this branch when dealing
                     # with CJK output, so keep it unchanged
-                    for token in remaining_tokens:
+                    for j, token in enumerate(remaining_tokens, returned_tokens):
                         if token == bos_token_id:
                             continue
-                        token_end_position += len(
-                            self.detokenize(
-                                [token],
-                                prev_tokens=prompt_tokens
-                                + completion_tokens[:returned_tokens],
-                            )
-                        )
+                        token_piece = detokenizer.piece(j)
+                        token_end_position += len(token_piece)
                         # Check if stop sequence is in the token
                         if token_end_position > (
                             remaining_length - first_stop_position
                         ):
                             break
-                        token_str = self.detokenize(
-                            [token],
-                            prev_tokens=prompt_tokens
-                            + completion_tokens[:returned_tokens],
-                        ).decode("utf-8", errors="ignore")
-                        text_offset = len(prompt) + len(
-                            self.detokenize(
-                                completion_tokens[:returned_tokens],
-                                prev_tokens=prompt_tokens
-                                + completion_tokens[:returned_tokens],
-                            ).decode("utf-8", errors="ignore")
+                        token_str = token_piece.decode("utf-8", errors="ignore")
+                        text_offset = len(prompt) + detokenizer.char_offset(
+                            returned_tokens
                         )
                         token_offset = len(prompt_tokens) + returned_tokens
-                        logits = self._scores[token_offset - 1, :]
-                        current_logprobs = Llama.logits_to_logprobs(logits).tolist()
+                        current_logprobs = self.logprobs_rows(
+                            token_offset - 1, token_offset
+                        )[0].tolist()
                         sorted_logprobs = list(
                             sorted(
                                 zip(current_logprobs, range(len(current_logprobs))),
                                 reverse=True,
                             )
                         )
-                        top_logprob = {
-                            self.detokenize([i]).decode(
-                                "utf-8", errors="ignore"
-                            ): logprob
-                            for logprob, i in sorted_logprobs[:logprobs]
-                        }
+                        top_logprob = self._top_logprob_dict(
+                            sorted_logprobs[:logprobs]
+                        )
                         top_logprob.update({token_str: current_logprobs[int(token)]})
                         logprobs_or_none = {
-                            "tokens": [
-                                self.detokenize(
-                                    [token],
-                                    prev_tokens=prompt_tokens
-                                    + completion_tokens[:returned_tokens],
-                                ).decode("utf-8", errors="ignore")
-                            ],
+                            "tokens": [token_str],
                             "text_offset": [text_offset],
                             "token_logprobs": [current_logprobs[int(token)]],
                             "top_logprobs": [top_logprob],
@@ -1350,11 +1419,7 @@ class Llama:
                             "model": model_name,
                             "choices": [
                                 {
-                                    "text": self.detokenize(
-                                        [token],
-                                        prev_tokens=prompt_tokens
-                                        + completion_tokens[:returned_tokens],
-                                    ).decode("utf-8", errors="ignore"),
+                                    "text": token_str,
                                     "index": 0,
                                     "logprobs": logprobs_or_none,
                                     "finish_reason": None,
@@ -1366,10 +1431,12 @@ class Llama:
                         decode_success = False
                         for i in range(1, len(remaining_tokens) + 1):
                             try:
-                                bs = self.detokenize(
-                                    remaining_tokens[:i],
-                                    prev_tokens=prompt_tokens
-                                    + completion_tokens[:returned_tokens],
+                                bs = bytes(
+                                    all_text[
+                                        detokenizer.offset(
+                                            returned_tokens
+                                        ) : detokenizer.offset(returned_tokens + i)
+                                    ]
                                 )
                                 ts = bs.decode("utf-8")
                                 decode_success = True
@@ -1405,14 +1472,14 @@ class Llama:
                         }
 
             if len(completion_tokens) >= max_tokens:
-                text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+                text = bytes(detokenizer.text)
                 finish_reason = "length"
                 break
 
         if stopping_criteria is not None and stopping_criteria(
-            self._input_ids, self._scores[-1, :]
+            self._input_ids, self.logits_row(self.n_tokens - 1)
         ):
-            text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+            text = bytes(detokenizer.text)
             finish_reason = "stop"
 
         if self.verbose:
@@ -1420,10 +1487,7 @@ class Llama:
 
         if stream:
             remaining_tokens = completion_tokens[returned_tokens:]
-            all_text = self.detokenize(
-                remaining_tokens,
-                prev_tokens=prompt_tokens + completion_tokens[:returned_tokens],
-            )
+            all_text = bytes(detokenizer.text[detokenizer.offset(returned_tokens) :])
             any_stop = [s for s in stop_sequences if s in all_text]
             if len(any_stop) > 0:
                 end = min(all_text.index(stop) for stop in any_stop)
@@ -1431,53 +1495,37 @@ class Llama:
                 end = len(all_text)
 
             token_end_position = 0
-            for token in remaining_tokens:
-                token_end_position += len(
-                    self.detokenize(
-                        [token],
-                        prev_tokens=prompt_tokens + completion_tokens[:returned_tokens],
-                    )
-                )
+            for j, token in enumerate(remaining_tokens, returned_tokens):
+                token_piece = detokenizer.piece(j)
+                token_end_position += len(token_piece)
 
                 logprobs_or_none: Optional[CompletionLogprobs] = None
                 if logprobs is not None:
                     if token == bos_token_id:
                         continue
-                    token_str = self.detokenize([token]).decode(
-                        "utf-8", errors="ignore"
-                    )
-                    text_offset = len(prompt) + len(
-                        self.detokenize(
-                            completion_tokens[:returned_tokens],
-                            prev_tokens=prompt_tokens
-                            + completion_tokens[:returned_tokens],
-                        )
-                    )
+                    token_str = token_piece.decode("utf-8", errors="ignore")
+                    text_offset = len(prompt) + detokenizer.offset(returned_tokens)
                     token_offset = len(prompt_tokens) + returned_tokens - 1
-                    logits = self._scores[token_offset, :]
-                    current_logprobs = Llama.logits_to_logprobs(logits).tolist()
+                    current_logprobs = self.logprobs_rows(
+                        token_offset, token_offset + 1
+                    )[0].tolist()
                     sorted_logprobs = list(
                         sorted(
                             zip(current_logprobs, range(len(current_logprobs))),
                             reverse=True,
                         )
                     )
-                    top_logprob = {
-                        self.detokenize([i]).decode("utf-8", errors="ignore"): logprob
-                        for logprob, i in sorted_logprobs[:logprobs]
-                    }
+                    top_logprob = self._top_logprob_dict(sorted_logprobs[:logprobs])
                     top_logprob.update({token_str: current_logprobs[int(token)]})
                     logprobs_or_none = {
-                        "tokens": [
-                            self.detokenize([token]).decode("utf-8", errors="ignore")
-                        ],
+                        "tokens": [token_str],
                         "text_offset": [text_offset],
                         "token_logprobs": [current_logprobs[int(token)]],
                         "top_logprobs": [top_logprob],
                     }
 
                 if token_end_position >= end:
-                    last_text = self.detokenize([token])
+                    last_text = token_piece
                     if token_end_position == end - 1:
                         break
                     returned_tokens += 1
@@ -1506,9 +1554,7 @@ class Llama:
                     "model": model_name,
                     "choices": [
                         {
-                            "text": self.detokenize([token]).decode(
-                                "utf-8", errors="ignore"
-                            ),
+                            "text": token_piece.decode("utf-8", errors="ignore"),
                             "index": 0,
                             "logprobs": logprobs_or_none,
                             "finish_reason": None,
@@ -1568,13 +1614,17 @@ class Llama:
             else:
                 all_tokens = completion_tokens
 
-            all_token_strs = [
-                self.detokenize([token], prev_tokens=all_tokens[:i]).decode(
-                    "utf-8", errors="ignore"
-                )
-                for i, token in enumerate(all_tokens)
-            ]
-            all_logprobs = Llama.logits_to_logprobs(self._scores)[token_offset:]
+            if isinstance(self.tokenizer_, LlamaTokenizer):
+                vocab_text = self._model.vocab().text
+                all_token_strs = [vocab_text[token] for token in all_tokens]
+            else:
+                all_token_strs = [
+                    self.detokenize([token], prev_tokens=all_tokens[:i]).decode(
+                        "utf-8", errors="ignore"
+                    )
+                    for i, token in enumerate(all_tokens)
+                ]
+            all_logprobs = self.logprobs_rows(token_offset, self.n_tokens)
             # TODO: may be able to change this loop to use np.take_along_dim
             for idx, (token, token_str, logprobs_token) in enumerate(
                 zip(all_tokens, all_token_strs, all_logprobs)
@@ -1596,12 +1646,9 @@ class Llama:
                     )
                 )
                 token_logprobs.append(logprobs_token[int(token)])
-                top_logprob: Optional[Dict[str, float]] = {
-                    self.detokenize([i], prev_tokens=all_tokens[:idx]).decode(
-                        "utf-8", errors="ignore"
-                    ): logprob
-                    for logprob, i in sorted_logprobs[:logprobs]
-                }
+                top_logprob: Optional[Dict[str, float]] = self._top_logprob_dict(
+                    sorted_logprobs[:logprobs], prev_tokens=all_tokens[:idx]
+                )
                 top_logprob.update({token_str: logprobs_token[int(token)]})
                 top_logprobs.append(top_logprob)
             # Weird idosincracy of the OpenAI API where
@@ -1978,6 +2025,7 @@ class Llama:
             seed=self.context_params.seed,
             n_ctx=self.context_params.n_ctx,
             n_batch=self.n_batch,
+            n_seq_max=self.context_params.n_seq_max,
             n_threads=self.context_params.n_threads,
             n_threads_batch=self.context_params.n_threads_batch,
             rope_scaling_type=self.context_params.rope_scaling_type,
@@ -1990,11 +2038,15 @@ class Llama:
             yarn_beta_slow=self.context_params.yarn_beta_slow,
             yarn_orig_ctx=self.context_params.yarn_orig_ctx,
             logits_all=self.context_params.logits_all,
+            logits_retention=self.logits_retention,
+            logits_top_k=self._logits.top_k,
             embedding=self.context_params.embeddings,
             offload_kqv=self.context_params.offload_kqv,
             flash_attn=self.context_params.flash_attn,
             # Sampling Params
             last_n_tokens_size=self.last_n_tokens_size,
+            sampler_backend=self.sampler_backend,
+            capture_sampler_stages=self.capture_sampler_stages,
             # LoRA Params
             lora_base=self.lora_base,
             lora_scale=self.lora_scale,
@@ -2039,19 +2091,29 @@ class Llama:
                 f"Llama.save_state: saving {n_bytes} bytes of llama state",
                 file=sys.stderr,
             )
+        logits_state = self._logits.get_state(0, self.n_tokens)
         return LlamaState(
-            scores=self._scores.copy(),
+            scores=logits_state.get(
+                "logits", np.empty((0, self._n_vocab), dtype=np.single)
+            ),
             input_ids=self.input_ids.copy(),
             n_tokens=self.n_tokens,
             llama_state=bytes(llama_state_compact),
             llama_state_size=n_bytes,
+            logits_state=logits_state,
         )
 
     def load_state(self, state: LlamaState) -> None:
         assert self._ctx.ctx is not None
         # Only filling in up to `n_tokens` and then zero-ing out the rest
-        self.scores[: state.n_tokens, :] = state.scores.copy()
-        self.scores[state.n_tokens :, :] = 0.0
+        logits_state = (
+            state.logits_state
+            if state.logits_state is not None
+            else {"logits": state.scores}
+        )
+        self._logits.set_state(0, state.n_tokens, logits_state)
+        if self._logits.dense is not None:
+            self._logits.dense[state.n_tokens :, :] = 0.0
         self.input_ids = state.input_ids.copy()
         self.n_tokens = state.n_tokens
         state_size = state.llama_state_size
@@ -2061,10 +2123,226 @@ class Llama:
         if llama_cpp.llama_set_state_data(self._ctx.ctx, llama_state) != state_size:
             raise RuntimeError("Failed to set llama state data")
 
+    def save_seq_state(
+        self, seq_id: int = 0, input_ids: Optional[Sequence[int]] = None
+    ) -> LlamaSeqState:
+        """Save the KV cache of a single sequence.
+
+        Much smaller than `save_state` as only the cells of `seq_id` and the last
+        logits row are copied instead of the whole context and score matrix.
+
+        Args:
+            seq_id: The sequence to save.
+            input_ids: The tokens of the sequence, defaults to the evaluated tokens of sequence 0.
+
+        Returns:
+            The sequence state.
+        """
+        assert self._ctx.ctx is not None
+        llama_state = self._ctx.state_seq_get_data(seq_id)
+        # the scores only belong to the evaluated tokens of sequence 0
+        logits_state: Optional[Dict[str, npt.NDArray]] = None
+        if input_ids is None:
+            input_ids = self._input_ids
+            if self.n_tokens > 0:
+                logits_state = self._logits.get_state(self.n_tokens - 1, self.n_tokens)
+        input_ids = np.array(input_ids, dtype=np.intc)
+        n_tokens = len(input_ids)
+        if self.verbose:
+            print(
+                f"Llama.save_seq_state: saving {len(llama_state)} bytes of sequence {seq_id} state",
+                file=sys.stderr,
+            )
+        return LlamaSeqState(
+            input_ids=input_ids,
+            n_tokens=n_tokens,
+            logits_state=logits_state,
+            llama_state=llama_state,
+            llama_state_size=len(llama_state),
+        )
+
+    def load_seq_state(self, state: LlamaSeqState, seq_id: int = 0) -> None:
+        """Restore a sequence saved with `save_seq_state` into `seq_id`.
+
+        Only sequence 0 is tracked by `input_ids`/`n_tokens`, so those are updated
+        when restoring into it.
+        """
+        assert self._ctx.ctx is not None
+        self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        if self._ctx.state_seq_set_data(state.llama_state, seq_id) == 0:
+            raise RuntimeError("Failed to set sequence state data")
+        if seq_id == 0:
+            self.input_ids[: state.n_tokens] = state.input_ids
+            self.n_tokens = state.n_tokens
+            if state.logits_state is not None and state.n_tokens > 0:
+                self._logits.set_state(
+                    state.n_tokens - 1, state.n_tokens, state.logits_state
+                )
+
+    def score(
+        self,
+        prompt: Union[str, Sequence[int]],
+        continuations: Sequence[Union[str, Sequence[int]]],
+    ) -> List[LlamaContinuationScore]:
+        """Score existing continuations of a prompt by teacher forcing, without sampling.
+
+        The prompt is evaluated once on sequence 0 (reusing what is already in the
+        KV cache) and shared with every continuation through a sequence copy, so
+        each continuation costs one prefill of its own tokens. The continuations are
+        packed into `n_batch` sized batches with logits requested for every token,
+        so this works without `logits_all`. The continuations take sequences
+        `1 .. n_seq_max - 1`, so the context needs `n_seq_max` of at least 2; with fewer
+        sequences than `n_batch` a batch is decoded early whenever they run out. Sequence 0
+        is left holding the prompt.
+
+        Args:
+            prompt: The prompt text or tokens.
+            continuations: The continuation texts or tokens. Texts are tokenized on
+                their own, without BOS.
+
+        Raises:
+            ValueError: If the prompt is empty, a continuation does not fit the context or
+                the context has fewer than 2 sequences.
+
+        Returns:
+            Per token log probabilities, ranks and entropies of each continuation.
+        """
+        assert self._ctx.ctx is not None
+        assert self._batch.batch is not None
+        prompt_tokens = (
+            self.tokenize(prompt.encode("utf-8"))
+            if isinstance(prompt, str)
+            else list(prompt)
+        )
+        continuation_tokens = [
+            self.tokenize(c.encode("utf-8"), add_bos=False)
+            if isinstance(c, str)
+            else list(c)
+            for c in continuations
+        ]
+        n_prompt = len(prompt_tokens)
+        if n_prompt == 0:
+            raise ValueError("score: prompt must not be empty")
+        for tokens in continuation_tokens:
+            if n_prompt + len(tokens) > self._n_ctx:
+                raise ValueError(
+                    f"score: prompt and continuation of {n_prompt + len(tokens)} tokens exceed context window of {self._n_ctx}"
+                )
+        seq_ids = _LlamaSeqIdPool(self._ctx, self.n_batch)
+
+        results = [
+            LlamaContinuationScore(
+                tokens=np.array(tokens, dtype=np.intc),
+                logprobs=np.empty(len(tokens), dtype=np.single),
+                ranks=np.empty(len(tokens), dtype=np.int32),
+                entropy=np.empty(len(tokens), dtype=np.single),
+            )
+            for tokens in continuation_tokens
+        ]
+
+        # The prompt's last logits score the first token of every continuation
+        prefix = min(
+            Llama.longest_token_prefix(self._input_ids.tolist(), prompt_tokens),
+            n_prompt - 1,
+        )
+        self.n_tokens = prefix
+        self.eval(prompt_tokens[prefix:])
+        first = [i for i, tokens in enumerate(continuation_tokens) if len(tokens) > 0]
+        if len(first) > 0:
+            prompt_logits = self.logits_row(self.n_tokens - 1)[None, :]
+            targets = np.array([continuation_tokens[i][0] for i in first], dtype=np.intc)
+            logprobs, ranks, entropy = Llama._token_scores(
+                np.broadcast_to(prompt_logits, (len(first), self._n_vocab)), targets
+            )
+            for k, i in enumerate(first):
+                results[i].logprobs[0] = logprobs[k]
+                results[i].ranks[0] = ranks[k]
+                results[i].entropy[0] = entropy[k]
+
+        rows: List[Tuple[int, int]] = []
+
+        def flush():
+            n_rows = len(rows)
+            if n_rows > 0:
+                self._ctx.decode(self._batch)
+                logits = np.ctypeslib.as_array(
+                    self._ctx.get_logits(), shape=(n_rows, self._n_vocab)
+                )
+                targets = np.array(
+                    [continuation_tokens[i][j] for i, j in rows], dtype=np.intc
+                )
+                logprobs, ranks, entropy = Llama._token_scores(logits, targets)
+                for k, (i, j) in enumerate(rows):
+                    results[i].logprobs[j] = logprobs[k]
+                    results[i].ranks[j] = ranks[k]
+                    results[i].entropy[j] = entropy[k]
+            seq_ids.release()
+            rows.clear()
+            self._batch.reset()
+
+        self._batch.reset()
+        for i, tokens in enumerate(continuation_tokens):
+            # the last token only needs to be scored, not decoded
+            if len(tokens) < 2:
+                continue
+            if seq_ids.is_empty():
+                flush()
+            seq_id = seq_ids.take()
+            self._ctx.kv_cache_seq_cp(0, seq_id, -1, -1)
+            for j in range(len(tokens) - 1):
+                self._batch.add_token(tokens[j], n_prompt + j, [seq_id], True)
+                rows.append((i, j + 1))
+                # free the id with the flush that decodes its last token
+                if j == len(tokens) - 2:
+                    seq_ids.finish(seq_id)
+                if self._batch.n_tokens() == self.n_batch:
+                    flush()
+        flush()
+        return results
+
+    @staticmethod
+    def _token_scores(
+        logits: npt.NDArray[np.single], targets: npt.NDArray[np.intc]
+    ) -> Tuple[npt.NDArray[np.single], npt.NDArray[np.int32], npt.NDArray[np.single]]:
+        """Log probability, rank (0 is the most likely) and entropy of each row's target token."""
+        n_rows, n_vocab = logits.shape
+        logprobs = np.empty(n_rows, dtype=np.single)
+        ranks = np.empty(n_rows, dtype=np.int32)
+        entropy = np.empty(n_rows, dtype=np.single)
+        # bound the n_vocab sized temporaries to a few MB per pass
+        rows_per_pass = max(1, (1 << 20) // n_vocab)
+        for start in range(0, n_rows, rows_per_pass):
+            stop = min(n_rows, start + rows_per_pass)
+            block = logits[start:stop]
+            block_targets = targets[start:stop]
+            target_logits = block[np.arange(stop - start), block_targets]
+            log_p = Llama.logits_to_logprobs(block, axis=1)
+            p = np.exp(log_p)
+            with np.errstate(invalid="ignore"):
+                entropy[start:stop] = -np.nansum(p * log_p, axis=1, dtype=np.float64)
+            logprobs[start:stop] = log_p[np.arange(stop - start), block_targets]
+            ranks[start:stop] = (block > target_logits[:, None]).sum(axis=1)
+        return logprobs, ranks, entropy
+
+    def chat_formatter(self) -> Optional[llama_chat_format.ChatFormatter]:
+        """Return the prompt formatter of the chat format `create_chat_completion` uses.
+
+        None when a custom `chat_handler` is set or the format has no formatter.
+        """
+        if self.chat_handler is not None or self.chat_format is None:
+            return None
+        return self._chat_formatters.get(
+            self.chat_format
+        ) or llama_chat_format.get_chat_formatter(self.chat_format)
+
     def n_ctx(self) -> int:
         """Return the context window size."""
         return self._ctx.n_ctx()
 
+    def n_seq_max(self) -> int:
+        """Return the maximum number of sequences of the context."""
+        return self._ctx.n_seq_max()
+
     def n_embd(self) -> int:
         """Return the embedding size."""
         return self._model.n_embd()
@@ -2231,12 +2509,66 @@ class LlamaState:
         n_tokens: int,
         llama_state: bytes,
         llama_state_size: int,
+        logits_state: Optional[Dict[str, npt.NDArray]] = None,
     ):
         self.input_ids = input_ids
         self.scores = scores
         self.n_tokens = n_tokens
         self.llama_state = llama_state
         self.llama_state_size = llama_state_size
+        # the retained logits as saved by `LlamaLogitsStore.get_state`
+        self.logits_state = logits_state
+
+
+class LlamaSeqState:
+    def __init__(
+        self,
+        input_ids: npt.NDArray[np.intc],
+        n_tokens: int,
+        logits_state: Optional[Dict[str, npt.NDArray]],
+        llama_state: bytes,
+        llama_state_size: int,
+    ):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        # the retained logits of the last token, as saved by `LlamaLogitsStore.get_state`
+        self.logits_state = logits_state
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.llama_state_size
+            + self.input_ids.nbytes
+            + (
+                sum(a.nbytes for a in self.logits_state.values())
+                if self.logits_state is not None
+                else 0
+            )
+        )
+
+
+class LlamaContinuationScore:
+    def __init__(
+        self,
+        tokens: npt.NDArray[np.intc],
+        logprobs: npt.NDArray[np.single],
+        ranks: npt.NDArray[np.int32],
+        entropy: npt.NDArray[np.single],
+    ):
+        self.tokens = tokens
+        self.logprobs = logprobs
+        self.ranks = ranks
+        self.entropy = entropy
+
+    @property
+    def total_logprob(self) -> float:
+        return float(self.logprobs.sum(dtype=np.float64))
+
+    @property
+    def mean_logprob(self) -> float:
+        return self.total_logprob / len(self.tokens) if len(self.tokens) > 0 else 0.0
 
 
 LogitsProcessor = Callable[
@@ -942,8 +942,18 @@ def _grammar_for_response_format(
 ### Chat Formats ###
 
 
+_CHAT_FORMATTERS: Dict[str, ChatFormatter] = {}
+
+
+def get_chat_formatter(name: str) -> Optional[ChatFormatter]:
+    """Return the prompt formatter registered under `name`, None if there is none
+    (e.g. a handler that is not built from a formatter)."""
+    return _CHAT_FORMATTERS.get(name)
+
+
 def register_chat_format(name: str):
     def decorator(f: ChatFormatter):
+        _CHAT_FORMATTERS[name] = f
         chat_completion_handler = chat_formatter_to_chat_completion_handler(f)
         LlamaChatCompletionHandlerRegistry().register_chat_completion_handler(
             name, chat_completion_handler
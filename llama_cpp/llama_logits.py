@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+from typing import Dict, Literal, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+LogitsRetention = Literal["dense", "last", "top_k"]
+
+LOGITS_RETENTIONS = ("dense", "last", "top_k")
+
+
+class LlamaLogitsStore:
+    """Logits rows of the evaluated positions of sequence 0.
+
+    `dense` keeps every row in an `(n_ctx, n_vocab)` float32 matrix, the upstream
+    `Llama.scores`. `last` keeps only the most recently stored row, which is all that
+    plain generation samples from. `top_k` keeps the `top_k` largest logits of every
+    row (highest first) with their token ids and the logsumexp of the full row, so the
+    log probabilities of the kept tokens stay exact while the rest of the row is dropped.
+
+    At n_ctx=8192 and a 152k vocab `dense` is ~5 GB, `top_k` with k=64 is ~4 MB.
+    """
+
+    def __init__(
+        self,
+        n_ctx: int,
+        n_vocab: int,
+        retention: LogitsRetention = "dense",
+        top_k: int = 64,
+    ):
+        if retention not in LOGITS_RETENTIONS:
+            raise ValueError(
+                f"logits_retention must be one of {LOGITS_RETENTIONS}, got {retention!r}"
+            )
+        self.n_ctx = n_ctx
+        self.n_vocab = n_vocab
+        self.retention = retention
+        self.top_k = max(1, min(top_k, n_vocab))
+        self.dense: Optional[npt.NDArray[np.single]] = None
+        self.last: Optional[npt.NDArray[np.single]] = None
+        self.last_pos = -1
+        self.top_ids: Optional[npt.NDArray[np.intc]] = None
+        self.top_logits: Optional[npt.NDArray[np.single]] = None
+        self.logsumexp: Optional[npt.NDArray[np.single]] = None
+        if retention == "dense":
+            self.dense = np.ndarray((n_ctx, n_vocab), dtype=np.single)
+        elif retention == "last":
+            self.last = np.zeros((n_vocab,), dtype=np.single)
+        else:
+            self.top_ids = np.zeros((n_ctx, self.top_k), dtype=np.intc)
+            self.top_logits = np.full((n_ctx, self.top_k), -np.inf, dtype=np.single)
+            self.logsumexp = np.zeros((n_ctx,), dtype=np.single)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.dense, self.last, self.top_ids, self.top_logits, self.logsumexp)
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def has_row(self, pos: int) -> bool:
+        if self.retention == "last":
+            return pos == self.last_pos
+        return 0 <= pos < self.n_ctx
+
+    def store(self, pos: int, logits: npt.NDArray[np.single]):
+        """Store the logits rows of positions `pos .. pos + len(logits) - 1`."""
+        n = logits.shape[0]
+        if n == 0:
+            return
+        if self.retention == "dense":
+            assert self.dense is not None
+            self.dense[pos : pos + n, :] = logits
+        elif self.retention == "last":
+            assert self.last is not None
+            self.last[:] = logits[-1]
+            self.last_pos = pos + n - 1
+        else:
+            assert self.top_ids is not None and self.top_logits is not None
+            assert self.logsumexp is not None
+            k = self.top_k
+            top = np.argpartition(logits, -k, axis=1)[:, -k:]
+            top_logits = np.take_along_axis(logits, top, axis=1)
+            order = np.argsort(-top_logits, axis=1)
+            self.top_ids[pos : pos + n] = np.take_along_axis(top, order, axis=1)
+            self.top_logits[pos : pos + n] = np.take_along_axis(top_logits, order, axis=1)
+            self.logsumexp[pos : pos + n] = _logsumexp_rows(logits)
+
+    def _check_row(self, pos: int):
+        if not self.has_row(pos):
+            raise ValueError(
+                f"the logits of position {pos} were not retained (logits_retention={self.retention!r})"
+            )
+
+    def row(self, pos: int) -> npt.NDArray[np.single]:
+        """The full logits row of `pos`.
+
+        `dense` and `last` return a view of the stored row. `top_k` returns a new row
+        with the kept logits and -inf everywhere else, samplers that apply top-k with
+        k <= `top_k` first see the same candidates as with the full row.
+        """
+        self._check_row(pos)
+        if self.retention == "dense":
+            assert self.dense is not None
+            return self.dense[pos, :]
+        if self.retention == "last":
+            assert self.last is not None
+            return self.last
+        assert self.top_ids is not None and self.top_logits is not None
+        row = np.full((self.n_vocab,), -np.inf, dtype=np.single)
+        row[self.top_ids[pos]] = self.top_logits[pos]
+        return row
+
+    def rows(self, start: int, stop: int) -> npt.NDArray[np.single]:
+        """Full logits rows of positions `start .. stop - 1`, see `row`."""
+        if self.retention == "dense":
+            assert self.dense is not None
+            return self.dense[start:stop, :]
+        if self.retention == "last":
+            if stop <= start:
+                return np.empty((0, self.n_vocab), dtype=np.single)
+            if stop - start > 1:
+                raise ValueError(
+                    "only the last logits row is retained (logits_retention='last')"
+                )
+            return self.row(start)[None, :]
+        assert self.top_ids is not None and self.top_logits is not None
+        rows = np.full((max(0, stop - start), self.n_vocab), -np.inf, dtype=np.single)
+        np.put_along_axis(
+            rows, self.top_ids[start:stop], self.top_logits[start:stop], axis=1
+        )
+        return rows
+
+    def logprobs(self, start: int, stop: int) -> npt.NDArray[np.single]:
+        """Log softmax of the rows of positions `start .. stop - 1`.
+
+        With `top_k` the kept tokens are normalized by the logsumexp of the full row,
+        so their log probabilities are exact, every other token is -inf.
+        """
+        rows = self.rows(start, stop)
+        if self.retention == "top_k":
+            assert self.logsumexp is not None
+            return rows - self.logsumexp[start:stop, None]
+        return rows - _logsumexp_rows(rows)[:, None]
+
+    def get_state(self, start: int, stop: int) -> Dict[str, npt.NDArray]:
+        """Copies of the retained data of positions `start .. stop - 1`, with `last`
+        the row of `stop - 1` if that is the retained one."""
+        if self.retention == "dense":
+            assert self.dense is not None
+            return {"logits": self.dense[start:stop, :].copy()}
+        if self.retention == "last":
+            if stop <= start or not self.has_row(stop - 1):
+                return {}
+            return {"last_logits": self.row(stop - 1).copy()}
+        assert self.top_ids is not None and self.top_logits is not None
+        assert self.logsumexp is not None
+        return {
+            "top_ids": self.top_ids[start:stop].copy(),
+            "top_logits": self.top_logits[start:stop].copy(),
+            "logsumexp": self.logsumexp[start:stop].copy(),
+        }
+
+    def set_state(self, start: int, stop: int, state: Dict[str, npt.NDArray]):
+        """Restore data of positions `start .. stop - 1` saved with `get_state`, the
+        state may come from a store with another retention."""
+        if "logits" in state:
+            self.store(start, state["logits"])
+        elif "last_logits" in state:
+            self.store(stop - 1, state["last_logits"][None, :])
+        elif "top_ids" in state:
+            top_ids = state["top_ids"]
+            top_logits = state["top_logits"]
+            n = top_ids.shape[0]
+            if self.retention != "top_k":
+                rows = np.full((n, self.n_vocab), -np.inf, dtype=np.single)
+                np.put_along_axis(rows, top_ids, top_logits, axis=1)
+                self.store(start, rows)
+                return
+            assert self.top_ids is not None and self.top_logits is not None
+            assert self.logsumexp is not None
+            k = min(self.top_k, top_ids.shape[1])
+            self.top_ids[start : start + n, :k] = top_ids[:, :k]
+            self.top_logits[start : start + n, :k] = top_logits[:, :k]
+            self.top_logits[start : start + n, k:] = -np.inf
+            self.logsumexp[start : start + n] = state["logsumexp"]
+
+
+def _logsumexp_rows(rows: npt.NDArray[np.single]) -> npt.NDArray[np.single]:
+    maxs = rows.max(axis=1, keepdims=True)
+    maxs[~np.isfinite(maxs)] = 0
+    with np.errstate(divide="ignore"):
+        summed = np.log(np.exp(rows - maxs).sum(axis=1, dtype=np.float64))
+    return (summed + maxs[:, 0]).astype(np.single)
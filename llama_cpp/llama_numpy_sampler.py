@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import ctypes
+
+from typing import TYPE_CHECKING, List
+
+import numpy as np
+import numpy.typing as npt
+
+if TYPE_CHECKING:
+    # only NumPy at runtime, so this loads without the shared library
+    import llama_cpp.llama_cpp as llama_cpp
+    from ._internals import _LlamaTokenDataArray
+
+# llama_cpp.LLAMA_DEFAULT_SEED
+LLAMA_DEFAULT_SEED = 0xFFFFFFFF
+
+
+class LlamaNumpySampler:
+    """The llama.cpp sampler chain in NumPy, a drop-in for the `sample_*` methods of
+    `_LlamaContext` that never calls into the shared library.
+
+    Every stage works in place on the candidates of a `_LlamaTokenDataArray` with
+    preallocated scratch buffers and leaves them as the native stage does (order, size,
+    `sorted` and, after `sample_token`, the probabilities). `sample_token` draws from an
+    mt19937 seeded like the context's and picks like libstdc++'s
+    `std::discrete_distribution`, so with the same seed it samples the same tokens as a
+    llama.cpp built against libstdc++ (gcc, MinGW). MSVC's `discrete_distribution`, and
+    so the bundled Windows `llama.dll`, draws differently: there the stages keep the same
+    candidates but the sampled tokens differ. With `capture_stages` the token ids that
+    survive each stage are appended to `stages` as `(stage, ids)`."""
+
+    def __init__(
+        self,
+        *,
+        n_vocab: int,
+        seed: int = LLAMA_DEFAULT_SEED,
+        capture_stages: bool = False,
+    ):
+        self.n_vocab = n_vocab
+        self.capture_stages = capture_stages
+        self.stages: List[tuple[str, npt.NDArray[np.intc]]] = []
+        # candidates as rows of their 3 x 4 byte fields, moved with one take
+        self._rows = np.zeros((n_vocab, 3), dtype=np.intc)
+        self._a = np.zeros((n_vocab,), dtype=np.single)
+        self._b = np.zeros((n_vocab,), dtype=np.single)
+        self._weights = np.zeros((n_vocab,), dtype=np.double)
+        self._cdf = np.zeros((n_vocab,), dtype=np.double)
+        self._counts = np.zeros((n_vocab,), dtype=np.intc)
+        self.set_rng_seed(seed)
+
+    def set_rng_seed(self, seed: int):
+        # like llama_set_rng_seed, the default seed is a random one
+        seed &= 0xFFFFFFFF
+        self.rng = np.random.RandomState(
+            None if seed == LLAMA_DEFAULT_SEED else seed
+        )
+
+    def clear_stages(self):
+        self.stages.clear()
+
+    def _capture(self, stage: str, candidates: "_LlamaTokenDataArray"):
+        if self.capture_stages:
+            size = candidates.candidates.size
+            self.stages.append((stage, candidates.candidates_data.id[:size].copy()))
+
+    def _reorder(self, candidates: "_LlamaTokenDataArray", order: npt.NDArray[np.intp]):
+        n = order.shape[0]
+        rows = candidates.candidates_data.view(np.ndarray).view(np.intc).reshape(-1, 3)
+        np.take(rows[: candidates.candidates.size], order, axis=0, out=self._rows[:n])
+        rows[:n] = self._rows[:n]
+        candidates.candidates.size = n
+
+    # like std::sort the order of equal logits is unspecified, NumPy's default sort is
+    # several times faster than a stable one on a full vocabulary
+    def _sort(self, candidates: "_LlamaTokenDataArray"):
+        if not candidates.candidates.sorted:
+            logits = candidates.candidates_data.logit[: candidates.candidates.size]
+            self._reorder(candidates, np.argsort(logits)[::-1])
+            candidates.candidates.sorted = True
+
+    def sample_repetition_penalties(
+        self,
+        candidates: "_LlamaTokenDataArray",
+        last_tokens_data: "llama_cpp.Array[llama_cpp.llama_token]",
+        penalty_last_n: int,
+        penalty_repeat: float,
+        penalty_freq: float,
+        penalty_present: float,
+    ):
+        if penalty_last_n == 0 or (
+            penalty_repeat == 1.0 and penalty_freq == 0.0 and penalty_present == 0.0
+        ):
+            return
+        if isinstance(last_tokens_data, ctypes._Pointer):
+            window = np.ctypeslib.as_array(last_tokens_data, shape=(penalty_last_n,))
+        else:
+            window = np.asarray(last_tokens_data)[:penalty_last_n]
+        size = candidates.candidates.size
+        data = candidates.candidates_data
+        np.add.at(self._counts, window, 1)
+        counts = self._counts[data.id[:size]]
+        hit = np.flatnonzero(counts)
+        logits = data.logit[hit]
+        logits = np.where(
+            logits <= 0,
+            logits * np.single(penalty_repeat),
+            logits / np.single(penalty_repeat),
+        )
+        logits -= counts[hit].astype(np.single) * np.single(penalty_freq) + np.single(
+            penalty_present
+        )
+        data.logit[hit] = logits
+        self._counts[window] = 0
+        candidates.candidates.sorted = False
+
+    def sample_softmax(self, candidates: "_LlamaTokenDataArray"):
+        self._sort(candidates)
+        size = candidates.candidates.size
+        data = candidates.candidates_data
+        # on contiguous scratch, the record fields are strided
+        p = self._a[:size]
+        np.subtract(data.logit[:size], data.logit[0], out=p)
+        np.exp(p, out=p)
+        # sequential float sums like the native loops, not pairwise
+        p /= np.cumsum(p, out=self._b[:size])[-1]
+        data.p[:size] = p
+
+    def _top_indices(self, logits: npt.NDArray[np.single], k: int) -> npt.NDArray[np.intp]:
+        size = logits.shape[0]
+        values = self._a[:size]
+        np.copyto(values, logits)
+        if 64 * k <= size:
+            # the maxima of k blocks are k distinct values, so the top k all reach the
+            # smallest of them and only the few values that do are partitioned
+            blocks = size // k
+            bound = values[: blocks * k].reshape(k, blocks).max(axis=1).min()
+            near = np.flatnonzero(values >= bound)
+            if near.size >= k:
+                return near[np.argpartition(values[near], near.size - k)[near.size - k :]]
+        return np.argpartition(values, size - k)[size - k :]
+
+    def sample_top_k(self, candidates: "_LlamaTokenDataArray", k: int, min_keep: int):
+        size = candidates.candidates.size
+        if k <= 0:
+            k = size
+        k = min(max(k, min_keep), size)
+        if not candidates.candidates.sorted:
+            logits = candidates.candidates_data.logit[:size]
+            if k < size:
+                top = self._top_indices(logits, k)
+                order = top[np.argsort(logits[top])[::-1]]
+            else:
+                order = np.argsort(logits)[::-1]
+            self._reorder(candidates, order)
+            candidates.candidates.sorted = True
+        candidates.candidates.size = k
+        self._capture("top_k", candidates)
+
+    def sample_tail_free(
+        self, candidates: "_LlamaTokenDataArray", z: float, min_keep: int
+    ):
+        size = candidates.candidates.size
+        if z < 1.0 and size > 2:
+            self.sample_softmax(candidates)
+            p = candidates.candidates_data.p[:size]
+            first = np.subtract(p[:-1], p[1:], out=self._a[: size - 1])
+            second = np.subtract(first[:-1], first[1:], out=self._b[: size - 2])
+            np.abs(second, out=second)
+            total = np.cumsum(second, out=self._a[: size - 2])[-1]
+            if total > 1e-6:
+                second /= total
+            else:
+                second[:] = np.single(1.0) / np.single(size - 2)
+            cum = np.cumsum(second, out=self._a[: size - 2])
+            over = cum[min_keep:] > np.single(z)
+            if over.any():
+                candidates.candidates.size = min_keep + int(np.argmax(over))
+        self._capture("tail_free", candidates)
+
+    def sample_typical(
+        self, candidates: "_LlamaTokenDataArray", p: float, min_keep: int
+    ):
+        if p < 1.0:
+            self.sample_softmax(candidates)
+            size = candidates.candidates.size
+            probs = candidates.candidates_data.p[:size]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                log_probs = np.log(probs, out=self._a[:size])
+                terms = np.multiply(probs, log_probs, out=self._b[:size])
+                terms[probs == 0] = 0
+                entropy = -np.cumsum(terms, out=self._b[:size])[-1]
+                shifted = np.abs(np.add(log_probs, entropy, out=self._a[:size]))
+            order = np.argsort(shifted)
+            cum = np.cumsum(probs[order], out=self._b[:size])
+            start = max(min_keep - 1, 0)
+            over = cum[start:] > np.single(p)
+            if over.any():
+                order = order[: start + int(np.argmax(over)) + 1]
+            self._reorder(candidates, order)
+            candidates.candidates.sorted = False
+        self._capture("typical", candidates)
+
+    def sample_top_p(self, candidates: "_LlamaTokenDataArray", p: float, min_keep: int):
+        if p < 1.0:
+            self.sample_softmax(candidates)
+            size = candidates.candidates.size
+            cum = np.cumsum(candidates.candidates_data.p[:size], out=self._a[:size])
+            start = max(min_keep - 1, 0)
+            reached = cum[start:] >= np.single(p)
+            if reached.any():
+                candidates.candidates.size = start + int(np.argmax(reached)) + 1
+        self._capture("top_p", candidates)
+
+    def sample_min_p(self, candidates: "_LlamaTokenDataArray", p: float, min_keep: int):
+        if p > 0.0 and candidates.candidates.size > 0:
+            self.sample_softmax(candidates)
+            size = candidates.candidates.size
+            probs = candidates.candidates_data.p[:size]
+            # the first token always matches
+            start = max(min_keep, 1)
+            below = probs[start:] < np.single(p) * probs[0]
+            if below.any():
+                candidates.candidates.size = start + int(np.argmax(below))
+        self._capture("min_p", candidates)
+
+    def sample_temp(self, candidates: "_LlamaTokenDataArray", temp: float):
+        logits = candidates.candidates_data.logit[: candidates.candidates.size]
+        np.divide(logits, np.single(temp), out=logits)
+
+    def sample_token_greedy(self, candidates: "_LlamaTokenDataArray") -> int:
+        logits = candidates.candidates_data.logit[: candidates.candidates.size]
+        return int(candidates.candidates_data.id[int(np.argmax(logits))])
+
+    def _uniform(self) -> float:
+        # std::generate_canonical<double, 53> over two 32 bit mt19937 draws
+        low, high = self.rng.randint(0, 1 << 32, size=2, dtype=np.uint32).tolist()
+        u = (float(low) + float(high) * 4294967296.0) / 18446744073709551616.0
+        return u if u < 1.0 else float(np.nextafter(1.0, 0.0))
+
+    def _sample_index(self, candidates: "_LlamaTokenDataArray") -> int:
+        self.sample_softmax(candidates)
+        size = candidates.candidates.size
+        # a discrete_distribution of fewer than 2 weights does not draw
+        if size < 2:
+            return 0
+        weights = self._weights[:size]
+        np.copyto(weights, candidates.candidates_data.p[:size])
+        cdf = np.cumsum(weights, out=self._cdf[:size])
+        weights /= cdf[-1]
+        np.cumsum(weights, out=cdf)
+        cdf[-1] = 1.0
+        return int(np.searchsorted(cdf, self._uniform(), side="left"))
+
+    def sample_token(self, candidates: "_LlamaTokenDataArray") -> int:
+        return int(candidates.candidates_data.id[self._sample_index(candidates)])
+
+    def _update_mu(
+        self,
+        candidates: "_LlamaTokenDataArray",
+        index: int,
+        tau: float,
+        eta: float,
+        mu: llama_cpp.CtypesPointer[ctypes.c_float],
+    ):
+        surprise = -np.log2(candidates.candidates_data.p[index])
+        mu.contents.value = np.single(mu.contents.value) - np.single(eta) * (
+            surprise - np.single(tau)
+        )
+
+    def sample_token_mirostat(
+        self,
+        candidates: "_LlamaTokenDataArray",
+        tau: float,
+        eta: float,
+        m: int,
+        mu: llama_cpp.CtypesPointer[ctypes.c_float],
+    ) -> int:
+        self.sample_softmax(candidates)
+        size = candidates.candidates.size
+        p = candidates.candidates_data.p[:size]
+        n = min(m - 1, size - 1)
+        i = np.arange(1, n + 1, dtype=np.single)
+        with np.errstate(all="ignore"):
+            t = np.log((i + 1) / i)
+            b = np.log(p[:n] / p[1 : n + 1])
+            s_hat = np.cumsum(t * b)[-1] / np.cumsum(t * t)[-1] if n > 0 else np.nan
+            epsilon_hat = s_hat - np.single(1)
+            k = np.power(
+                epsilon_hat
+                * np.power(np.single(2), np.single(mu.contents.value))
+                / (np.single(1) - np.power(np.single(self.n_vocab), -epsilon_hat)),
+                np.single(1) / s_hat,
+            )
+        self.sample_top_k(candidates, int(k) if np.isfinite(k) else size, 1)
+        index = self._sample_index(candidates)
+        self._update_mu(candidates, index, tau, eta, mu)
+        return int(candidates.candidates_data.id[index])
+
+    def sample_token_mirostat_v2(
+        self,
+        candidates: "_LlamaTokenDataArray",
+        tau: float,
+        eta: float,
+        mu: llama_cpp.CtypesPointer[ctypes.c_float],
+    ) -> int:
+        self.sample_softmax(candidates)
+        size = candidates.candidates.size
+        with np.errstate(divide="ignore"):
+            surprise = -np.log2(candidates.candidates_data.p[:size])
+        over = surprise > np.single(mu.contents.value)
+        candidates.candidates.size = max(int(np.argmax(over)) if over.any() else size, 1)
+        self._capture("mirostat", candidates)
+        index = self._sample_index(candidates)
+        self._update_mu(candidates, index, tau, eta, mu)
+        return int(candidates.candidates_data.id[index])
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import abc
+import codecs
 from typing import (
     List,
     Optional,
@@ -66,6 +67,107 @@ class LlamaTokenizer(BaseLlamaTokenizer):
         return cls(llama_cpp.Llama(model_path=path, vocab_only=True))
 
 
+class LlamaStreamingDetokenizer:
+    """Detokenizes a completion one token at a time into a growing byte buffer.
+
+    Each token's bytes are appended once, and the end of the last complete UTF-8
+    character and the decoded length are updated from the new bytes only, so the work
+    per token is proportional to its piece, not to the length of the completion.
+    `text` is what `tokenizer.detokenize(tokens, prev_tokens=prev_tokens)` returns for
+    the tokens appended so far, less a character still split at the end for tokenizers
+    other than `LlamaTokenizer`. A `LlamaTokenizer` reads pieces straight from the
+    vocab. Other tokenizers decode a short window of the latest tokens (the
+    prefix_offset/read_offset scheme of incremental detokenizers): the new text is what
+    the window decodes to beyond its already emitted prefix, held back while it ends
+    in U+FFFD, the mark of a character split over tokens."""
+
+    # tokens of prev_tokens decoded as context before the first appended token
+    CONTEXT_TOKENS = 5
+
+    def __init__(
+        self, tokenizer: BaseLlamaTokenizer, prev_tokens: Optional[List[int]] = None
+    ):
+        self.tokenizer = tokenizer
+        self.tokens: List[int] = []
+        self.text = bytearray()
+        # per token, where its bytes end and the length of the text up to there
+        # decoded with errors="ignore"
+        self.ends: List[int] = []
+        self.char_ends: List[int] = []
+        # text[:complete] ends on a whole UTF-8 character
+        self.complete = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._chars = 0
+        self._context = list(prev_tokens or [])
+        self._read_offset = len(self._context)
+        self._prefix_offset = max(self._read_offset - self.CONTEXT_TOKENS, 0)
+        self._pieces: Optional[List[bytes]] = None
+        self._bos = -1
+        if isinstance(tokenizer, LlamaTokenizer):
+            self._pieces = tokenizer._model.vocab().pieces_for(False)
+            self._bos = tokenizer._model.token_bos()
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def append(self, token: int) -> bytes:
+        """Append a token and return its bytes."""
+        if self._pieces is None:
+            piece = self._window_piece(token)
+        else:
+            piece = self._pieces[token]
+            # like _LlamaModel.detokenize, a leading bos drops the space after it
+            if not self.tokens and token == self._bos and piece[:1] == b" ":
+                piece = piece[1:]
+        self.tokens.append(token)
+        self.text += piece
+        self.ends.append(len(self.text))
+        self._chars += len(self._decoder.decode(piece))
+        self.char_ends.append(self._chars)
+        self.complete = _utf8_complete_end(self.text)
+        return piece
+
+    def _window_piece(self, token: int) -> bytes:
+        context = self._context
+        context.append(token)
+        prefix = self.tokenizer.detokenize(
+            context[self._prefix_offset : self._read_offset]
+        )
+        text = self.tokenizer.detokenize(context[self._prefix_offset :])
+        if len(text) <= len(prefix) or text.endswith("\ufffd".encode("utf-8")):
+            return b""
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(context)
+        return text[len(prefix) :]
+
+    @property
+    def is_complete(self) -> bool:
+        return self.complete == len(self.text)
+
+    def offset(self, n_tokens: int) -> int:
+        """Length in bytes of the text of the first `n_tokens` tokens."""
+        return self.ends[n_tokens - 1] if n_tokens > 0 else 0
+
+    def char_offset(self, n_tokens: int) -> int:
+        """Length of the text of the first `n_tokens` tokens decoded with errors="ignore"."""
+        return self.char_ends[n_tokens - 1] if n_tokens > 0 else 0
+
+    def piece(self, i: int) -> bytes:
+        return bytes(self.text[self.offset(i) : self.ends[i]])
+
+
+def _utf8_complete_end(text: bytearray) -> int:
+    """End of the last whole UTF-8 character, only the last 4 bytes are looked at."""
+    end = len(text)
+    for back in range(1, min(4, end) + 1):
+        byte = text[end - back]
+        if byte & 0xC0 == 0x80:
+            continue
+        length = 1 if byte < 0x80 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+        return end - back if length > back else end
+    return end
+
+
 class LlamaHFTokenizer(BaseLlamaTokenizer):
     def __init__(self, hf_tokenizer: Any):
         self.hf_tokenizer = hf_tokenizer
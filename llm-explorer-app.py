@@ -1,14 +1,19 @@
 import sys
 import llm_generator
+import llm_threads
+import llm_best_of_n
+import llm_session
 
 from typing import List, Tuple
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                                QTextEdit, QLineEdit, QPushButton, QFileDialog,  
-                               QLabel, QSplitter)
+                               QLabel, QSplitter, QComboBox)
 from PySide6.QtGui import QColor, QPen, QBrush, QTextCursor
 from PySide6.QtCore import QCoreApplication, Qt, QRectF, Slot
 
-from CustomNodeWidget import Node, CustomLayout, ScrollArea
+from node_canvas import NodeCanvas
+from transcript_view import TranscriptView, HEATMAP_NAMES
+from exploration_tree import ExplorationTree
 from util.properties_widget import PropertiesWidget
 GO = "go"
 STOP = "stop"
@@ -21,7 +26,7 @@ TODO:
     [x] should make the nodes much more compact
 [ ] Create chat entries, so that some messages can be ignored or replaced with alterate responses
     [ ] add a button to select a row as the final response
-[ ] Create a metric from logits and or softmax to quantify hallicination/certainty
+[x] Create a metric from logits and or softmax to quantify hallicination/certainty
 [ ] Try generating N responses, then ask LLM to pick the best
     [ ] can the LLM identify hallicinated reponses? 
     [ ] should "roll again" be an option?
@@ -35,12 +40,31 @@ class LLMExplorer(QMainWindow):
         super().__init__()
 
         self.sample_settings:llm_generator.SampleSettings = llm_generator.SampleSettings()
-        self.prev_prompt = ""
-        self.prev_node:Node = None
+        # everything explored for the current prompt, the node canvas paints it
+        self.tree = ExplorationTree()
+        self.prev_node = ExplorationTree.ROOT # last node of the response being generated
 
-        self.response_generator = llm_generator.ResponseGeneratorThread()
-        self.response_generator.new_data_signal.connect(self.update_data)
+        self.response_generator = llm_threads.ResponseGeneratorThread()
+        self.response_generator.new_samples_signal.connect(self.update_data)
         self.response_generator.end_of_response.connect(self.end_of_response)
+        self.response_generator.finished.connect(self.start_branches)
+
+        # alternatives are grown as branches, several selected alternatives are generated together in one batch
+        self.branch_generator = llm_threads.ParallelResponseGeneratorThread(self.response_generator.state_cache)
+        self.branch_generator.new_samples_signal.connect(self.update_branch_data)
+        self.branch_generator.end_of_response.connect(self.end_of_branches)
+        self.branch_generator.finished.connect(self.start_branches)
+        self.pending_branches: List[Tuple[str, int]] = [] # (prompt, alternative node) waiting to be generated
+        self.active_branches: List[int] = [] # last node of each branch being generated
+
+        # N responses to one prompt, one row each, ranked by the selected selector
+        self.best_of_n_generator = llm_threads.BestOfNThread(self.response_generator.state_cache)
+        self.best_of_n_generator.new_samples_signal.connect(self.update_best_of_n_data)
+        self.best_of_n_generator.end_of_response.connect(self.end_of_best_of_n)
+        self.best_of_n_generator.finished.connect(self.start_branches)
+        self.best_of_n_nodes: List[int] = [] # last node of each candidate
+        self.best_of_n_lanes: List[int] = []
+        self.response_lane = 0
 
         self.setWindowTitle("LLM Explorer")
         self.setGeometry(100, 100, 1200, 800)
@@ -58,23 +82,31 @@ class LLMExplorer(QMainWindow):
         chat_layout = QVBoxLayout(chat_widget)
         chat_label = QLabel("Chat Session")
         chat_label.setStyleSheet("font-weight: bold; font-size: 14px;")
-        self.chat_history = QTextEdit()
-        self.chat_history.setReadOnly(True)
-        chat_layout.addWidget(chat_label)
+        # response tokens are colored by the selected metric
+        self.chat_history = TranscriptView()
+        self.heatmap_combo = QComboBox()
+        self.heatmap_combo.addItems(HEATMAP_NAMES)
+        self.heatmap_combo.setCurrentText(self.chat_history.heatmap_metric)
+        self.heatmap_combo.currentTextChanged.connect(self.chat_history.set_heatmap_metric)
+        chat_header_layout = QHBoxLayout()
+        chat_header_layout.addWidget(chat_label)
+        chat_header_layout.addStretch()
+        chat_header_layout.addWidget(QLabel("heatmap"))
+        chat_header_layout.addWidget(self.heatmap_combo)
+        chat_layout.addLayout(chat_header_layout)
         chat_layout.addWidget(self.chat_history)
         splitter.addWidget(chat_widget)
 
         # Current Response Node Panel
-        self.node_scroll_area = ScrollArea()
-        self.current_node_row = 0
-        self.current_node_column = 0
+        self.node_canvas = NodeCanvas()
+        self.node_canvas.alternative_selected.connect(self.on_alternative_selected)
 
         node_view_widget = QWidget()
         node_view_layout = QVBoxLayout(node_view_widget)
         node_view_label = QLabel("Response Nodes")
         node_view_label.setStyleSheet("font-weight: bold; font-size: 14px;")
         node_view_layout.addWidget(node_view_label)
-        node_view_layout.addWidget(self.node_scroll_area)
+        node_view_layout.addWidget(self.node_canvas)
         splitter.addWidget(node_view_widget)
 
         # Model Select
@@ -94,11 +126,11 @@ class LLMExplorer(QMainWindow):
         settings_layout = QVBoxLayout(settings_widget)
         settings_label = QLabel("Sample settings")
         settings_label.setStyleSheet("font-weight: bold; font-size: 14px;")
-        properties_widget = PropertiesWidget(orientation=Qt.Horizontal)
-        properties_widget.set_object(self.sample_settings)
+        self.properties_widget = PropertiesWidget(orientation=Qt.Horizontal)
+        self.properties_widget.set_object(self.sample_settings)
         settings_layout = QHBoxLayout()
         settings_layout.addWidget(settings_label)
-        settings_layout.addWidget(properties_widget)
+        settings_layout.addWidget(self.properties_widget)
 
         # Prompt 
         prompt_widget = QWidget()
@@ -111,11 +143,26 @@ class LLMExplorer(QMainWindow):
         self.go_button.clicked.connect(self.on_go_pressed)
         self.clear_button = QPushButton("clear")
         self.clear_button.clicked.connect(self.on_clear_pressed)        
+        self.best_of_n_button = QPushButton("best of N")
+        self.best_of_n_button.clicked.connect(self.on_best_of_n_pressed)
+        self.best_of_n_input = QLineEdit("4")
+        self.best_of_n_input.setFixedWidth(30)
+        self.selector_combo = QComboBox()
+        self.selector_combo.addItems(llm_best_of_n.SELECTOR_NAMES)
+        self.save_button = QPushButton("save")
+        self.save_button.clicked.connect(self.on_save_pressed)
+        self.open_button = QPushButton("open")
+        self.open_button.clicked.connect(self.on_open_pressed)
         prompt_input_layout = QHBoxLayout()
         prompt_input_layout.addWidget(prompt_label)
         prompt_input_layout.addWidget(self.prompt_input)
         prompt_input_layout.addWidget(self.go_button)
+        prompt_input_layout.addWidget(self.best_of_n_button)
+        prompt_input_layout.addWidget(self.best_of_n_input)
+        prompt_input_layout.addWidget(self.selector_combo)
         prompt_input_layout.addWidget(self.clear_button)
+        prompt_input_layout.addWidget(self.save_button)
+        prompt_input_layout.addWidget(self.open_button)
 
         # 
         prompt_layout.addLayout(model_select_layout)
@@ -148,59 +195,110 @@ class LLMExplorer(QMainWindow):
     @Slot()
     def end_of_response(self):
         self.go_button.setText(GO)
-    
-
-    @Slot(llm_generator.SampleData, str)
-    def update_data(self, sample_data: llm_generator.SampleData, decoded_token: str):
-        self.chat_history.insertPlainText(decoded_token)
-
-        node = Node(decoded_token, sample_data.get_logit(), sample_data.get_p(), sample_data, self.current_node_row, self.current_node_column, self.response_generator.llm)
-        if self.prev_node != None:
-            node.response_text = self.prev_node.response_text + self.prev_node.decoded_token
-        self.node_scroll_area.add_node(node)
-        self.prev_node = node
-
-        # add callback for combo selection
-        node.alternatives_combo.currentIndexChanged.connect( lambda index, n=node: self.on_alternative_selected(n, index) )
-
-        self.current_node_column += 1
+        self.statusBar().showMessage(str(self.response_generator.latency))
 
-        #force an update
-        QCoreApplication.processEvents()
+    @Slot()
+    def end_of_branches(self):
+        message = f"{len(self.active_branches)} branches: {self.branch_generator.latency}"
+        if self.branch_generator.error:
+            message += f" | {self.branch_generator.error}"
+        self.statusBar().showMessage(message)
+    
 
-    def on_alternative_selected(self, node: Node, index: int):
+    @Slot()
+    def end_of_best_of_n(self):
+        self.go_button.setText(GO)
+        ranked = self.best_of_n_generator.ranked
+        if len(ranked) > 0:
+            # the best candidate becomes the response
+            self.chat_history.append_tokens(self.tree, self.tree.path(self.best_of_n_nodes[ranked[0].index]))
+            scores = ", ".join(f"{c.index + 1}: {c.score:.3f}" for c in ranked)
+            self.chat_history.append(f"<font color='yellow'>System: best of {len(ranked)} by {self.best_of_n_generator.selector_name}, {scores}</font>\n")
+        message = str(self.best_of_n_generator.generator.latency) if self.best_of_n_generator.generator else ""
+        if self.best_of_n_generator.error:
+            message += f" | {self.best_of_n_generator.error}"
+        self.statusBar().showMessage(message)
+
+    # a new prompt starts a new tree
+    def reset_tree(self, prompt: str):
+        self.stop_branches()
+        self.tree = ExplorationTree(prompt)
+        self.node_canvas.set_tree(self.tree, self.response_generator.llm)
+        self.prev_node = ExplorationTree.ROOT
+
+    # the update slots get a batch of (stream index, SampleData) per ui frame, all nodes of a batch
+    # are laid out and repainted together
+    @Slot(list)
+    def update_best_of_n_data(self, samples: list):
+        nodes = []
+        for candidate_index, sample_data in samples:
+            node = self.tree.add_sample(self.best_of_n_nodes[candidate_index], sample_data, self.best_of_n_lanes[candidate_index])
+            self.best_of_n_nodes[candidate_index] = node
+            nodes.append(node)
+        self.node_canvas.add_nodes(nodes)
+
+    @Slot(list)
+    def update_data(self, samples: list):
+        nodes = []
+        for _, sample_data in samples:
+            self.prev_node = self.tree.add_sample(self.prev_node, sample_data, self.response_lane)
+            nodes.append(self.prev_node)
+        self.chat_history.append_tokens(self.tree, nodes)
+        self.node_canvas.add_nodes(nodes)
+
+    @Slot(list)
+    def update_branch_data(self, samples: list):
+        nodes = []
+        for branch_index, sample_data in samples:
+            prev_node = self.active_branches[branch_index]
+            node = self.tree.add_sample(prev_node, sample_data, self.tree.lane(prev_node))
+            self.active_branches[branch_index] = node
+            nodes.append(node)
+        self.node_canvas.add_nodes(nodes)
+
+    # start every queued branch in one parallel generation, once the model is free
+    @Slot()
+    def start_branches(self):
+        if (len(self.pending_branches) == 0 or self.response_generator.isRunning() or self.branch_generator.isRunning()
+                or self.best_of_n_generator.isRunning()):
+            return
+        self.branch_generator.llm = self.response_generator.llm
+        self.branch_generator.settings = self.sample_settings
+        self.branch_generator.prompts = [prompt for prompt, _ in self.pending_branches]
+        self.active_branches = [alt_node for _, alt_node in self.pending_branches]
+        self.pending_branches = []
+        self.branch_generator.start()
+
+    def stop_branches(self):
+        self.pending_branches = []
+        self.branch_generator.stop()
+        self.branch_generator.wait()
+
+    @Slot(int, int)
+    def on_alternative_selected(self, node: int, index: int):
         #create a new node on the row below the current node
-        #insert a new row below the top row, current_node_row is then the new row
+        #insert a new lane (row) below the node's lane for the branch
         #generate a new prompt, using the previous prompt, plus the response up to the token associated with this node, then include this selected alternative
         #request a new response        
+        if not self.response_generator.llm:
+            # a session opened without a model shows the alternatives, but cannot continue them
+            self.chat_history.append("<font color='yellow'>System: Please load a model first.</font>\n")
+            return
         if self.go_button.text() == GO: #only if there is no activate response generating
-            decoded_token = node.sample_data.get_canidate_decodedtoken(index, self.response_generator.llm)
-            p = node.sample_data.get_canidate_p(index)
-            logit = node.sample_data.get_canidate_logit(index)
-
-            self.node_scroll_area.custom_layout.insert_row_after(node.row)
-            alt_node = Node(decoded_token, logit, p, node.sample_data, node.row+1, node.column, self.response_generator.llm)
-            alt_node.response_text = node.response_text
-            self.node_scroll_area.add_node(alt_node)
-            self.prev_node = alt_node
+            llm = self.response_generator.llm
+            token = int(self.tree.sample(node).candidate_ids[index])
+            if self.tree.find_child(self.tree.parent(node), token) >= 0:
+                return # already explored
 
-            # add callback for combo selection
-            alt_node.alternatives_combo.currentIndexChanged.connect( lambda index, n=alt_node: self.on_alternative_selected(n, index) )        
+            # the new branch gets its own lane (row) right below the node's
+            lane = self.tree.new_lane(after_lane=self.tree.lane(node))
+            alt_node = self.tree.add_alternative(node, index, llm.detokenize([token]), lane)
+            self.node_canvas.add_nodes([alt_node])
 
-            #
-            self.current_node_row = node.row + 1
-            self.current_node_column = node.column + 1
-
-            # update all the nodes so the "row" is accurate
-            for i_row, row in enumerate(self.node_scroll_area.custom_layout.rows):
-                for node in row:
-                    node.row = i_row
-
-            # Generate a new response
-            prompt = self.prev_prompt + "\n" + alt_node.response_text + decoded_token
-            self.response_generator.prompt = prompt
-            self.response_generator.settings = self.sample_settings            
-            self.response_generator.start()            
+            # Queue a new branch, alternatives picked while other branches grow are started together
+            prompt = self.tree.prompt + "\n" + self.tree.text(alt_node)
+            self.pending_branches.append((prompt, alt_node))
+            self.start_branches()
 
 
     def select_model(self):
@@ -208,14 +306,13 @@ class LLMExplorer(QMainWindow):
         if file_name:
             self.model_path_input.setText(file_name)
             result = self.response_generator.load_model(file_name)
+            self.node_canvas.llm = self.response_generator.llm
             self.chat_history.append("<font color='yellow'>System: {result}</font>\n")
 
     def on_clear_pressed(self):
         self.chat_history.clear()
         self.prompt_input.clear()
-        self.node_scroll_area.custom_layout.clear_nodes()
-        self.current_node_row = 0
-        self.current_node_column = 0        
+        self.reset_tree("")
 
     def on_go_pressed(self):
         if not self.response_generator.llm:
@@ -227,16 +324,13 @@ class LLMExplorer(QMainWindow):
             self.prompt_input.clear()
 
             #     
-            self.node_scroll_area.custom_layout.clear_nodes()
-            self.current_node_row = 0
-            self.current_node_column = 0
+            self.reset_tree(self.chat_history.toPlainText())
+            self.response_lane = self.tree.new_lane()
 
             # Generate response
-            self.response_generator.prompt = self.chat_history.toPlainText()
+            self.response_generator.prompt = self.tree.prompt
             self.response_generator.settings = self.sample_settings            
             self.response_generator.start()
-            self.prev_prompt = self.response_generator.prompt
-            self.prev_node = None
 
             self.go_button.setText(STOP)
             QCoreApplication.processEvents()
@@ -244,11 +338,72 @@ class LLMExplorer(QMainWindow):
 
         elif self.go_button.text() == STOP:
             self.response_generator.stop()
+            self.best_of_n_generator.stop()
             
             self.go_button.setText(GO)
             QCoreApplication.processEvents()
 
 
+    def on_best_of_n_pressed(self):
+        if not self.response_generator.llm:
+            self.chat_history.append("<font color='yellow'>System: Please load a model first.</font>\n")
+            return
+        n = int(self.best_of_n_input.text()) if self.best_of_n_input.text().isdigit() else 0
+        if self.go_button.text() == GO and n > 0:
+            prompt = self.prompt_input.text()
+            self.chat_history.append(f"<font color='blue'>User:</font> {prompt}\n<font color='green'>Response:</font>")
+            self.prompt_input.clear()
+
+            #
+            self.reset_tree(self.chat_history.toPlainText())
+            self.best_of_n_nodes = [ExplorationTree.ROOT] * n
+            self.best_of_n_lanes = [self.tree.new_lane() for _ in range(n)]
+
+            # Generate N responses together
+            self.best_of_n_generator.llm = self.response_generator.llm
+            self.best_of_n_generator.settings = self.sample_settings
+            self.best_of_n_generator.prompt = self.tree.prompt
+            self.best_of_n_generator.n = n
+            self.best_of_n_generator.selector_name = self.selector_combo.currentText()
+            self.best_of_n_generator.start()
+
+            self.go_button.setText(STOP)
+            QCoreApplication.processEvents()
+
+    def on_save_pressed(self):
+        if self.response_generator.isRunning() or self.branch_generator.isRunning() or self.best_of_n_generator.isRunning():
+            self.statusBar().showMessage("stop generating before saving")
+            return
+        file_name, _ = QFileDialog.getSaveFileName(self, "Save Session", filter = "LLM Explorer session (*.npz)")
+        if file_name:
+            session = llm_session.Session(self.tree, self.sample_settings, self.chat_history.toHtml(), self.model_path_input.text())
+            llm_session.save_session(file_name, session)
+            self.statusBar().showMessage(f"saved {len(self.tree) - 1} nodes to {file_name}")
+
+    def on_open_pressed(self):
+        file_name, _ = QFileDialog.getOpenFileName(self, "Open Session", filter = "LLM Explorer session (*.npz)")
+        if file_name:
+            self.response_generator.stop()
+            self.best_of_n_generator.stop()
+            self.response_generator.wait()
+            self.best_of_n_generator.wait()
+            self.reset_tree("")
+            try:
+                session = llm_session.load_session(file_name)
+            except (OSError, ValueError, KeyError) as e:
+                self.statusBar().showMessage(f"could not open {file_name}: {e}")
+                return
+            self.tree = session.tree
+            # the arrays are memory mapped, the canvas only lays out the nodes and paints the visible ones
+            self.node_canvas.set_tree(self.tree, self.response_generator.llm)
+            self.sample_settings = session.settings
+            self.properties_widget.set_object(self.sample_settings)
+            self.chat_history.setHtml(session.chat_html)
+            if not self.response_generator.llm:
+                self.model_path_input.setText(session.model_path)
+            self.statusBar().showMessage(f"opened {len(self.tree) - 1} nodes from {file_name}")
+
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     explorer = LLMExplorer()
@@ -0,0 +1,264 @@
+"""
+Headless exploration, runs every prompt of a prompt file through the ExplorerEngine and writes one
+session (.npz, open it in the app) per prompt plus a summary.jsonl with the responses and latencies.
+
+    python llm-explorer-cli.py model.gguf prompts.txt --out sessions --n 4 --temp 0.9
+
+The prompt file has one prompt per line, empty lines are skipped. Every SampleSettings field can be
+set with --<field-name>.
+
+--sweep runs a grid of sampler settings per prompt instead, replaying cached logits so only positions
+where a setting's tokens diverge are decoded, and reports candidate set sizes and distribution
+differences against the first setting:
+
+    python llm-explorer-cli.py model.gguf prompts.txt --sweep temp=0.2,0.8,1.5 --sweep top_k=5,40
+
+--compare teacher forces every line through the model and a second one that shares its tokenizer (a
+fine tune and its base, two quantizations) and writes the per position KL, JS, top-1 agreement and
+rank columns of the whole corpus to compare.npz, with a summary row per line:
+
+    python llm-explorer-cli.py base.gguf corpus.txt --compare finetune.gguf
+
+--beam N grows each response a chunk of --chunk-tokens tokens at a time, N candidate chunks per step
+over the --beam-width best beams so far, and saves the final beams one lane each. The judge and
+embedding scorers run on a second model (--scorer-model):
+
+    python llm-explorer-cli.py model.gguf prompts.txt --beam 8 --beam-width 2 --chunk-tokens 16
+
+--continuations scores the existing answers of a file (one per line) as continuations of every prompt,
+one prefill each, and ranks them by mean token log probability:
+
+    python llm-explorer-cli.py model.gguf questions.txt --continuations answers.txt
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from typing import Dict, List, Tuple
+
+from llm_engine import ExplorerEngine
+from llm_generator import SampleSettings
+from exploration_tree import ExplorationTree
+from llm_session import Session, save_session
+from llm_sweep import SamplingSweep, sweep_grid
+from llm_compare import ModelComparison, CorpusComparison
+from llm_beam import ChunkBeamGenerator, SCORER_NAMES, make_scorer
+
+def read_prompts(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+def parse_bool(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes", "on")
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run prompts through the LLM Explorer engine without a GUI")
+    parser.add_argument("model", help="path of the gguf model")
+    parser.add_argument("prompts", help="prompt file, one prompt per line")
+    parser.add_argument("--out", default="sessions", help="output directory for the sessions and summary.jsonl")
+    parser.add_argument("--n", type=int, default=1, help="responses per prompt, generated together as parallel branches")
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    parser.add_argument("--n-batch", type=int, default=512)
+    parser.add_argument("--n-gpu-layers", type=int, default=-1)
+    parser.add_argument("--sweep", action="append", default=[], metavar="SETTING=V1,V2,...",
+                        help="sweep a sample setting over values, repeat for a grid")
+    parser.add_argument("--seed", type=int, default=1234, help="sampler seed of every sweep setting")
+    parser.add_argument("--compare", default="", metavar="MODEL_B", help="compare the model against MODEL_B over the prompts")
+    parser.add_argument("--beam", type=int, default=0, metavar="N", help="chunk beam search with N candidate chunks per step")
+    parser.add_argument("--beam-width", type=int, default=2, help="beams kept after every step")
+    parser.add_argument("--chunk-tokens", type=int, default=16, help="tokens per chunk")
+    parser.add_argument("--scorer", choices=SCORER_NAMES, default=SCORER_NAMES[0], help="how the chunks are ranked")
+    parser.add_argument("--scorer-model", default="", help="judge model, or embedding model for --scorer embedding")
+    parser.add_argument("--continuations", default="", metavar="FILE", help="score the lines of FILE as continuations of every prompt")
+    # one option per sample setting
+    for name, value in SampleSettings().__dict__.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, default=value,
+                            type=parse_bool if isinstance(value, bool) else type(value))
+    return parser.parse_args(argv)
+
+# {"temp": [0.2, 0.8]} from ["temp=0.2,0.8"], values are converted to the type of the setting
+def parse_sweep(specs: List[str]) -> Dict[str, List]:
+    defaults = SampleSettings().__dict__
+    values: Dict[str, List] = {}
+    for spec in specs:
+        name, _, items = spec.partition("=")
+        name = name.strip().replace("-", "_")
+        if name not in defaults:
+            raise SystemExit(f"unknown sweep setting {name}")
+        convert = parse_bool if isinstance(defaults[name], bool) else type(defaults[name])
+        values[name] = [convert(item) for item in items.split(",") if item.strip()]
+    return values
+
+# every setting of the sweep from the root, one lane each
+def sweep(engine: ExplorerEngine, prompt: str, grid: List[SampleSettings], seed: int) -> Tuple[ExplorationTree, List[Dict]]:
+    tree = ExplorationTree(prompt)
+    summaries = []
+    sampling_sweep = SamplingSweep(engine.llm, engine.state_cache, seed)
+    for result in sampling_sweep.generate(prompt, grid):
+        lane = tree.new_lane()
+        parent = ExplorationTree.ROOT
+        for i in range(len(result.trace)):
+            parent = tree.add_sample(parent, result.trace.sample(i), lane)
+        summaries.append(result.summary())
+    engine.latency = sampling_sweep.latency
+    return tree, summaries
+
+# the final beams of a chunk beam search from the root, best first, one lane each
+def beam_search(generator: ChunkBeamGenerator, prompt: str) -> Tuple[ExplorationTree, List[Dict]]:
+    tree = ExplorationTree(prompt)
+    generator.run(prompt)
+    summaries = []
+    for beam in generator.survivors:
+        lane = tree.new_lane()
+        parent = ExplorationTree.ROOT
+        for chunk in beam.path():
+            for i in range(len(chunk.trace)):
+                parent = tree.add_sample(parent, chunk.trace.sample(i), lane)
+        summaries.append({"score": beam.score, "mean_logprob": beam.mean_logprob, "chunks": beam.depth,
+                          "text": beam.path_text()})
+    return tree, summaries
+
+# one exploration of prompt, n > 1 grows n responses together, one lane each
+def explore(engine: ExplorerEngine, prompt: str, n: int) -> ExplorationTree:
+    tree = ExplorationTree(prompt)
+    if n <= 1:
+        lane = tree.new_lane()
+        parent = ExplorationTree.ROOT
+        for sample_data in engine.generate(prompt):
+            parent = tree.add_sample(parent, sample_data, lane)
+    else:
+        lanes = [tree.new_lane() for _ in range(n)]
+        parents = [ExplorationTree.ROOT] * n
+        for i_branch, sample_data in engine.generate_branches([prompt] * n):
+            parents[i_branch] = tree.add_sample(parents[i_branch], sample_data, lanes[i_branch])
+    return tree
+
+# every prompt teacher forced through both models, one summary row per prompt and the columns of
+# the whole corpus in compare.npz
+def compare(args: argparse.Namespace, prompts: List[str]) -> int:
+    engine_a = ExplorerEngine(state_cache_bytes=0)
+    engine_b = ExplorerEngine(state_cache_bytes=0)
+    for engine, path in ((engine_a, args.model), (engine_b, args.compare)):
+        engine.load_model(path, n_ctx=args.n_ctx, n_batch=args.n_batch, n_gpu_layers=args.n_gpu_layers,
+                          logits_all=True, verbose=False)
+    comparison = ModelComparison(engine_a.llm, engine_b.llm)
+    corpus = CorpusComparison()
+
+    start_time = time.perf_counter()
+    with open(os.path.join(args.out, "summary.jsonl"), "w", encoding="utf-8") as summary:
+        for i, result in comparison.compare_corpus(prompts):
+            corpus.add(result)
+            row = {"index": i, "prompt": prompts[i], "compare": result.summary()}
+            summary.write(json.dumps(row) + "\n")
+            if (i + 1) % 100 == 0 or i + 1 == len(prompts):
+                summary.flush()
+                print(f"[{i + 1}/{len(prompts)}] {corpus.summary()}", file=sys.stderr)
+    corpus.save(os.path.join(args.out, "compare.npz"))
+
+    seconds = time.perf_counter() - start_time
+    positions = corpus.summary()["positions"]
+    print(f"{len(corpus)} prompts, {positions} positions in {seconds:.1f}s ({positions / max(seconds, 1e-9):.1f} pos/s)",
+          file=sys.stderr)
+    return 0
+
+# every continuation teacher forced after every prompt, ranked by mean token log probability
+def score_continuations(args: argparse.Namespace, prompts: List[str]) -> int:
+    continuations = read_prompts(args.continuations)
+    engine = ExplorerEngine(state_cache_bytes=0)
+    engine.load_model(args.model, n_ctx=args.n_ctx, n_batch=args.n_batch, n_gpu_layers=args.n_gpu_layers, verbose=False)
+
+    start_time = time.perf_counter()
+    with open(os.path.join(args.out, "summary.jsonl"), "w", encoding="utf-8") as summary:
+        for i, prompt in enumerate(prompts):
+            scores = engine.llm.score(prompt, continuations)
+            ranked = sorted(range(len(continuations)), key=lambda k: scores[k].mean_logprob, reverse=True)
+            row = {"index": i,
+                   "prompt": prompt,
+                   "ranked": [{"continuation": continuations[k],
+                               "mean_logprob": scores[k].mean_logprob,
+                               "total_logprob": scores[k].total_logprob,
+                               "mean_rank": float(scores[k].ranks.mean()) if len(scores[k].ranks) > 0 else 0.0,
+                               "mean_entropy": float(scores[k].entropy.mean()) if len(scores[k].entropy) > 0 else 0.0}
+                              for k in ranked]}
+            summary.write(json.dumps(row) + "\n")
+            summary.flush()
+            print(f"[{i + 1}/{len(prompts)}] best: {continuations[ranked[0]] if ranked else ''}", file=sys.stderr)
+
+    seconds = time.perf_counter() - start_time
+    print(f"{len(prompts)} prompts x {len(continuations)} continuations in {seconds:.1f}s", file=sys.stderr)
+    return 0
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    settings = SampleSettings()
+    for name in settings.__dict__:
+        setattr(settings, name, getattr(args, name))
+
+    sweep_values = parse_sweep(args.sweep)
+    prompts = read_prompts(args.prompts)
+    os.makedirs(args.out, exist_ok=True)
+    if args.compare:
+        return compare(args, prompts)
+    if args.continuations:
+        return score_continuations(args, prompts)
+
+    engine = ExplorerEngine(settings=settings)
+    engine.load_model(args.model, n_ctx=args.n_ctx, n_batch=args.n_batch, n_gpu_layers=args.n_gpu_layers, verbose=False)
+
+    beam_generator = None
+    if args.beam > 0:
+        scorer_engine = ExplorerEngine(state_cache_bytes=0)
+        if args.scorer != SCORER_NAMES[0] and args.scorer_model:
+            scorer_engine.load_model(args.scorer_model, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers,
+                                     embedding=args.scorer == "embedding", verbose=False)
+        scorer = make_scorer(args.scorer, judge=scorer_engine.llm, embedder=scorer_engine.llm)
+        beam_generator = ChunkBeamGenerator(engine.llm, settings, scorer, n_chunks=args.beam,
+                                            beam_width=args.beam_width, chunk_tokens=args.chunk_tokens,
+                                            state_cache=engine.state_cache)
+
+    total_tokens = 0
+    start_time = time.perf_counter()
+    with open(os.path.join(args.out, "summary.jsonl"), "w", encoding="utf-8") as summary:
+        for i, prompt in enumerate(prompts):
+            sweep_summaries = None
+            beam_summaries = None
+            if len(sweep_values) > 0:
+                tree, sweep_summaries = sweep(engine, prompt, sweep_grid(settings, **sweep_values), args.seed)
+            elif beam_generator is not None:
+                tree, beam_summaries = beam_search(beam_generator, prompt)
+                engine.latency = beam_generator.latency
+            else:
+                tree = explore(engine, prompt, args.n)
+            session_path = os.path.join(args.out, f"prompt_{i:04d}.npz")
+            save_session(session_path, Session(tree, settings, model_path=args.model))
+
+            generated = len(tree) - 1
+            total_tokens += generated
+            row = {"index": i,
+                   "prompt": prompt,
+                   "session": session_path,
+                   "responses": [trace.get_text() for trace in tree.traces],
+                   "latency": vars(engine.latency)}
+            if sweep_summaries is not None:
+                row["sweep"] = sweep_summaries
+            if beam_summaries is not None:
+                row["beams"] = beam_summaries
+            summary.write(json.dumps(row) + "\n")
+            summary.flush()
+            print(f"[{i + 1}/{len(prompts)}] {generated} tokens, {engine.latency}", file=sys.stderr)
+            for s in sweep_summaries or []:
+                swept = " ".join(f"{name}={s['settings'][name]}" for name in sweep_values)
+                print(f"    {swept}: {s['tokens']} tokens ({s['decoded']} decoded, {s['replayed']} replayed), "
+                      f"candidates {s['mean_candidates']:.1f} avg {s['max_candidates']} max, "
+                      f"entropy {s['mean_entropy']:.2f}, diverged at {s['diverged_at']}, distance {s['mean_distance']:.3f}",
+                      file=sys.stderr)
+
+    seconds = time.perf_counter() - start_time
+    print(f"{len(prompts)} prompts, {total_tokens} tokens in {seconds:.1f}s ({total_tokens / max(seconds, 1e-9):.1f} tok/s)",
+          file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,294 @@
+import time
+import numpy as np
+
+from typing import Callable, Iterator, List, Optional
+
+from llama_cpp import Llama
+from llm_generator import ResponseTrace, SampleSettings, BranchLatency, rewind_to_prefix
+from llm_parallel import make_sampling_context
+from llm_judge import final_logits
+from branch_state_cache import BranchStateCache
+from util.growable_array import GrowableArray
+
+class BeamChunk:
+    # K tokens generated on top of a parent chunk, the path from the root is one beam's response.
+    # Chunks only hold their own tokens, forking a beam never copies its history
+    def __init__(self, parent: Optional["BeamChunk"], seq_id: int, n_past: int):
+        self.parent = parent
+        self.seq_id = seq_id # -1 once its kv cells were released
+        self.n_past = n_past # positions in the sequence before this chunk's first token
+        self.tokens: List[int] = []
+        self.trace = ResponseTrace(capacity=16)
+        self.logprobs = GrowableArray(np.single, 16) # full vocab log p of each sampled token
+        self.logits: Optional[np.ndarray] = None # logits after the last token, the children sample from it
+        self.sampling_context = None
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.path_logprob_sum = 0.0 if parent is None else parent.path_logprob_sum
+        self.path_length = 0 if parent is None else parent.path_length
+        self.score = 0.0
+        self.done = False
+
+    @property
+    def text(self) -> str:
+        return self.trace.get_text()
+
+    @property
+    def mean_logprob(self) -> float:
+        return self.path_logprob_sum / self.path_length if self.path_length > 0 else -np.inf
+
+    def path(self) -> List["BeamChunk"]:
+        chunks = []
+        chunk = self
+        while chunk is not None and chunk.parent is not None:
+            chunks.append(chunk)
+            chunk = chunk.parent
+        return chunks[::-1]
+
+    def path_tokens(self) -> List[int]:
+        return [token for chunk in self.path() for token in chunk.tokens]
+
+    def path_text(self) -> str:
+        return "".join(chunk.text for chunk in self.path())
+
+# a scorer scores the chunks of a step given the prompt, higher is better
+Scorer = Callable[[str, List[BeamChunk]], np.ndarray]
+
+class MeanLogprobScorer:
+    # average token log probability of the whole beam so far
+    def __call__(self, prompt: str, chunks: List[BeamChunk]) -> np.ndarray:
+        return np.array([chunk.mean_logprob for chunk in chunks], dtype=np.single)
+
+class JudgeScorer:
+    # asks a judge model whether the beam so far is a good answer and scores it with the log odds of
+    # "Yes" over "No" after one prefill, no tokens are generated. The judge needs its own Llama, rewinding
+    # it would drop the beam sequences of the generating model. The chunks of a step are prefilled
+    # together, the prompt part of the judge's question is shared by all of them
+    def __init__(self, judge: Llama, state_cache: Optional[BranchStateCache] = None,
+                 instruction: str = "Is this response coherent and relevant to the question? Answer Yes or No."):
+        self.judge = judge
+        self.state_cache = state_cache
+        self.instruction = instruction
+        self._labels: Optional[List[int]] = None
+
+    def build_prompt(self, prompt: str, chunk: BeamChunk) -> str:
+        return f"{prompt}\n\nResponse: {chunk.path_text().strip()}\n\n{self.instruction}\nAnswer:"
+
+    def label_tokens(self) -> List[int]:
+        if self._labels is None:
+            self._labels = [self.judge.tokenize(label.encode(), add_bos=False, special=False)[-1] for label in (" Yes", " No")]
+        return self._labels
+
+    def __call__(self, prompt: str, chunks: List[BeamChunk]) -> np.ndarray:
+        yes, no = self.label_tokens()
+        token_lists = [self.judge.tokenize(self.build_prompt(prompt, chunk).encode()) for chunk in chunks]
+        logits = final_logits(self.judge, token_lists, self.state_cache)
+        return logits[:, yes] - logits[:, no]
+
+class EmbeddingScorer:
+    # cosine similarity of the beam so far to the prompt, from a model created with embedding=True.
+    # All chunks of a step are embedded in one call
+    def __init__(self, embedder: Llama):
+        self.embedder = embedder
+        self._prompt = ""
+        self._prompt_embedding: Optional[np.ndarray] = None
+
+    def __call__(self, prompt: str, chunks: List[BeamChunk]) -> np.ndarray:
+        if self._prompt_embedding is None or prompt != self._prompt:
+            self._prompt = prompt
+            self._prompt_embedding = np.asarray(self.embedder.embed(prompt, normalize=True), dtype=np.single)
+        embeddings = np.asarray(self.embedder.embed([chunk.path_text() for chunk in chunks], normalize=True),
+                                dtype=np.single)
+        return embeddings @ self._prompt_embedding
+
+class ChunkBeamGenerator:
+    # macro sampling, the response grows a chunk of chunk_tokens tokens at a time. Each step forks
+    # n_chunks sequences off the surviving beams (kv_cache_seq_cp shares the cells of their history,
+    # the first child of a beam takes over its sequence), samples and decodes all of them together
+    # with one llama_decode per token, scores the new chunks and keeps the best beam_width. The
+    # sequences of the losers are removed, so a step costs about as much as n_chunks parallel streams.
+    # Beams that reached an end of generation token stay in the running with their score
+    def __init__(self, llm: Llama, settings: SampleSettings, scorer: Optional[Scorer] = None,
+                 n_chunks: int = 8, beam_width: int = 2, chunk_tokens: int = 16,
+                 state_cache: Optional[BranchStateCache] = None):
+        if n_chunks > llm.n_batch:
+            raise ValueError(f"Requested chunks ({n_chunks}) exceed batch size of {llm.n_batch}")
+        # sequence 0 holds the prompt, the chunks take sequences 1..n_chunks
+        if n_chunks >= llm.n_seq_max():
+            raise ValueError(f"Requested chunks ({n_chunks}) need {n_chunks + 1} sequences, the context has n_seq_max={llm.n_seq_max()}")
+        self.llm = llm
+        self.settings = settings
+        self.scorer: Scorer = scorer if scorer is not None else MeanLogprobScorer()
+        self.n_chunks = max(1, n_chunks)
+        self.beam_width = max(1, min(beam_width, self.n_chunks))
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.state_cache = state_cache
+        self.survivors: List[BeamChunk] = []
+        self.latency = BranchLatency()
+        self.steps = 0
+        self.score_seconds = 0.0
+        self._prompt = ""
+        self._free_seq_ids: List[int] = []
+        self._is_running = False
+
+    def stop(self):
+        self._is_running = False
+
+    @property
+    def best(self) -> Optional[BeamChunk]:
+        return self.survivors[0] if len(self.survivors) > 0 else None
+
+    # yields the surviving beams, best first, after every step
+    def generate(self, prompt: str) -> Iterator[List[BeamChunk]]:
+        llm = self.llm
+        self._prompt = prompt
+        self._is_running = True
+        self.latency = BranchLatency()
+        self.steps = 0
+        self.score_seconds = 0.0
+        start_time = time.perf_counter()
+
+        # the prompt on sequence 0, every beam forks from it
+        tokens = llm.tokenize(prompt.encode())
+        prefix = rewind_to_prefix(llm, tokens, self.state_cache, self.latency)
+        llm.eval(tokens[prefix:])
+        root = BeamChunk(None, 0, 0)
+        root.logits = llm.logits_row(llm.n_tokens - 1).copy()
+        root.tokens = tokens
+        self.survivors = [root]
+        self._free_seq_ids = list(range(self.n_chunks, 0, -1))
+        self.latency.prompt_eval_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        try:
+            while self._is_running and any(not beam.done for beam in self.survivors):
+                if self.settings.max_samples > 0 and self.survivors[0].path_length > self.settings.max_samples:
+                    break
+                chunks = self._fork()
+                self._decode_chunks(chunks)
+                self._select(chunks)
+                self.steps += 1
+                yield self.survivors
+        finally:
+            for beam in self.survivors:
+                self._release(beam)
+            self.latency.generation_seconds = time.perf_counter() - start_time
+            self._is_running = False
+
+    def run(self, prompt: str) -> Optional[BeamChunk]:
+        for _ in self.generate(prompt):
+            pass
+        return self.best
+
+    # n_chunks children spread over the beams that are still growing, the best beams get the remainder
+    def _fork(self) -> List[BeamChunk]:
+        llm = self.llm
+        growing = [beam for beam in self.survivors if not beam.done]
+        fanout, extra = divmod(self.n_chunks, len(growing))
+        chunks = []
+        for i, beam in enumerate(growing):
+            n_children = fanout + (1 if i < extra else 0)
+            for i_child in range(n_children):
+                # the first child continues in the beam's own sequence, the root's (sequence 0) is kept
+                if i_child == 0 and beam.parent is not None:
+                    seq_id = beam.seq_id
+                else:
+                    seq_id = self._free_seq_ids.pop()
+                    llm._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+                    llm._ctx.kv_cache_seq_cp(beam.seq_id, seq_id, -1, -1)
+                chunk = BeamChunk(beam, seq_id, beam.n_past + len(beam.tokens))
+                chunk.sampling_context = make_sampling_context(llm, self.settings, self._history(beam))
+                chunks.append(chunk)
+            if n_children == 0 and beam.parent is not None:
+                self._release(beam)
+            else:
+                # the children own the sequence now
+                beam.seq_id = -1
+        return chunks
+
+    def _history(self, beam: BeamChunk) -> List[int]:
+        root = beam
+        while root.parent is not None:
+            root = root.parent
+        return root.tokens + beam.path_tokens()
+
+    # chunk_tokens tokens for every chunk, one llama_decode per token for all of them
+    def _decode_chunks(self, chunks: List[BeamChunk]):
+        llm = self.llm
+        n_vocab = llm.n_vocab()
+        logits = np.empty((len(chunks), n_vocab), dtype=np.single)
+        for i, chunk in enumerate(chunks):
+            logits[i] = chunk.parent.logits
+        active = list(range(len(chunks)))
+        for _ in range(self.chunk_tokens):
+            if not self._is_running or len(active) == 0:
+                break
+            rows = []
+            llm._batch.reset()
+            for i_chunk in list(active):
+                chunk = chunks[i_chunk]
+                context = chunk.sampling_context
+                token = context.sample(llm._ctx, logits_array=logits[i_chunk])
+                context.accept(llm._ctx, token, apply_grammar=False)
+                row = logits[i_chunk]
+                row_max = row.max()
+                logprob = float(row[token] - row_max - np.log(np.exp(row - row_max).sum(dtype=np.float64)))
+                chunk.trace.append(token, llm.detokenize([token]), context.get_token_data_array(),
+                                   raw_logits=row, raw_top_n=self.settings.raw_top_n)
+                chunk.logprobs.append(logprob)
+                chunk.path_logprob_sum += logprob
+                chunk.path_length += 1
+                chunk.tokens.append(token)
+                self.latency.generated_tokens += 1
+
+                position = chunk.n_past + len(chunk.tokens) - 1
+                if llm._model.vocab().is_eog[token] or position + 1 >= llm._n_ctx:
+                    chunk.done = True
+                    active.remove(i_chunk)
+                    continue
+                rows.append((llm._batch.n_tokens(), i_chunk))
+                llm._batch.add_token(token, position, [chunk.seq_id], True)
+
+            if len(rows) > 0:
+                llm._ctx.decode(llm._batch)
+                self.latency.evaluated_tokens += len(rows)
+                for row, i_chunk in rows:
+                    logits[i_chunk, :] = np.ctypeslib.as_array(llm._ctx.get_logits_ith(row), shape=(n_vocab,))
+                llm._batch.reset()
+        for i, chunk in enumerate(chunks):
+            chunk.logits = logits[i].copy() if not chunk.done else None
+            chunk.sampling_context = None
+
+    # scores the new chunks and keeps the best beam_width of them and of the finished beams
+    def _select(self, chunks: List[BeamChunk]):
+        start_time = time.perf_counter()
+        scores = self.scorer(self._prompt, chunks)
+        self.score_seconds += time.perf_counter() - start_time
+        for chunk, score in zip(chunks, scores):
+            chunk.score = float(score)
+        finished = [beam for beam in self.survivors if beam.done]
+        ranked = sorted(chunks + finished, key=lambda beam: beam.score, reverse=True)
+        self.survivors = ranked[:self.beam_width]
+        for beam in ranked[self.beam_width:]:
+            self._release(beam)
+        # finished beams never decode again
+        for beam in self.survivors:
+            if beam.done:
+                self._release(beam)
+
+    def _release(self, beam: BeamChunk):
+        if beam.seq_id > 0:
+            self.llm._ctx.kv_cache_seq_rm(beam.seq_id, -1, -1)
+            self._free_seq_ids.append(beam.seq_id)
+        beam.seq_id = -1
+        beam.logits = None
+
+SCORER_NAMES = ["mean logprob", "judge", "embedding"]
+
+# judge and embedding scorers need their own model, they fall back to mean logprob without one
+def make_scorer(name: str, judge: Optional[Llama] = None, embedder: Optional[Llama] = None,
+                state_cache: Optional[BranchStateCache] = None) -> Scorer:
+    if name == "judge" and judge is not None:
+        return JudgeScorer(judge, state_cache)
+    if name == "embedding" and embedder is not None:
+        return EmbeddingScorer(embedder)
+    return MeanLogprobScorer()
@@ -0,0 +1,127 @@
+import time
+import numpy as np
+
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from llama_cpp import Llama
+from llm_generator import ResponseTrace, SampleSettings, BranchLatency
+from llm_parallel import ParallelBranchGenerator
+from llm_judge import LogitJudge, JudgeResult
+from branch_state_cache import BranchStateCache
+from util.growable_array import GrowableArray
+
+class BestOfNCandidate:
+    # one of the N responses, logprobs are the full-vocab log softmax of each selected token
+    def __init__(self, index: int, trace: ResponseTrace):
+        self.index = index
+        self.trace = trace
+        self.logprobs = GrowableArray(np.single, 64)
+        self.score: float = 0.0
+
+    @property
+    def text(self) -> str:
+        return self.trace.get_text()
+
+# a selector scores every candidate, higher is better
+Selector = Callable[[List[BestOfNCandidate]], np.ndarray]
+
+class MeanLogprobSelector:
+    # average token log probability, how likely the model finds its own response
+    def __call__(self, candidates: List[BestOfNCandidate]) -> np.ndarray:
+        return np.array([c.logprobs.values.mean() if len(c.logprobs) > 0 else -np.inf for c in candidates],
+                        dtype=np.single)
+
+class MinPMarginSelector:
+    # the weakest point of the response, the smallest margin between the selected token's p and the best
+    # other candidate at any position. A response that never had to pick between close candidates wins
+    def __call__(self, candidates: List[BestOfNCandidate]) -> np.ndarray:
+        scores = np.full(len(candidates), -np.inf, dtype=np.single)
+        for i, candidate in enumerate(candidates):
+            trace = candidate.trace
+            if len(trace) == 0:
+                continue
+            # candidates are sorted by p once the sampler chain ran, so the best other candidate is the
+            # first one, or the second one when the first was selected
+            flat_p = trace.flat_candidate_p
+            offsets = trace.candidate_offsets
+            first = flat_p[offsets]
+            second = np.where(trace.candidate_counts > 1, flat_p[np.minimum(offsets + 1, flat_p.size - 1)], 0.0)
+            runner_up = np.where(trace.token_indices == 0, second, first)
+            scores[i] = (trace.p - runner_up).min()
+        return scores
+
+class JudgeSelector:
+    # asks the model which response is best and reads the answer off the logits of the label tokens
+    # "1".."N" after a single prefill, no tokens are generated. Scores are the log of the calibrated
+    # label probabilities
+    def __init__(self, llm: Llama, question: str, state_cache: Optional[BranchStateCache] = None,
+                 calibrate: bool = True):
+        self.question = question
+        self.judge = LogitJudge(llm, state_cache, calibrate)
+        self.result: Optional[JudgeResult] = None
+
+    def __call__(self, candidates: List[BestOfNCandidate]) -> np.ndarray:
+        self.result = self.judge.judge(self.question, [candidate.text for candidate in candidates])
+        with np.errstate(divide="ignore"):
+            return np.log(self.result.probs)
+
+class BestOfNGenerator:
+    # generates N responses to one prompt as parallel branches (the prompt is evaluated once and shared
+    # through kv_cache_seq_cp) and ranks them with a pluggable selector
+    def __init__(self, llm: Llama, settings: SampleSettings, selector: Optional[Selector] = None,
+                 state_cache: Optional[BranchStateCache] = None):
+        self.llm = llm
+        self.settings = settings
+        self.selector: Selector = selector if selector is not None else MeanLogprobSelector()
+        self.state_cache = state_cache
+        self.generator = ParallelBranchGenerator(llm, settings, state_cache)
+        self.candidates: List[BestOfNCandidate] = []
+        self.rank_seconds = 0.0
+
+    @property
+    def latency(self) -> BranchLatency:
+        return self.generator.latency
+
+    def stop(self):
+        self.generator.stop()
+
+    # yields (candidate index, sample index) as the N responses grow
+    def generate(self, prompt: str, n: int) -> Iterator[Tuple[int, int]]:
+        # fail before generating responses the judge cannot label
+        if isinstance(self.selector, JudgeSelector) and n > self.selector.judge.max_candidates:
+            raise ValueError(f"the judge picks between at most {self.selector.judge.max_candidates} responses, got n={n}")
+        tokens = self.llm.tokenize(prompt.encode())
+        self.candidates = []
+        for i_branch, i_sample in self.generator.generate_tokens([tokens] * n):
+            if len(self.candidates) == 0:
+                self.candidates = [BestOfNCandidate(i, branch.trace) for i, branch in enumerate(self.generator.branches)]
+            candidate = self.candidates[i_branch]
+            # the branch's logits row is still the one its sample was taken from
+            logprobs = Llama.logits_to_logprobs(self.generator.logits[i_branch])
+            candidate.logprobs.append(logprobs[candidate.trace.token_ids[i_sample]])
+            yield i_branch, i_sample
+
+    # candidates best first
+    def rank(self) -> List[BestOfNCandidate]:
+        if len(self.candidates) == 0:
+            return []
+        start_time = time.perf_counter()
+        scores = self.selector(self.candidates)
+        for candidate, score in zip(self.candidates, scores):
+            candidate.score = float(score)
+        self.rank_seconds = time.perf_counter() - start_time
+        return sorted(self.candidates, key=lambda c: c.score, reverse=True)
+
+    def run(self, prompt: str, n: int) -> List[BestOfNCandidate]:
+        for _ in self.generate(prompt, n):
+            pass
+        return self.rank()
+
+SELECTOR_NAMES = ["mean logprob", "min p margin", "judge"]
+
+def make_selector(name: str, llm: Llama, question: str, state_cache: Optional[BranchStateCache] = None) -> Selector:
+    if name == "min p margin":
+        return MinPMarginSelector()
+    if name == "judge":
+        return JudgeSelector(llm, question, state_cache)
+    return MeanLogprobSelector()
@@ -0,0 +1,233 @@
+import time
+import numpy as np
+
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+from util.growable_array import GrowableArray
+from llm_generator import longest_common_prefix
+from llm_metrics import LOG_P_FLOOR
+
+LOG_2 = float(np.log(2.0))
+
+# log softmax of every row, floored so 0 * log p of masked tokens stays 0 instead of nan
+def log_softmax_rows(logits: np.ndarray) -> np.ndarray:
+    log_p = logits - logits.max(axis=1, keepdims=True)
+    np.maximum(log_p, LOG_P_FLOOR, out=log_p)
+    log_p -= np.log(np.exp(log_p).sum(axis=1, dtype=np.float64, keepdims=True)).astype(log_p.dtype)
+    return log_p
+
+class PositionDivergence(NamedTuple):
+    kl: np.ndarray          # KL(a || b) of the next token distributions, nats
+    js: np.ndarray          # Jensen-Shannon divergence, nats, 0..log 2
+    top1_agree: np.ndarray  # both models put the same token on top
+    rank_a: np.ndarray      # rank of the actual next token under a, 0 is the most likely
+    rank_b: np.ndarray      # rank of the actual next token under b
+
+# divergence of the rows of two logit matrices, targets[i] is the token that actually follows row i
+def position_divergence(logits_a: np.ndarray, logits_b: np.ndarray, targets: np.ndarray) -> PositionDivergence:
+    log_p = log_softmax_rows(logits_a)
+    log_q = log_softmax_rows(logits_b)
+    p = np.exp(log_p)
+    q = np.exp(log_q)
+    kl = (p * (log_p - log_q)).sum(axis=1, dtype=np.float64)
+    log_m = np.logaddexp(log_p, log_q)
+    log_m -= LOG_2
+    js = 0.5 * ((p * (log_p - log_m)).sum(axis=1, dtype=np.float64) + (q * (log_q - log_m)).sum(axis=1, dtype=np.float64))
+    top1_agree = logits_a.argmax(axis=1) == logits_b.argmax(axis=1)
+    rows = np.arange(targets.size)
+    rank_a = (logits_a > logits_a[rows, targets][:, None]).sum(axis=1)
+    rank_b = (logits_b > logits_b[rows, targets][:, None]).sum(axis=1)
+    return PositionDivergence(kl.astype(np.single), js.astype(np.single), top1_agree,
+                              rank_a.astype(np.int32), rank_b.astype(np.int32))
+
+class ComparisonResult:
+    # per position comparison of two models over one token stream, position i compares their
+    # distributions for tokens[i + 1] given tokens[:i + 1]
+    def __init__(self, tokens: List[int]):
+        self.tokens = np.asarray(tokens, dtype=np.intc)
+        capacity = max(1, self.tokens.size - 1)
+        self._kl = GrowableArray(np.single, capacity)
+        self._js = GrowableArray(np.single, capacity)
+        self._top1_agree = GrowableArray(np.bool_, capacity)
+        self._rank_a = GrowableArray(np.int32, capacity)
+        self._rank_b = GrowableArray(np.int32, capacity)
+        self.seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self._kl)
+
+    @property
+    def kl(self) -> np.ndarray:
+        return self._kl.values
+
+    @property
+    def js(self) -> np.ndarray:
+        return self._js.values
+
+    @property
+    def top1_agree(self) -> np.ndarray:
+        return self._top1_agree.values
+
+    @property
+    def rank_a(self) -> np.ndarray:
+        return self._rank_a.values
+
+    @property
+    def rank_b(self) -> np.ndarray:
+        return self._rank_b.values
+
+    @property
+    def rank_shift(self) -> np.ndarray:
+        # > 0 where b finds the actual token less likely than a does
+        return self.rank_b - self.rank_a
+
+    def extend(self, divergence: PositionDivergence):
+        for name, values in divergence._asdict().items():
+            getattr(self, "_" + name).extend(values)
+
+    # the columns by name, no copies. Column i belongs to tokens[i + 1], the token a view colors
+    def columns(self) -> Dict[str, np.ndarray]:
+        columns = {name[1:]: column.values for name, column in self.__dict__.items() if isinstance(column, GrowableArray)}
+        columns["tokens"] = self.tokens
+        return columns
+
+    def summary(self) -> Dict:
+        n = len(self)
+        disagree = np.flatnonzero(~self.top1_agree)
+        return {"positions": n,
+                "mean_kl": float(self.kl.mean()) if n > 0 else 0.0,
+                "max_kl": float(self.kl.max()) if n > 0 else 0.0,
+                "mean_js": float(self.js.mean()) if n > 0 else 0.0,
+                "top1_agreement": float(self.top1_agree.mean()) if n > 0 else 1.0,
+                "mean_abs_rank_shift": float(np.abs(self.rank_shift).mean()) if n > 0 else 0.0,
+                "first_disagreement": int(disagree[0]) if disagree.size > 0 else -1,
+                "seconds": self.seconds}
+
+class ModelComparison:
+    # teacher forces the same tokens through two models that share a tokenizer (a fine tune and its
+    # base, two quantizations of one model) and compares their next token distributions at every
+    # position. Both models must be created with logits_all=True, the tokens are decoded a full batch
+    # at a time and compared straight from llm.scores, a block of rows per numpy pass. The part of a
+    # text that is already in a model's kv cache (e.g. a shared system prompt) is not decoded again.
+    def __init__(self, llm_a, llm_b, rows_per_pass: int = 0):
+        if not (llm_a.context_params.logits_all and llm_b.context_params.logits_all):
+            raise ValueError("both models need logits_all=True")
+        if llm_a.logits_retention != "dense" or llm_b.logits_retention != "dense":
+            raise ValueError("both models need logits_retention=\"dense\"")
+        if llm_a._model.vocab().pieces != llm_b._model.vocab().pieces:
+            raise ValueError("the models do not share a tokenizer")
+        self.llm_a = llm_a
+        self.llm_b = llm_b
+        self.n_ctx = min(llm_a._n_ctx, llm_b._n_ctx)
+        self.n_batch = min(llm_a.n_batch, llm_b.n_batch)
+        # rows compared per numpy pass, bounds the n_vocab sized float32 temporaries to ~16MB each
+        self.rows_per_pass = rows_per_pass if rows_per_pass > 0 else max(1, (1 << 22) // llm_a.n_vocab())
+        self._is_running = False
+
+    def stop(self):
+        self._is_running = False
+
+    def _rewind(self, llm, tokens: List[int]):
+        prefix = longest_common_prefix(llm._input_ids, tokens)
+        llm.n_tokens = prefix
+        llm._ctx.kv_cache_seq_rm(-1, prefix, -1)
+
+    # both models have decoded tokens[:end], their rows [0, end) of scores are valid
+    def _eval_to(self, llm, tokens: List[int], end: int):
+        if llm.n_tokens < end:
+            llm.eval(tokens[llm.n_tokens:end])
+
+    # compares tokens block by block, yields the result after each block so a view can color the
+    # positions as they arrive (result.kl[start:end] etc.)
+    def stream(self, tokens: List[int]) -> Iterator[Tuple[ComparisonResult, int, int]]:
+        self._is_running = True
+        yield from self._stream(tokens)
+        self._is_running = False
+
+    def _stream(self, tokens: List[int]) -> Iterator[Tuple[ComparisonResult, int, int]]:
+        tokens = list(tokens[:self.n_ctx])
+        result = ComparisonResult(tokens)
+        targets = result.tokens[1:]
+        n = targets.size
+        start_time = time.perf_counter()
+        self._rewind(self.llm_a, tokens)
+        self._rewind(self.llm_b, tokens)
+        start = 0
+        while start < n and self._is_running:
+            end = min(n, start + self.n_batch)
+            self._eval_to(self.llm_a, tokens, end)
+            self._eval_to(self.llm_b, tokens, end)
+            for i in range(start, end, self.rows_per_pass):
+                j = min(end, i + self.rows_per_pass)
+                result.extend(position_divergence(self.llm_a.scores[i:j], self.llm_b.scores[i:j], targets[i:j]))
+            result.seconds = time.perf_counter() - start_time
+            yield result, start, end
+            start = end
+
+    def _compare(self, tokens: List[int]) -> ComparisonResult:
+        result = ComparisonResult(tokens[:self.n_ctx])
+        for result, _, _ in self._stream(tokens):
+            pass
+        return result
+
+    def compare(self, tokens: List[int]) -> ComparisonResult:
+        self._is_running = True
+        result = self._compare(tokens)
+        self._is_running = False
+        return result
+
+    def compare_text(self, text: str) -> ComparisonResult:
+        return self.compare(self.llm_a.tokenize(text.encode()))
+
+    # one result per text, in order, until stopped
+    def compare_corpus(self, texts: Iterable[str]) -> Iterator[Tuple[int, ComparisonResult]]:
+        self._is_running = True
+        for i, text in enumerate(texts):
+            result = self._compare(self.llm_a.tokenize(text.encode()))
+            if not self._is_running:
+                break
+            yield i, result
+        self._is_running = False
+
+class CorpusComparison:
+    # the results of a corpus run concatenated column by column, text i is positions
+    # offsets[i]:offsets[i + 1] (and tokens token_offsets[i]:token_offsets[i + 1]).
+    # Saved uncompressed so it can be memory mapped like a session
+    def __init__(self):
+        self._columns: Dict[str, GrowableArray] = {}
+        self._offsets = GrowableArray(np.int64)
+        self._token_offsets = GrowableArray(np.int64)
+        self._offsets.append(0)
+        self._token_offsets.append(0)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def add(self, result: ComparisonResult):
+        for name, values in result.columns().items():
+            if name not in self._columns:
+                self._columns[name] = GrowableArray(values.dtype, 1024)
+            self._columns[name].extend(values)
+        self._offsets.append(self._offsets[-1] + len(result))
+        self._token_offsets.append(self._token_offsets[-1] + result.tokens.size)
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        columns = {name: column.values for name, column in self._columns.items()}
+        columns["offsets"] = self._offsets.values
+        columns["token_offsets"] = self._token_offsets.values
+        return columns
+
+    def summary(self) -> Dict:
+        columns = self.columns()
+        n = columns["offsets"][-1]
+        if n == 0:
+            return {"texts": len(self), "positions": 0}
+        return {"texts": len(self),
+                "positions": int(n),
+                "mean_kl": float(columns["kl"].mean()),
+                "mean_js": float(columns["js"].mean()),
+                "top1_agreement": float(columns["top1_agree"].mean()),
+                "mean_abs_rank_shift": float(np.abs(columns["rank_b"] - columns["rank_a"]).mean())}
+
+    def save(self, path: str):
+        np.savez(path, **self.columns())
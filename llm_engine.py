@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+import llama_cpp
+
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from llm_generator import ResponseTrace, SampleData, SampleSettings, BranchLatency, rewind_to_prefix
+from llm_parallel import ParallelBranchGenerator
+from branch_state_cache import BranchStateCache
+
+class ExplorerEngine:
+    # Qt free generation, the GUI threads are thin adapters over it and the cli drives it directly.
+    # generate yields every sample as it is taken, agenerate is the same stream as an async iterator
+    # (each step runs in the default executor so the event loop is never blocked by a decode)
+    def __init__(self, llm: Optional[llama_cpp.Llama] = None, settings: Optional[SampleSettings] = None,
+                 state_cache_bytes: int = (2 << 30)):
+        self.llm = llm
+        self.settings: SampleSettings = settings if settings is not None else SampleSettings()
+        # kv snapshots of explored branches, None disables
+        self.state_cache: Optional[BranchStateCache] = BranchStateCache(state_cache_bytes) if state_cache_bytes > 0 else None
+        self.trace: ResponseTrace = ResponseTrace()
+        self.latency: BranchLatency = BranchLatency()
+        self.lock = threading.Lock() # guards swapping and appending to trace
+        self._is_running = False
+
+    @property
+    def is_running(self) -> bool:
+        return self._is_running
+
+    def load_model(self, model_path: str, **kwargs):
+        if self._is_running:
+            raise RuntimeError("load aborted, model in use")
+        kwargs.setdefault("n_gpu_layers", -1)
+        # branches, beams, judgements and scored continuations each take a sequence forked off sequence 0
+        kwargs.setdefault("n_seq_max", 64)
+        # generation only samples the last position, a dense n_ctx x n_vocab matrix is only needed for logits_all
+        kwargs.setdefault("logits_retention", "dense" if kwargs.get("logits_all") else "last")
+        self.llm = llama_cpp.Llama(model_path=model_path, **kwargs)
+        if self.state_cache is not None:
+            self.state_cache.clear()
+
+    def stop(self):
+        self._is_running = False
+
+    # tokenize the prompt and rewind the model to the longest prefix it shares with what is already
+    # in the kv cache (the chat history, or the response a branch forks from), returns the suffix
+    # that still needs to be evaluated
+    def eval_prefix(self, prompt: str) -> List[int]:
+        prompt_tokens = self.llm.tokenize(prompt.encode())
+        self.latency = BranchLatency()
+        prefix = rewind_to_prefix(self.llm, prompt_tokens, self.state_cache, self.latency)
+        return prompt_tokens[prefix:]
+
+    # one response to prompt, a new trace per response so views of earlier responses stay valid
+    def generate(self, prompt: str) -> Iterator[SampleData]:
+        if not self.llm or len(prompt) == 0:
+            return
+        self._is_running = True
+        with self.lock:
+            self.trace = ResponseTrace()
+        response_length = 0
+        loop = True
+        prompt_tokens = self.eval_prefix(prompt)
+        sample_idx = self.llm.n_tokens + len(prompt_tokens) - 1
+        start_time = time.perf_counter()
+        try:
+            while self._is_running and loop:
+                self.llm.eval(prompt_tokens)
+                if response_length == 0:
+                    self.latency.prompt_eval_seconds = time.perf_counter() - start_time
+                    start_time = time.perf_counter()
+                while sample_idx < self.llm.n_tokens:
+                    token = self.llm.sample(idx=sample_idx,
+                                            top_k = self.settings.top_k,
+                                            top_p = self.settings.top_p,
+                                            min_p = self.settings.min_p,
+                                            typical_p = self.settings.typical_p,
+                                            temp = self.settings.temp,
+                                            repeat_penalty = self.settings.repeat_penalty,
+                                            frequency_penalty = self.settings.frequency_penalty,
+                                            presence_penalty = self.settings.presence_penalty,
+                                            tfs_z = self.settings.tfs_z,
+                                            mirostat_mode = self.settings.mirostat_mode,
+                                            mirostat_eta = self.settings.mirostat_eta,
+                                            mirostat_tau = self.settings.mirostat_tau,
+                                            penalize_nl = self.settings.penalize_nl,
+                                            )
+
+                    loop = not self.llm._model.vocab().is_eog[token]
+
+                    prompt_tokens.clear()
+                    prompt_tokens.append(token)
+
+                    with self.lock:
+                        # snapshot the surviving candidates, the token data array is n_vocab sized
+                        i_sample = self.trace.append(token, self.llm.detokenize([token]), self.llm.token_data_array,
+                                                     raw_logits=self.llm.logits_row(sample_idx),
+                                                     raw_top_n=self.settings.raw_top_n)
+                    yield self.trace.sample(i_sample)
+
+                    #
+                    sample_idx += 1
+                    response_length += 1
+
+                    if self.settings.max_samples > 0 and response_length > self.settings.max_samples:
+                        loop = False
+                        break
+
+                    if sample_idx < self.llm.n_tokens and token != self.llm._input_ids[sample_idx]:
+                        self.llm.n_tokens = sample_idx
+                        self.llm._ctx.kv_cache_seq_rm(-1, self.llm.n_tokens, -1)
+                        break
+        finally:
+            self.latency.generated_tokens = response_length
+            self.latency.generation_seconds = time.perf_counter() - start_time
+            self._is_running = False
+
+    # several responses grown together in one batch, yields (branch index, sample)
+    def generate_branches(self, prompts: List[str]) -> Iterator[Tuple[int, SampleData]]:
+        if not self.llm or len(prompts) == 0:
+            return
+        generator = ParallelBranchGenerator(self.llm, self.settings, self.state_cache)
+        self._is_running = True
+        try:
+            for i_branch, i_sample in generator.generate(prompts):
+                yield i_branch, generator.branches[i_branch].trace.sample(i_sample)
+                if not self._is_running:
+                    generator.stop()
+        finally:
+            self.latency = generator.latency
+            self._is_running = False
+
+    async def agenerate(self, prompt: str) -> AsyncIterator[SampleData]:
+        loop = asyncio.get_running_loop()
+        samples = self.generate(prompt)
+        try:
+            while True:
+                sample_data = await loop.run_in_executor(None, next, samples, None)
+                if sample_data is None:
+                    break
+                yield sample_data
+        finally:
+            # stop the generator on the executor as well, it may be mid decode
+            self.stop()
+            await loop.run_in_executor(None, samples.close)
@@ -1,41 +1,330 @@
-import llama_cpp
 from llama_cpp._internals import _LlamaTokenDataArray
+import numpy as np
+import time
 
-from typing import List, Tuple
-from PySide6.QtCore import QThread, Signal, QMutex, QMutexLocker
+from typing import Callable, Dict, List, Optional, Tuple
 from util.serializable import ISerializable
+from util.growable_array import GrowableArray
+from branch_state_cache import BranchStateCache
+from llm_metrics import UncertaintyMetrics, TokenUncertainty, rolling_mean
+
+class ResponseTrace:
+    # columnar store for every sample of a response, one row per token in the per token columns
+    # and a flat candidate buffer addressed by candidate_offsets/candidate_counts. All columns are
+    # growable numpy arrays, so appending a token never copies the whole trace and bulk queries
+    # are plain vectorized slices, e.g. trace.p or np.flatnonzero(trace.candidate_counts > 5)
+    def __init__(self, capacity: int = 256):
+        # per token, 44 bytes here and 36 in the uncertainty columns below, 80 before candidates and text
+        self._token_ids = GrowableArray(np.intc, capacity)
+        self._token_indices = GrowableArray(np.int32, capacity)
+        self._logits = GrowableArray(np.single, capacity)
+        self._p = GrowableArray(np.single, capacity)
+        self._candidate_counts = GrowableArray(np.int32, capacity)
+        self._candidate_offsets = GrowableArray(np.int64, capacity)
+        self._raw_offsets = GrowableArray(np.int64, capacity + 1)
+        self._text_offsets = GrowableArray(np.int64, capacity + 1)
+        # flat candidate buffers
+        self._candidate_ids = GrowableArray(np.intc, capacity * 8)
+        self._candidate_logits = GrowableArray(np.single, capacity * 8)
+        self._candidate_p = GrowableArray(np.single, capacity * 8)
+        # optional top N raw logits from before the sampler chain
+        self._raw_top_ids = GrowableArray(np.intc, 1)
+        self._raw_top_logits = GrowableArray(np.float16, 1)
+        # utf-8 bytes of the decoded tokens, token i is _text[_text_offsets[i]:_text_offsets[i+1]]
+        self._text = GrowableArray(np.uint8, capacity * 4)
+        # per token uncertainty (20 bytes, 16 more for the cumsums), computed as the sample is appended
+        self._metrics = UncertaintyMetrics()
+        self._entropy = GrowableArray(np.single, capacity)
+        self._varentropy = GrowableArray(np.single, capacity)
+        self._margin = GrowableArray(np.single, capacity)
+        self._effective_count = GrowableArray(np.single, capacity)
+        self._surprisal = GrowableArray(np.single, capacity)
+        # cumulative sums with a leading 0, any rolling window mean is a difference of two entries
+        self._entropy_cumsum = GrowableArray(np.float64, capacity + 1)
+        self._surprisal_cumsum = GrowableArray(np.float64, capacity + 1)
+        self._raw_offsets.append(0)
+        self._text_offsets.append(0)
+        self._entropy_cumsum.append(0.0)
+        self._surprisal_cumsum.append(0.0)
+
+    def __len__(self) -> int:
+        return len(self._token_ids)
+
+    def append(self, token: int, decoded_token: bytes, token_data_array:_LlamaTokenDataArray,
+               raw_logits: Optional[np.ndarray] = None, raw_top_n: int = 0) -> int:
+        # only the first candidates.size entries survived the sampler chain
+        size = token_data_array.candidates.size
+        candidates = token_data_array.candidates_data[:size]
+        return self.append_candidates(token, decoded_token, candidates.id, candidates.logit, candidates.p,
+                                      raw_logits=raw_logits, raw_top_n=raw_top_n)
+
+    def append_candidates(self, token: int, decoded_token: bytes,
+                          candidate_ids: np.ndarray, candidate_logits: np.ndarray, candidate_p: np.ndarray,
+                          raw_logits: Optional[np.ndarray] = None, raw_top_n: int = 0) -> int:
+        matches = np.flatnonzero(candidate_ids == token)
+        token_index = int(matches[0]) if matches.size > 0 else -1
+
+        self._candidate_offsets.append(len(self._candidate_ids))
+        self._candidate_counts.append(candidate_ids.size)
+        self._candidate_ids.extend(candidate_ids)
+        self._candidate_logits.extend(candidate_logits)
+        self._candidate_p.extend(candidate_p)
+
+        if raw_logits is not None and raw_top_n > 0:
+            raw_top_ids, raw_top_logits = top_n_logits(raw_logits, raw_top_n)
+            self._raw_top_ids.extend(raw_top_ids)
+            self._raw_top_logits.extend(raw_top_logits)
+        self._raw_offsets.append(len(self._raw_top_ids))
+
+        self._text.extend(np.frombuffer(decoded_token, dtype=np.uint8))
+        self._text_offsets.append(len(self._text))
+
+        self._token_indices.append(token_index)
+        self._logits.append(candidate_logits[token_index] if token_index >= 0 else np.nan)
+        self._p.append(candidate_p[token_index] if token_index >= 0 else np.nan)
+
+        uncertainty = self._metrics.compute(candidate_logits, token_index)
+        self._entropy.append(uncertainty.entropy)
+        self._varentropy.append(uncertainty.varentropy)
+        self._margin.append(uncertainty.margin)
+        self._effective_count.append(uncertainty.effective_count)
+        self._surprisal.append(uncertainty.surprisal)
+        self._entropy_cumsum.append(self._entropy_cumsum[-1] + np.nan_to_num(uncertainty.entropy))
+        self._surprisal_cumsum.append(self._surprisal_cumsum[-1] + np.nan_to_num(uncertainty.surprisal))
+        # the token id goes last, len(trace) only grows once the row is complete
+        self._token_ids.append(token)
+        return len(self) - 1
+
+    # column views, no copies
+    @property
+    def token_ids(self) -> np.ndarray:
+        return self._token_ids.values[:len(self)]
+
+    @property
+    def token_indices(self) -> np.ndarray:
+        return self._token_indices.values[:len(self)]
+
+    @property
+    def logits(self) -> np.ndarray:
+        return self._logits.values[:len(self)]
+
+    @property
+    def p(self) -> np.ndarray:
+        return self._p.values[:len(self)]
+
+    @property
+    def candidate_counts(self) -> np.ndarray:
+        return self._candidate_counts.values[:len(self)]
+
+    @property
+    def candidate_offsets(self) -> np.ndarray:
+        return self._candidate_offsets.values[:len(self)]
+
+    @property
+    def text_offsets(self) -> np.ndarray:
+        return self._text_offsets.values[:len(self) + 1]
+
+    @property
+    def entropy(self) -> np.ndarray:
+        return self._entropy.values[:len(self)]
+
+    @property
+    def varentropy(self) -> np.ndarray:
+        return self._varentropy.values[:len(self)]
+
+    @property
+    def margin(self) -> np.ndarray:
+        return self._margin.values[:len(self)]
+
+    @property
+    def effective_count(self) -> np.ndarray:
+        return self._effective_count.values[:len(self)]
+
+    @property
+    def surprisal(self) -> np.ndarray:
+        return self._surprisal.values[:len(self)]
+
+    # rolling window means over the response, one per token
+    def rolling_entropy(self, window: int) -> np.ndarray:
+        return rolling_mean(self._entropy_cumsum.values[:len(self) + 1], window)
+
+    def rolling_surprisal(self, window: int) -> np.ndarray:
+        return rolling_mean(self._surprisal_cumsum.values[:len(self) + 1], window)
+
+    # the same means for the window ending at sample i, O(1)
+    def rolling_entropy_at(self, i: int, window: int) -> float:
+        return self._window_mean(self._entropy_cumsum, i, window)
+
+    def rolling_surprisal_at(self, i: int, window: int) -> float:
+        return self._window_mean(self._surprisal_cumsum, i, window)
+
+    def _window_mean(self, cumsum: GrowableArray, i: int, window: int) -> float:
+        start = max(0, i + 1 - max(1, window))
+        return float((cumsum[i + 1] - cumsum[start]) / (i + 1 - start))
+
+    def uncertainty(self, i: int) -> TokenUncertainty:
+        return TokenUncertainty(float(self._entropy[i]), float(self._varentropy[i]), float(self._margin[i]),
+                                float(self._effective_count[i]), float(self._surprisal[i]))
+
+    # the flat candidate buffers of every sample
+    @property
+    def flat_candidate_ids(self) -> np.ndarray:
+        return self._candidate_ids.values
+
+    @property
+    def flat_candidate_logits(self) -> np.ndarray:
+        return self._candidate_logits.values
+
+    @property
+    def flat_candidate_p(self) -> np.ndarray:
+        return self._candidate_p.values
+
+    # candidates of sample i
+    def candidate_ids(self, i: int) -> np.ndarray:
+        start = self._candidate_offsets[i]
+        return self._candidate_ids.values[start:start + self._candidate_counts[i]]
+
+    def candidate_logits(self, i: int) -> np.ndarray:
+        start = self._candidate_offsets[i]
+        return self._candidate_logits.values[start:start + self._candidate_counts[i]]
+
+    def candidate_p(self, i: int) -> np.ndarray:
+        start = self._candidate_offsets[i]
+        return self._candidate_p.values[start:start + self._candidate_counts[i]]
+
+    def raw_top_ids(self, i: int) -> np.ndarray:
+        return self._raw_top_ids.values[self._raw_offsets[i]:self._raw_offsets[i + 1]]
+
+    def raw_top_logits(self, i: int) -> np.ndarray:
+        return self._raw_top_logits.values[self._raw_offsets[i]:self._raw_offsets[i + 1]]
+
+    def decoded_bytes(self, start: int, stop: int) -> bytes:
+        return self._text.values[self._text_offsets[start]:self._text_offsets[stop]].tobytes()
+
+    def decoded_token(self, i: int) -> str:
+        return self.decoded_bytes(i, i + 1).decode("utf-8", errors="replace")
+
+    def get_text(self, start: int = 0, stop: Optional[int] = None) -> str:
+        stop = len(self) if stop is None else stop
+        return self.decoded_bytes(start, stop).decode("utf-8", errors="replace")
+
+    def sample(self, i: int) -> "SampleData":
+        return SampleData(self, i)
+
+    def positions_with_candidates_over(self, count: int) -> np.ndarray:
+        return np.flatnonzero(self.candidate_counts > count)
+
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.__dict__.values() if isinstance(column, GrowableArray))
+
+    # the columns by name, no copies
+    def columns(self) -> Dict[str, np.ndarray]:
+        return {name[1:]: column.values for name, column in self.__dict__.items() if isinstance(column, GrowableArray)}
+
+    # trace over existing columns (e.g. memory mapped from a session file), nothing is copied until
+    # a sample is appended
+    @classmethod
+    def from_columns(cls, columns: Dict[str, np.ndarray]) -> "ResponseTrace":
+        trace = cls(capacity=1)
+        for name, values in columns.items():
+            if isinstance(getattr(trace, "_" + name, None), GrowableArray):
+                setattr(trace, "_" + name, GrowableArray.from_array(values))
+        return trace
 
 class SampleData:
+    # view onto one sample of a ResponseTrace
     # decoded_token decoded token from sample
-    # the index selected from the cadidate tokens for this response.
-    # the full response up until this sample
-    # token_data_array sample info a cadidates
-    def __init__(self, decoded_token: str, token_index: int, token_data_array:_LlamaTokenDataArray):
-        self.decoded_token = decoded_token
-        self.token_index:int = token_index
-        self.token_data_array:_LlamaTokenDataArray = token_data_array
+    # token_index the index selected from the cadidate tokens for this response.
+    def __init__(self, trace: ResponseTrace, sample_index: int):
+        self.trace:ResponseTrace = trace
+        self.sample_index:int = sample_index
+
+    @property
+    def decoded_token(self) -> str:
+        return self.trace.decoded_token(self.sample_index)
+
+    @property
+    def token(self) -> int:
+        return int(self.trace.token_ids[self.sample_index])
+
+    @property
+    def token_index(self) -> int:
+        return int(self.trace.token_indices[self.sample_index])
+
+    @property
+    def candidate_ids(self) -> np.ndarray:
+        return self.trace.candidate_ids(self.sample_index)
+
+    @property
+    def candidate_logits(self) -> np.ndarray:
+        return self.trace.candidate_logits(self.sample_index)
+
+    @property
+    def candidate_p(self) -> np.ndarray:
+        return self.trace.candidate_p(self.sample_index)
+
+    @property
+    def raw_top_ids(self) -> np.ndarray:
+        return self.trace.raw_top_ids(self.sample_index)
+
+    @property
+    def raw_top_logits(self) -> np.ndarray:
+        return self.trace.raw_top_logits(self.sample_index)
 
     def get_logit(self) -> float:
-        return self.token_data_array.candidates_data[self.token_index].logit
+        return float(self.trace.logits[self.sample_index])
     
     # could be softmax, but not necessarily
     def get_p(self) -> float:
-        return self.token_data_array.candidates_data[self.token_index].p  
+        return float(self.trace.p[self.sample_index])
 
     def get_candidate_count(self) -> int:
-        return self.token_data_array.candidates.size
+        return int(self.trace.candidate_counts[self.sample_index])
+
+    # uncertainty of the sample, computed on the generation thread
+    def get_uncertainty(self) -> TokenUncertainty:
+        return self.trace.uncertainty(self.sample_index)
+
+    def get_entropy(self) -> float:
+        return float(self.trace.entropy[self.sample_index])
+
+    def get_surprisal(self) -> float:
+        return float(self.trace.surprisal[self.sample_index])
+
+    def get_rolling_entropy(self, window: int = 16) -> float:
+        return self.trace.rolling_entropy_at(self.sample_index, window)
 
     def get_canidate_logit(self, i:int) -> float:
-        return self.token_data_array.candidates_data[i].logit
+        return float(self.candidate_logits[i])
 
     def get_canidate_p(self, i:int) -> float:
-        return self.token_data_array.candidates_data[i].p
+        return float(self.candidate_p[i])
+
+    def get_canidate_decodedtoken(self, i:int, llm) -> str:
+        return llm._model.vocab().text[self.candidate_ids[i]]
+
+    # "token,p,logit" for every candidate, for the alternatives combo. Without a model (e.g. a session
+    # opened before loading one) tokens are shown by id
+    def get_candidate_labels(self, llm, format_token: Callable[[str], str] = str.strip) -> List[str]:
+        text = llm._model.vocab().text if llm is not None else None
+        return [f"{format_token(text[token]) if text is not None else token},{p:.2f},{logit:.2f}"
+                for token, p, logit in zip(self.candidate_ids.tolist(), self.candidate_p.tolist(), self.candidate_logits.tolist())]
+
+    # the label of candidate i alone, for views that build rows on demand
+    def get_candidate_label(self, i: int, llm, format_token: Callable[[str], str] = str.strip) -> str:
+        token = int(self.candidate_ids[i])
+        return (f"{format_token(llm._model.vocab().text[token]) if llm is not None else token},"
+                f"{self.get_canidate_p(i):.2f},{self.get_canidate_logit(i):.2f}")
+
+    def get_raw_top_count(self) -> int:
+        return self.raw_top_ids.size
 
-    def get_canidate_decodedtoken(self, i:int, llm) -> float:
-        candidate_token = self.token_data_array.candidates_data.id[i]
-        detokenized = llm.detokenize([candidate_token])
-        decoded = detokenized.decode("utf-8")    
-        return decoded
+# top n (ids, fp16 logits) of a full vocab logits row, highest first
+def top_n_logits(logits: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    n = min(n, logits.size)
+    top = np.argpartition(logits, -n)[-n:]
+    top = top[np.argsort(logits[top])[::-1]]
+    return top.astype(np.intc), logits[top].astype(np.float16)
 
 class SampleSettings(ISerializable):
     def __init__(self):  
@@ -53,111 +342,81 @@ class SampleSettings(ISerializable):
         self.mirostat_eta: float = 0.1
         self.mirostat_tau: float = 5.0
         self.penalize_nl: bool = True
+        self.raw_top_n: int = 0 # keep the top N raw logits (fp16) from before the sampler chain, 0 to disable
 
-class ResponseGeneratorThread(QThread):
-    new_data_signal = Signal(SampleData, str)
-    end_of_response = Signal()
+# length of the common token prefix of a and b
+def longest_common_prefix(a: np.ndarray, b: List[int]) -> int:
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = np.flatnonzero(np.asarray(a[:n]) != np.asarray(b[:n], dtype=np.intc))
+    return int(mismatch[0]) if mismatch.size > 0 else n
 
+class BranchLatency:
+    # counters for one response, how much of the prompt came from the kv cache vs. was recomputed
     def __init__(self):
-        super().__init__()
-        self._is_running = False
-        self.llm = None
-        self.settings:SampleSettings = SampleSettings()
-        self.prompt =""
-        self.response_data = []
-        self.response_text = ""
-        self.mutex = QMutex()  # Create a mutex for thread synchronization
-
-    def load_model(self, model_path) -> str:
-        result = ""
-        if not self._is_running:
-            try:
-                self.llm = llama_cpp.Llama(model_path=model_path, n_gpu_layers=-1)
-                result = "Model loaded successfully."
-            except Exception as e:
-                result = f"Error loading model: {str(e)}"
-        else:
-            result = "load aborted, model in use"                
-        return result        
-
-    # thread entry point
-    def run(self):    
-        if self.llm and len(self.prompt) > 0:
-            self._is_running = True
-            self.response_text = ""
-            response_length = 0
-            loop = True
-            prompt_tokens = self.llm.tokenize(self.prompt.encode())
-            sample_idx = self.llm.n_tokens + len(prompt_tokens) - 1            
-            while self._is_running and loop:
-                self.llm.eval(prompt_tokens)
-                while sample_idx < self.llm.n_tokens:
-                    token = self.llm.sample(idx=sample_idx,
-                                            top_k = self.settings.top_k,
-                                            top_p = self.settings.top_p,
-                                            min_p = self.settings.min_p,
-                                            typical_p = self.settings.typical_p,
-                                            temp = self.settings.temp,
-                                            repeat_penalty = self.settings.repeat_penalty,
-                                            frequency_penalty = self.settings.frequency_penalty,
-                                            presence_penalty = self.settings.presence_penalty,
-                                            tfs_z = self.settings.tfs_z,
-                                            mirostat_mode = self.settings.mirostat_mode,
-                                            mirostat_eta = self.settings.mirostat_eta,
-                                            mirostat_tau = self.settings.mirostat_tau,
-                                            penalize_nl = self.settings.penalize_nl,                                            
-                                            )
-
-                    loop = not llama_cpp.llama_token_is_eog(self.llm._model.model, token)
-
-                    #tokens_or_none = yield token
-                    tokens_or_none = token
-                    prompt_tokens.clear()
-                    prompt_tokens.append(token)
-
-                    # Ensure thread-safe access to data
-                    with QMutexLocker(self.mutex):
-                        detokenized = self.llm.detokenize([tokens_or_none])
-                        response_token_decoded = detokenized.decode("utf-8")
-                        self.response_text += response_token_decoded
-
-                        # find the index of the selected token
-                        selected_token_index = -1
-                        for i in range(self.llm.token_data_array.candidates.size):  
-                            candidate_data = self.llm.token_data_array.candidates_data
-                            candidate_token = candidate_data.id[i]
-                            if token == candidate_token:
-                                selected_token_index = i
-
-                        sample_data = SampleData(response_token_decoded, selected_token_index, self.llm.token_data_array)
-                        self.response_data.append(sample_data)
-                        
-                        self.new_data_signal.emit(sample_data, response_token_decoded)
-
-                    #
-                    sample_idx += 1
-                    response_length += 1
-
-                    if self.settings.max_samples > 0 and response_length > self.settings.max_samples:
-                        loop = False
-                        break
-
-                    if sample_idx < self.llm.n_tokens and token != self.llm._input_ids[sample_idx]:
-                        self.llm.n_tokens = sample_idx
-                        self._ctx.kv_cache_seq_rm(-1, self.llm.n_tokens, -1)
-                        break
-
-            self.end_of_response.emit()
-
-    def stop(self):
-        self._is_running = False
-
-    def get_response_data(self):#
-        # Ensure thread-safe access to data
-        with QMutexLocker(self.mutex):
-            return self.response_data.copy()
-        
-    def get_response_text(self):
-        # Ensure thread-safe access to data
-        with QMutexLocker(self.mutex):
-            return self.response_text
\ No newline at end of file
+        self.prompt_tokens: int = 0
+        self.reused_tokens: int = 0
+        self.restored_tokens: int = 0 # part of reused_tokens that came from a branch snapshot
+        self.restore_seconds: float = 0.0
+        self.evaluated_tokens: int = 0
+        self.prompt_eval_seconds: float = 0.0
+        self.generated_tokens: int = 0
+        self.generation_seconds: float = 0.0
+
+    def __str__(self):
+        tokens_per_second = self.generated_tokens / self.generation_seconds if self.generation_seconds > 0 else 0.0
+        return (f"prompt {self.prompt_tokens} tokens: {self.reused_tokens} reused "
+                f"({self.restored_tokens} restored in {self.restore_seconds * 1000:.0f} ms), {self.evaluated_tokens} evaluated "
+                f"in {self.prompt_eval_seconds * 1000:.0f} ms | generated {self.generated_tokens} tokens, {tokens_per_second:.1f} t/s")
+
+# rewind sequence 0 of the model to the longest prefix of tokens it already has in the kv cache,
+# restoring an explored branch from the state cache if that shares more. Unless keep_last is False at
+# least one token is left to eval so there are fresh logits to sample from. Returns the prefix length.
+def rewind_to_prefix(llm, tokens: List[int], state_cache: Optional[BranchStateCache], latency: BranchLatency,
+                     keep_last: bool = True) -> int:
+    prefix = longest_common_prefix(llm._input_ids, tokens)
+
+    if state_cache is not None:
+        start_time = time.perf_counter()
+        # the live branch is about to be trimmed, snapshot it so switching back is instant
+        if prefix < llm.n_tokens:
+            state_cache.save(llm)
+        # resume from an earlier branch if it shares more of the prompt than the live one
+        restored = state_cache.restore(llm, tokens, min_prefix=prefix)
+        if restored > prefix:
+            latency.restored_tokens = restored
+            prefix = restored
+        latency.restore_seconds = time.perf_counter() - start_time
+
+    if keep_last:
+        prefix = min(prefix, len(tokens) - 1)
+    llm.n_tokens = prefix
+    llm._ctx.kv_cache_seq_rm(-1, prefix, -1)
+
+    latency.prompt_tokens = len(tokens)
+    latency.reused_tokens = prefix
+    latency.evaluated_tokens = len(tokens) - prefix
+    return prefix
+
+class SampleBatcher:
+    # collects samples on the generation thread and hands them to emit as one list at most frame_rate
+    # times a second, so the GUI applies a whole batch per repaint instead of handling an event per token.
+    # Entries are (stream index, SampleData), the stream index tells parallel branches apart
+    def __init__(self, emit: Callable[[list], None], frame_rate: float = 30.0):
+        self.emit = emit
+        self.interval = 1.0 / frame_rate if frame_rate > 0 else 0.0
+        self.samples: List[Tuple[int, SampleData]] = []
+        self._last_flush = 0.0
+
+    def add(self, stream_index: int, sample_data: SampleData):
+        self.samples.append((stream_index, sample_data))
+        if time.perf_counter() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.samples) > 0:
+            samples = self.samples
+            self.samples = []
+            self.emit(samples)
+        self._last_flush = time.perf_counter()
@@ -0,0 +1,160 @@
+import numpy as np
+
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from llama_cpp._internals import _LlamaSeqIdPool
+from llm_generator import BranchLatency, longest_common_prefix, rewind_to_prefix
+from branch_state_cache import BranchStateCache
+
+# the logits after the last token of each token list. The prefix all of them share is evaluated once on
+# sequence 0, the rest of each list goes into its own sequence (a copy of sequence 0, the cells are
+# shared) and the lists are packed into n_batch sized batches, logits are only computed for last tokens
+def final_logits(llm, token_lists: List[List[int]], state_cache: Optional[BranchStateCache] = None) -> np.ndarray:
+    n_vocab = llm.n_vocab()
+    logits = np.empty((len(token_lists), n_vocab), dtype=np.single)
+    if len(token_lists) == 0:
+        return logits
+    first = np.asarray(token_lists[0], dtype=np.intc)
+    common = min(len(tokens) for tokens in token_lists) - 1
+    for tokens in token_lists[1:]:
+        common = min(common, longest_common_prefix(first, tokens))
+    common = max(common, 0)
+    seq_ids = _LlamaSeqIdPool(llm._ctx, llm.n_batch)
+    shared = list(token_lists[0][:common])
+    prefix = rewind_to_prefix(llm, shared, state_cache, BranchLatency(), keep_last=False)
+    if prefix < common:
+        llm.eval(shared[prefix:])
+
+    rows: List[Tuple[int, int]] = [] # (batch row, token list)
+
+    def flush():
+        if llm._batch.n_tokens() > 0:
+            llm._ctx.decode(llm._batch)
+            for row, i in rows:
+                logits[i, :] = np.ctypeslib.as_array(llm._ctx.get_logits_ith(row), shape=(n_vocab,))
+        seq_ids.release()
+        rows.clear()
+        llm._batch.reset()
+
+    llm._batch.reset()
+    for i, tokens in enumerate(token_lists):
+        # the batch is decoded early when the context runs out of sequences
+        if seq_ids.is_empty():
+            flush()
+        seq_id = seq_ids.take()
+        if common > 0:
+            llm._ctx.kv_cache_seq_cp(0, seq_id, 0, common)
+        for pos in range(common, len(tokens)):
+            is_last = pos == len(tokens) - 1
+            if is_last:
+                rows.append((llm._batch.n_tokens(), i))
+            llm._batch.add_token(tokens[pos], pos, [seq_id], is_last)
+            if is_last:
+                seq_ids.finish(seq_id)
+            if llm._batch.n_tokens() == llm.n_batch:
+                flush()
+    flush()
+    return logits
+
+class JudgeResult(NamedTuple):
+    probs: np.ndarray       # probability of each candidate being picked, calibrated if the judge calibrates
+    raw_probs: np.ndarray   # the label distribution as read off the logits, renormalized over the labels
+    label_mass: float       # share of the full distribution on the label tokens, low means the model
+                            # wanted to answer with something other than a number
+
+class LogitJudge:
+    # LLM as a judge without generating, the question and the numbered candidates go through the
+    # model's chat formatter and the judgement is the model's distribution over the label tokens
+    # "1".."N" right after the prompt, one prefill per judgement. Many judgements are prefilled together
+    # in one batch over sequence ids. With calibrate the label bias of the prompt is measured on a
+    # content free version of it (every candidate "N/A") and divided out, so a model that likes
+    # answering "1" does not favor the first candidate
+
+    # labels from "10" up are several tokens in most vocabularies and start with the label "1", so
+    # a judgement is between at most 9 candidates
+    MAX_CANDIDATES = 9
+
+    def __init__(self, llm, state_cache: Optional[BranchStateCache] = None, calibrate: bool = True,
+                 instruction: str = "Which of these statements do you find most reasonable and accurate? Just provide the number.",
+                 max_candidates: int = MAX_CANDIDATES):
+        if not 1 <= max_candidates <= self.MAX_CANDIDATES:
+            raise ValueError(f"max_candidates must be 1..{self.MAX_CANDIDATES}, labels from 10 up are not single tokens")
+        self.max_candidates = max_candidates
+        self.llm = llm
+        self.state_cache = state_cache
+        self.calibrate = calibrate
+        self.instruction = instruction
+        self._label_ids: Optional[Dict[str, List[int]]] = None
+
+    # vocab ids of every token that reads as the label, with or without a leading space
+    def label_tokens(self, n: int) -> List[List[int]]:
+        if n > self.max_candidates:
+            raise ValueError(f"{n} candidates, a judgement is between at most {self.max_candidates}")
+        if self._label_ids is None:
+            self._label_ids = {}
+            for token, text in enumerate(self.llm._model.vocab().text):
+                label = text.strip()
+                if len(label) == 1 and label.isdigit():
+                    self._label_ids.setdefault(label, []).append(token)
+        labels = []
+        for i in range(n):
+            ids = self._label_ids.get(str(i + 1))
+            if not ids:
+                raise ValueError(f"label {i + 1} is not a single token of this model")
+            labels.append(ids)
+        return labels
+
+    def build_prompt(self, question: str, candidates: Sequence[str]) -> str:
+        lines = [question, ""]
+        for i, candidate in enumerate(candidates):
+            lines.append(f"{i + 1}){candidate.strip()}")
+        lines += ["", self.instruction]
+        return "\n".join(lines)
+
+    def tokenize(self, question: str, candidates: Sequence[str]) -> List[int]:
+        llm = self.llm
+        content = self.build_prompt(question, candidates)
+        formatter = llm.chat_formatter()
+        if formatter is None:
+            return llm.tokenize((content + "\n").encode())
+        result = formatter(messages=[{"role": "user", "content": content}])
+        return llm.tokenize(result.prompt.encode(), add_bos=not result.added_special, special=True)
+
+    # probabilities over the labels from the logits after the prompt, and the share of the full
+    # distribution on them
+    def _label_probs(self, logits: np.ndarray, labels: List[List[int]]) -> Tuple[np.ndarray, float]:
+        shifted = logits.astype(np.float64) - logits.max()
+        mass = np.array([np.exp(shifted[ids]).sum() for ids in labels])
+        total = np.exp(shifted).sum()
+        label_total = mass.sum()
+        if label_total <= 0:
+            return np.full(len(labels), 1.0 / len(labels)), 0.0
+        return mass / label_total, float(label_total / total)
+
+    def judge(self, question: str, candidates: Sequence[str]) -> JudgeResult:
+        return self.judge_many([(question, candidates)])[0]
+
+    # one judgement per (question, candidates), all prefilled in one batch
+    def judge_many(self, items: Sequence[Tuple[str, Sequence[str]]]) -> List[JudgeResult]:
+        labels = [self.label_tokens(len(candidates)) for _, candidates in items]
+        token_lists = [self.tokenize(question, candidates) for question, candidates in items]
+        # one content free prompt per question and candidate count
+        content_free: Dict[Tuple[str, int], int] = {}
+        if self.calibrate:
+            for question, candidates in items:
+                key = (question, len(candidates))
+                if key not in content_free:
+                    content_free[key] = len(token_lists)
+                    token_lists.append(self.tokenize(question, ["N/A"] * len(candidates)))
+        logits = final_logits(self.llm, token_lists, self.state_cache)
+
+        results = []
+        for i, (question, candidates) in enumerate(items):
+            raw_probs, label_mass = self._label_probs(logits[i], labels[i])
+            probs = raw_probs
+            if self.calibrate:
+                prior, _ = self._label_probs(logits[content_free[(question, len(candidates))]], labels[i])
+                probs = raw_probs / np.maximum(prior, 1e-12)
+                probs /= probs.sum()
+            results.append(JudgeResult(probs.astype(np.single), raw_probs.astype(np.single), label_mass))
+        return results
@@ -0,0 +1,80 @@
+import numpy as np
+
+from typing import NamedTuple
+
+# log p floor, keeps masked (-inf) candidates finite so 0 * log p stays 0 instead of nan
+LOG_P_FLOOR = -1.0e4
+
+class TokenUncertainty(NamedTuple):
+    entropy: float          # nats, of the distribution over the surviving candidates
+    varentropy: float       # variance of the surprisal around the entropy
+    margin: float           # p of the most likely candidate minus p of the second one
+    effective_count: float  # exp(entropy), how many equally likely candidates the distribution is worth
+    surprisal: float        # -log p of the selected token
+
+NO_UNCERTAINTY = TokenUncertainty(np.nan, np.nan, np.nan, np.nan, np.nan)
+
+class UncertaintyMetrics:
+    # per token uncertainty of a sample from the logits of its candidates. The softmax is recomputed
+    # from the logits (they already carry the temperature), in float64 scratch buffers that are reused
+    # for every token, so a token costs a few passes over its candidates and no allocations
+    def __init__(self, capacity: int = 64):
+        self._p = np.empty(capacity, dtype=np.float64)
+        self._log_p = np.empty(capacity, dtype=np.float64)
+        self._scratch = np.empty(capacity, dtype=np.float64)
+
+    def _reserve(self, n: int):
+        if n <= self._p.size:
+            return
+        capacity = self._p.size
+        while capacity < n:
+            capacity *= 2
+        self._p = np.empty(capacity, dtype=np.float64)
+        self._log_p = np.empty(capacity, dtype=np.float64)
+        self._scratch = np.empty(capacity, dtype=np.float64)
+
+    def compute(self, candidate_logits: np.ndarray, token_index: int) -> TokenUncertainty:
+        n = candidate_logits.size
+        if n == 0:
+            return NO_UNCERTAINTY
+        self._reserve(n)
+        p = self._p[:n]
+        log_p = self._log_p[:n]
+        scratch = self._scratch[:n]
+
+        # log softmax
+        np.subtract(candidate_logits, candidate_logits.max(), out=log_p)
+        np.maximum(log_p, LOG_P_FLOOR, out=log_p)
+        np.exp(log_p, out=p)
+        total = p.sum()
+        p /= total
+        log_p -= np.log(total)
+
+        np.multiply(p, log_p, out=scratch)
+        entropy = -scratch.sum()
+        np.add(log_p, entropy, out=scratch)
+        np.square(scratch, out=scratch)
+        scratch *= p
+        varentropy = scratch.sum()
+
+        surprisal = -log_p[token_index] if 0 <= token_index < n else np.nan
+
+        i_top = int(p.argmax())
+        p_top = p[i_top]
+        if n > 1:
+            p[i_top] = -1.0
+            margin = p_top - p.max()
+        else:
+            margin = p_top
+        return TokenUncertainty(float(entropy), float(varentropy), float(margin), float(np.exp(entropy)),
+                                float(surprisal))
+
+# mean of the last window values ending at every position, from the cumulative sums (with a leading 0)
+def rolling_mean(cumsum: np.ndarray, window: int) -> np.ndarray:
+    n = cumsum.size - 1
+    if n <= 0:
+        return np.empty(0, dtype=np.float64)
+    window = max(1, window)
+    stop = np.arange(1, n + 1)
+    start = np.maximum(stop - window, 0)
+    return (cumsum[stop] - cumsum[start]) / (stop - start)
@@ -0,0 +1,167 @@
+import ctypes
+import time
+from llama_cpp._internals import _LlamaSamplingContext, _LlamaSamplingParams
+import numpy as np
+
+from typing import Iterator, List, Optional, Tuple
+
+from llm_generator import (ResponseTrace, SampleSettings, BranchLatency,
+                           longest_common_prefix, rewind_to_prefix)
+from branch_state_cache import BranchStateCache
+
+# sampler chain state for one sequence, prev is the token history used for the repeat penalties
+def make_sampling_context(llm, settings: SampleSettings, prev: List[int]) -> _LlamaSamplingContext:
+    params = _LlamaSamplingParams(top_k=settings.top_k,
+                                  top_p=settings.top_p,
+                                  min_p=settings.min_p,
+                                  tfs_z=settings.tfs_z,
+                                  typical_p=settings.typical_p,
+                                  temp=settings.temp,
+                                  penalty_last_n=llm.last_n_tokens_size,
+                                  penalty_repeat=settings.repeat_penalty,
+                                  penalty_freq=settings.frequency_penalty,
+                                  penalty_present=settings.presence_penalty,
+                                  mirostat=settings.mirostat_mode,
+                                  mirostat_tau=settings.mirostat_tau,
+                                  mirostat_eta=settings.mirostat_eta,
+                                  penalize_nl=settings.penalize_nl)
+    return _LlamaSamplingContext(params=params,
+                                 mirostat_mu=ctypes.c_float(2.0 * settings.mirostat_tau),
+                                 prev=list(prev))
+
+class Branch:
+    # one sequence of a parallel generation
+    # tokens are the tokens evaluated into the sequence's kv cells, the prompt plus what was generated so far
+    def __init__(self, seq_id: int, tokens: List[int], sampling_context: _LlamaSamplingContext):
+        self.seq_id = seq_id
+        self.tokens: List[int] = tokens
+        self.sampling_context = sampling_context
+        self.trace = ResponseTrace()
+        self.done = False
+
+class ParallelBranchGenerator:
+    # grows several branches that share a prompt prefix together. The shared prefix is evaluated once
+    # on sequence 0 and copied to one sequence per branch with kv_cache_seq_cp (the cells are shared,
+    # not duplicated), then every step samples each branch and decodes the next token of all of them
+    # in a single llama_decode, so N branches cost close to one stream.
+    def __init__(self, llm, settings: SampleSettings, state_cache: Optional[BranchStateCache] = None):
+        self.llm = llm
+        self.settings = settings
+        self.state_cache = state_cache
+        self.branches: List[Branch] = []
+        # logits row each branch samples from next, valid for a branch while its sample is yielded
+        self.logits = np.empty((0, 0), dtype=np.single)
+        self.latency = BranchLatency()
+        self._is_running = False
+
+    def stop(self):
+        self._is_running = False
+
+    # yields (branch index, sample index into that branch's trace) as samples are taken
+    def generate(self, prompts: List[str]) -> Iterator[Tuple[int, int]]:
+        return self.generate_tokens([self.llm.tokenize(prompt.encode()) for prompt in prompts])
+
+    def generate_tokens(self, token_lists: List[List[int]]) -> Iterator[Tuple[int, int]]:
+        llm = self.llm
+        if len(token_lists) == 0:
+            return
+        if len(token_lists) > llm.n_batch:
+            raise ValueError(f"Requested branches ({len(token_lists)}) exceed batch size of {llm.n_batch}")
+        # sequence 0 holds the shared prefix, the branches take sequences 1..n
+        if len(token_lists) >= llm.n_seq_max():
+            raise ValueError(f"Requested branches ({len(token_lists)}) need {len(token_lists) + 1} sequences, the context has n_seq_max={llm.n_seq_max()}")
+        self._is_running = True
+        self.latency = BranchLatency()
+        start_time = time.perf_counter()
+
+        # shared prefix of every branch, each branch keeps at least one token of its own to get logits from
+        first = np.asarray(token_lists[0], dtype=np.intc)
+        common = min(len(tokens) for tokens in token_lists) - 1
+        for tokens in token_lists[1:]:
+            common = min(common, longest_common_prefix(first, tokens))
+        common = max(common, 0)
+
+        # sequence 0 holds the shared prefix
+        shared = list(token_lists[0][:common])
+        prefix = rewind_to_prefix(llm, shared, self.state_cache, self.latency, keep_last=False)
+        if prefix < common:
+            llm.eval(shared[prefix:])
+
+        self.branches = []
+        for i, tokens in enumerate(token_lists):
+            branch = Branch(i + 1, list(tokens), make_sampling_context(llm, self.settings, tokens))
+            llm._ctx.kv_cache_seq_rm(branch.seq_id, -1, -1)
+            if common > 0:
+                llm._ctx.kv_cache_seq_cp(0, branch.seq_id, 0, common)
+            self.branches.append(branch)
+
+        self.logits = logits = np.empty((len(self.branches), llm.n_vocab()), dtype=np.single)
+        completed = False
+        try:
+            self._prefill(common, logits)
+            self.latency.evaluated_tokens += sum(len(branch.tokens) - common for branch in self.branches)
+            self.latency.prompt_eval_seconds = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+
+            active = list(range(len(self.branches)))
+            while self._is_running and len(active) > 0:
+                rows = []
+                llm._batch.reset()
+                for i_branch in list(active):
+                    branch = self.branches[i_branch]
+                    context = branch.sampling_context
+                    token = context.sample(llm._ctx, logits_array=logits[i_branch])
+                    context.accept(llm._ctx, token, apply_grammar=False)
+
+                    i_sample = branch.trace.append(token, llm.detokenize([token]), context.get_token_data_array(),
+                                                   raw_logits=logits[i_branch], raw_top_n=self.settings.raw_top_n)
+                    self.latency.generated_tokens += 1
+                    yield i_branch, i_sample
+
+                    if (llm._model.vocab().is_eog[token]
+                            or (self.settings.max_samples > 0 and len(branch.trace) > self.settings.max_samples)
+                            or len(branch.tokens) >= llm._n_ctx):
+                        branch.done = True
+                        active.remove(i_branch)
+                        continue
+
+                    rows.append((llm._batch.n_tokens(), i_branch))
+                    llm._batch.add_token(token, len(branch.tokens), [branch.seq_id], True)
+                    branch.tokens.append(token)
+
+                if len(rows) > 0:
+                    self._decode(rows, logits)
+            completed = True
+        finally:
+            for branch in self.branches:
+                if completed and self.state_cache is not None:
+                    self.state_cache.save(llm, branch.seq_id, tokens=branch.tokens)
+                llm._ctx.kv_cache_seq_rm(branch.seq_id, -1, -1)
+            self.latency.generation_seconds = time.perf_counter() - start_time
+            self._is_running = False
+
+    # evaluate the tokens of each branch after the shared prefix, n_batch tokens per decode
+    def _prefill(self, common: int, logits: np.ndarray):
+        llm = self.llm
+        rows = []
+        llm._batch.reset()
+        for i_branch, branch in enumerate(self.branches):
+            for pos in range(common, len(branch.tokens)):
+                is_last = pos == len(branch.tokens) - 1
+                if is_last:
+                    rows.append((llm._batch.n_tokens(), i_branch))
+                llm._batch.add_token(branch.tokens[pos], pos, [branch.seq_id], is_last)
+                if llm._batch.n_tokens() == llm.n_batch:
+                    self._decode(rows, logits)
+                    rows = []
+        if llm._batch.n_tokens() > 0:
+            self._decode(rows, logits)
+
+    # decode the batch and copy out the logits rows of each branch before the next decode overwrites them
+    def _decode(self, rows: List[Tuple[int, int]], logits: np.ndarray):
+        llm = self.llm
+        llm._ctx.decode(llm._batch)
+        n_vocab = logits.shape[1]
+        for row, i_branch in rows:
+            logits[i_branch, :] = np.ctypeslib.as_array(llm._ctx.get_logits_ith(row), shape=(n_vocab,))
+        llm._batch.reset()
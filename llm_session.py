@@ -0,0 +1,84 @@
+import json
+import os
+import struct
+import zipfile
+import numpy as np
+
+from typing import Dict, List
+
+from llm_generator import ResponseTrace, SampleSettings
+from exploration_tree import ExplorationTree
+
+# An exploration session is an uncompressed .npz: one .npy member per tree/trace column plus a
+# "header" member holding a small json header (prompt, settings, lane order, ...). Members are stored,
+# not deflated, so opening a session memory maps the file and views every column in place, nothing
+# is read until it is touched, whatever the size of the session.
+SESSION_VERSION = 1
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+
+class Session:
+    def __init__(self, tree: ExplorationTree, settings: SampleSettings, chat_html: str = "", model_path: str = ""):
+        self.tree = tree
+        self.settings = settings
+        self.chat_html = chat_html
+        self.model_path = model_path
+
+def save_session(path: str, session: Session):
+    tree = session.tree
+    header = {"version": SESSION_VERSION,
+              "prompt": tree.prompt,
+              "lane_order": tree.lane_order,
+              "trace_count": len(tree.traces),
+              "settings": session.settings.to_dict(),
+              "chat_html": session.chat_html,
+              "model_path": session.model_path}
+    arrays: Dict[str, np.ndarray] = {"header": np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8)}
+    for name, values in tree.columns().items():
+        arrays[f"tree.{name}"] = values
+    for i, trace in enumerate(tree.traces):
+        for name, values in trace.columns().items():
+            arrays[f"trace{i}.{name}"] = values
+
+    # write next to the file and swap, the session being saved may be memory mapped from path
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
+
+# every member of an uncompressed npz as an array viewing a read only memory map of the file
+def map_npz(path: str) -> Dict[str, np.ndarray]:
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays: Dict[str, np.ndarray] = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path}: {info.filename} is compressed and cannot be memory mapped")
+            f.seek(info.header_offset)
+            local_header = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+            f.seek(info.header_offset + ZIP_LOCAL_HEADER.size + local_header[-2] + local_header[-1])
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+            count = int(np.prod(shape))
+            values = data[offset:offset + count * dtype.itemsize].view(dtype)
+            arrays[info.filename[:-len(".npy")]] = values.reshape(shape, order="F" if fortran_order else "C")
+    return arrays
+
+def load_session(path: str) -> Session:
+    arrays = map_npz(path)
+    header = json.loads(arrays["header"].tobytes().decode("utf-8"))
+    if header.get("version", 0) > SESSION_VERSION:
+        raise ValueError(f"{path}: session version {header['version']} is newer than {SESSION_VERSION}")
+
+    traces: List[ResponseTrace] = []
+    for i in range(header["trace_count"]):
+        prefix = f"trace{i}."
+        traces.append(ResponseTrace.from_columns({name[len(prefix):]: values for name, values in arrays.items()
+                                                  if name.startswith(prefix)}))
+    tree_columns = {name[len("tree."):]: values for name, values in arrays.items() if name.startswith("tree.")}
+    tree = ExplorationTree.from_columns(header["prompt"], tree_columns, traces, header["lane_order"])
+    settings = SampleSettings.from_dict(header["settings"])
+    return Session(tree, settings, header.get("chat_html", ""), header.get("model_path", ""))
@@ -0,0 +1,180 @@
+import copy
+import itertools
+import time
+import numpy as np
+
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from llm_generator import ResponseTrace, SampleSettings, BranchLatency, longest_common_prefix, rewind_to_prefix
+from llm_parallel import make_sampling_context
+from branch_state_cache import BranchStateCache
+
+# every combination of the given setting values on top of base, e.g. sweep_grid(base, temp=[0.2, 1.0], top_k=[10, 40])
+def sweep_grid(base: SampleSettings, **values: Sequence) -> List[SampleSettings]:
+    names = list(values.keys())
+    grid = []
+    for combination in itertools.product(*(values[name] for name in names)):
+        settings = copy.copy(base)
+        for name, value in zip(names, combination):
+            setattr(settings, name, value)
+        grid.append(settings)
+    return grid
+
+class LogitsTrie:
+    # raw logits of every position decoded so far, keyed by the response tokens that lead to it.
+    # Node 0 is the end of the prompt, a child per token sampled after it
+    def __init__(self):
+        self.children: List[Dict[int, int]] = [{}]
+        self.logits: List[Optional[np.ndarray]] = [None]
+
+    def __len__(self) -> int:
+        return len(self.logits)
+
+    def child(self, node: int, token: int) -> int:
+        return self.children[node].get(token, -1)
+
+    def add_child(self, node: int, token: int, logits: np.ndarray) -> int:
+        child = len(self.logits)
+        self.children.append({})
+        self.logits.append(logits)
+        self.children[node][token] = child
+        return child
+
+# candidate distribution difference of two samples, total variation distance over the union of their
+# candidates (a candidate missing from one side has p 0 there)
+def candidate_distance(ids_a: np.ndarray, p_a: np.ndarray, ids_b: np.ndarray, p_b: np.ndarray) -> float:
+    ids = np.union1d(ids_a, ids_b)
+    dense_a = np.zeros(ids.size, dtype=np.float64)
+    dense_b = np.zeros(ids.size, dtype=np.float64)
+    dense_a[np.searchsorted(ids, ids_a)] = p_a
+    dense_b[np.searchsorted(ids, ids_b)] = p_b
+    return 0.5 * float(np.abs(dense_a - dense_b).sum())
+
+class SweepResult:
+    def __init__(self, settings: SampleSettings):
+        self.settings = settings
+        self.trace = ResponseTrace()
+        self.tokens: List[int] = []
+        self.decoded_tokens = 0 # positions this setting had to llama_decode
+        self.replayed_tokens = 0 # positions replayed from the logits cache
+        self.diverged_at = -1 # first position whose token differs from the baseline, -1 if none
+        self.distances = np.empty(0, dtype=np.single) # candidate distance to the baseline per shared position
+
+    @property
+    def text(self) -> str:
+        return self.trace.get_text()
+
+    def summary(self) -> Dict:
+        trace = self.trace
+        counts = trace.candidate_counts
+        return {"settings": {name: value for name, value in self.settings.__dict__.items()},
+                "tokens": len(trace),
+                "decoded": self.decoded_tokens,
+                "replayed": self.replayed_tokens,
+                "mean_candidates": float(counts.mean()) if counts.size > 0 else 0.0,
+                "max_candidates": int(counts.max()) if counts.size > 0 else 0,
+                "mean_entropy": float(np.nanmean(trace.entropy)) if len(trace) > 0 else 0.0,
+                "diverged_at": self.diverged_at,
+                "mean_distance": float(self.distances.mean()) if self.distances.size > 0 else 0.0,
+                "text": self.text}
+
+class SamplingSweep:
+    # runs a grid of sampler settings over one prompt. The sampler chain is cheap next to llama_decode,
+    # so the raw logits of every decoded position are cached in a trie keyed by the sampled tokens, and a
+    # setting only decodes once it samples a token no earlier setting took from the same prefix. The
+    # model's sequence 0 follows whichever path was decoded last and is rewound to the shared prefix.
+    # Every setting starts from the same seed so the settings are the only difference between runs.
+    def __init__(self, llm, state_cache: Optional[BranchStateCache] = None, seed: int = 1234):
+        self.llm = llm
+        self.state_cache = state_cache
+        self.seed = seed
+        self.cache = LogitsTrie()
+        self.latency = BranchLatency()
+        self._prompt_tokens: List[int] = []
+        self._is_running = False
+
+    def stop(self):
+        self._is_running = False
+
+    def run(self, prompt: str, grid: List[SampleSettings]) -> List[SweepResult]:
+        return [result for result in self.generate(prompt, grid)]
+
+    # yields the result of each setting as it completes, the first setting is the baseline
+    def generate(self, prompt: str, grid: List[SampleSettings]) -> Iterator[SweepResult]:
+        llm = self.llm
+        self._is_running = True
+        self.latency = BranchLatency()
+        self._prompt_tokens = llm.tokenize(prompt.encode())
+        self.cache = LogitsTrie()
+        start_time = time.perf_counter()
+        prefix = rewind_to_prefix(llm, self._prompt_tokens, self.state_cache, self.latency)
+        llm.eval(self._prompt_tokens[prefix:])
+        self.cache.logits[0] = llm.logits_row(llm.n_tokens - 1).copy()
+        self.latency.prompt_eval_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        baseline: Optional[SweepResult] = None
+        for settings in grid:
+            if not self._is_running:
+                break
+            result = self._run_setting(settings)
+            if baseline is None:
+                baseline = result
+            else:
+                self._compare(baseline, result)
+            yield result
+        self.latency.generation_seconds = time.perf_counter() - start_time
+        self._is_running = False
+
+    def _run_setting(self, settings: SampleSettings) -> SweepResult:
+        llm = self.llm
+        result = SweepResult(settings)
+        context = make_sampling_context(llm, settings, self._prompt_tokens)
+        llm.set_seed(self.seed)
+        node = 0
+        while self._is_running:
+            logits = self.cache.logits[node]
+            token = context.sample(llm._ctx, logits_array=logits)
+            context.accept(llm._ctx, token, apply_grammar=False)
+            result.trace.append(token, llm.detokenize([token]), context.get_token_data_array(),
+                                raw_logits=logits, raw_top_n=settings.raw_top_n)
+            result.tokens.append(token)
+
+            if (llm._model.vocab().is_eog[token]
+                    or (settings.max_samples > 0 and len(result.tokens) > settings.max_samples)
+                    or len(self._prompt_tokens) + len(result.tokens) >= llm._n_ctx):
+                break
+
+            child = self.cache.child(node, token)
+            if child >= 0:
+                result.replayed_tokens += 1
+            else:
+                child = self.cache.add_child(node, token, self._decode(result.tokens))
+                result.decoded_tokens += 1
+            node = child
+        self.latency.generated_tokens += len(result.tokens)
+        self.latency.evaluated_tokens += result.decoded_tokens
+        return result
+
+    # logits after the prompt and response tokens, only the part not already in the kv cache is decoded
+    def _decode(self, response_tokens: List[int]) -> np.ndarray:
+        llm = self.llm
+        tokens = self._prompt_tokens + response_tokens
+        prefix = longest_common_prefix(llm._input_ids, tokens)
+        prefix = min(prefix, len(tokens) - 1)
+        llm.n_tokens = prefix
+        llm._ctx.kv_cache_seq_rm(-1, prefix, -1)
+        llm.eval(tokens[prefix:])
+        return llm.logits_row(llm.n_tokens - 1).copy()
+
+    # divergence point and per position candidate distance of result against the baseline, positions
+    # are compared while both responses share the same prefix (the same logits)
+    def _compare(self, baseline: SweepResult, result: SweepResult):
+        shared = longest_common_prefix(np.asarray(baseline.tokens, dtype=np.intc), result.tokens)
+        n = min(len(baseline.tokens), len(result.tokens))
+        result.diverged_at = shared if shared < n else -1
+        # the position where they diverge still had the same logits, only its sampled token differs
+        compared = min(shared + 1, n)
+        result.distances = np.array([candidate_distance(baseline.trace.candidate_ids(i), baseline.trace.candidate_p(i),
+                                                        result.trace.candidate_ids(i), result.trace.candidate_p(i))
+                                     for i in range(compared)], dtype=np.single)
@@ -0,0 +1,145 @@
+from typing import List, Optional
+from PySide6.QtCore import QThread, Signal
+
+from llm_generator import ResponseTrace, SampleSettings, BranchLatency, SampleBatcher
+from llm_engine import ExplorerEngine
+from llm_parallel import ParallelBranchGenerator
+from llm_best_of_n import BestOfNGenerator, BestOfNCandidate, make_selector
+from branch_state_cache import BranchStateCache
+
+# Qt adapters over the Qt free generators, each runs one generation on its own thread and hands the
+# samples to the GUI in batches at ui_frame_rate
+
+class ResponseGeneratorThread(QThread):
+    # list of (0, SampleData), batched at ui_frame_rate
+    new_samples_signal = Signal(list)
+    end_of_response = Signal()
+
+    def __init__(self, state_cache_bytes: int = (2 << 30)):
+        super().__init__()
+        self.engine = ExplorerEngine(state_cache_bytes=state_cache_bytes)
+        self.settings:SampleSettings = SampleSettings()
+        self.prompt =""
+        self.ui_frame_rate = 30.0 # samples reach the GUI in batches at most this many times a second
+
+    @property
+    def llm(self):
+        return self.engine.llm
+
+    @property
+    def state_cache(self) -> Optional[BranchStateCache]:
+        return self.engine.state_cache
+
+    @property
+    def latency(self) -> BranchLatency:
+        return self.engine.latency
+
+    def load_model(self, model_path) -> str:
+        try:
+            self.engine.load_model(model_path)
+            return "Model loaded successfully."
+        except RuntimeError as e:
+            return str(e)
+        except Exception as e:
+            return f"Error loading model: {str(e)}"
+
+    # thread entry point
+    def run(self):
+        self.engine.settings = self.settings
+        batcher = SampleBatcher(self.new_samples_signal.emit, self.ui_frame_rate)
+        for sample_data in self.engine.generate(self.prompt):
+            batcher.add(0, sample_data)
+        batcher.flush()
+        self.end_of_response.emit()
+
+    def stop(self):
+        self.engine.stop()
+
+    def get_response_data(self) -> ResponseTrace:#
+        # Ensure thread-safe access to data
+        with self.engine.lock:
+            return self.engine.trace
+
+    def get_response_text(self):
+        # Ensure thread-safe access to data
+        with self.engine.lock:
+            return self.engine.trace.get_text()
+
+class ParallelResponseGeneratorThread(QThread):
+    # list of (branch index, SampleData), batched at ui_frame_rate
+    new_samples_signal = Signal(list)
+    end_of_response = Signal()
+
+    def __init__(self, state_cache: Optional[BranchStateCache] = None):
+        super().__init__()
+        self.llm = None
+        self.settings:SampleSettings = SampleSettings()
+        self.state_cache = state_cache
+        self.prompts: List[str] = []
+        self.generator: Optional[ParallelBranchGenerator] = None
+        self.latency:BranchLatency = BranchLatency()
+        self.error = ""
+        self.ui_frame_rate = 30.0
+
+    # thread entry point
+    def run(self):
+        if self.llm and len(self.prompts) > 0:
+            self.error = ""
+            self.generator = ParallelBranchGenerator(self.llm, self.settings, self.state_cache)
+            batcher = SampleBatcher(self.new_samples_signal.emit, self.ui_frame_rate)
+            try:
+                for i_branch, i_sample in self.generator.generate(self.prompts):
+                    batcher.add(i_branch, self.generator.branches[i_branch].trace.sample(i_sample))
+            except (RuntimeError, ValueError) as e:
+                # e.g. the kv cache has no room left for all branches
+                self.error = str(e)
+            batcher.flush()
+            self.latency = self.generator.latency
+            self.end_of_response.emit()
+
+    def stop(self):
+        if self.generator is not None:
+            self.generator.stop()
+
+    def get_branch_traces(self) -> List[ResponseTrace]:
+        return [] if self.generator is None else [branch.trace for branch in self.generator.branches]
+
+class BestOfNThread(QThread):
+    # list of (candidate index, SampleData), batched at ui_frame_rate
+    new_samples_signal = Signal(list)
+    end_of_response = Signal()
+
+    def __init__(self, state_cache: Optional[BranchStateCache] = None):
+        super().__init__()
+        self.llm = None
+        self.settings:SampleSettings = SampleSettings()
+        self.state_cache = state_cache
+        self.prompt = ""
+        self.n = 4
+        self.selector_name = "mean logprob"
+        self.generator: Optional[BestOfNGenerator] = None
+        self.ranked: List[BestOfNCandidate] = []
+        self.error = ""
+        self.ui_frame_rate = 30.0
+
+    # thread entry point
+    def run(self):
+        if self.llm and len(self.prompt) > 0 and self.n > 0:
+            self.error = ""
+            self.ranked = []
+            selector = make_selector(self.selector_name, self.llm, self.prompt, self.state_cache)
+            self.generator = BestOfNGenerator(self.llm, self.settings, selector, self.state_cache)
+            batcher = SampleBatcher(self.new_samples_signal.emit, self.ui_frame_rate)
+            try:
+                for i_candidate, i_sample in self.generator.generate(self.prompt, self.n):
+                    batcher.add(i_candidate, self.generator.candidates[i_candidate].trace.sample(i_sample))
+                batcher.flush()
+                self.ranked = self.generator.rank()
+            except (RuntimeError, ValueError) as e:
+                self.error = str(e)
+            batcher.flush()
+            self.end_of_response.emit()
+
+    def stop(self):
+        if self.generator is not None:
+            self.generator.stop()
@@ -0,0 +1,263 @@
+import numpy as np
+
+from typing import Dict, List, Optional, Tuple
+from PySide6.QtWidgets import QAbstractScrollArea
+from PySide6.QtCore import Qt, QEvent, QPoint, QRect, Signal
+from PySide6.QtGui import QPainter, QColor, QPen, QCursor
+
+from CustomNodeWidget import Node, ARROW_ONLY_COMBO_STYLE
+from exploration_tree import ExplorationTree
+from util.growable_array import GrowableArray
+
+class NodeCanvas(QAbstractScrollArea):
+    # the response nodes of an ExplorationTree painted straight from its columns. Only the nodes in the
+    # viewport are drawn and the only widget is a Node for the node under the cursor (its combo box picks
+    # alternatives), so memory and paint cost do not grow with the tree.
+    # A node starts where its parent ends, so a branch lines up under the token it replaces, and each
+    # lane (display row) keeps its nodes' x in order for a binary searched visible range and hit test
+    alternative_selected = Signal(int, int) # tree node, candidate index
+
+    ROW_HEIGHT = 24
+    ROW_SPACING = 5
+    MARGIN = 2
+    PADDING = 10
+    ARROW_WIDTH = 20
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.tree = ExplorationTree()
+        self.llm = None
+        self._x = GrowableArray(np.int32)
+        self._width = GrowableArray(np.int32)
+        self._has_alternatives = GrowableArray(np.bool_)
+        self._lane_nodes: List[GrowableArray] = []
+        self._lane_x: List[GrowableArray] = []
+        self._extent = 0 # right edge of the widest row
+        self._widths: Dict[Tuple[int, bool], int] = {} # (token, has alternatives) -> width
+        self._labels: Dict[int, str] = {} # token -> label
+        self._hover_node = -1
+        self._hover_widget: Optional[Node] = None
+        self.viewport().setMouseTracking(True)
+        self.viewport().setStyleSheet(ARROW_ONLY_COMBO_STYLE)
+        self.set_tree(self.tree)
+
+    # views tree, every node it already has is laid out
+    def set_tree(self, tree: ExplorationTree, llm=None):
+        self._drop_hover_widget()
+        self.tree = tree
+        self.llm = llm
+        self._x.clear()
+        self._width.clear()
+        self._has_alternatives.clear()
+        self._lane_nodes = []
+        self._lane_x = []
+        self._extent = 0
+        # labels come from the tree's detokenizer, another tree or llm may render a token differently
+        self._widths.clear()
+        self._labels.clear()
+        # the root takes no space
+        self._x.append(self.MARGIN)
+        self._width.append(0)
+        self._has_alternatives.append(False)
+        self.add_nodes(range(ExplorationTree.ROOT + 1, len(tree)))
+
+    # lays out the nodes new to the tree, tree_nodes are the ids after the last laid out one. Within a
+    # lane the nodes form a chain, so the x of a lane's new nodes is one cumulative sum of widths
+    # from where the chain continues; widths come from a (token, has alternatives) cache
+    def add_nodes(self, tree_nodes):
+        tree = self.tree
+        first = len(self._x)
+        nodes = np.asarray(tree_nodes, dtype=np.int64)
+        n = nodes.size
+        if n == 0:
+            return
+        if nodes[0] != first or nodes[-1] != first + n - 1:
+            raise ValueError(f"nodes {nodes[0]}..{nodes[-1]} added out of order, expected {first}..")
+        stop = first + n
+        columns = tree.columns()
+        parents = np.asarray(columns["parents"][first:stop])
+        lanes = np.asarray(columns["lanes"][first:stop])
+        token_ids = np.asarray(columns["token_ids"][first:stop])
+        node_traces = np.asarray(columns["node_traces"][first:stop])
+        sample_indices = np.asarray(columns["sample_indices"][first:stop])
+
+        has_alternatives = np.zeros(n, dtype=np.bool_)
+        for trace_id in np.unique(node_traces):
+            in_trace = node_traces == trace_id
+            has_alternatives[in_trace] = tree.traces[trace_id].candidate_counts[sample_indices[in_trace]] > 1
+        keys = token_ids.astype(np.int64) * 2 + has_alternatives
+        _, key_nodes, key_inverse = np.unique(keys, return_index=True, return_inverse=True)
+        key_widths = np.array([self._node_width(first + int(i), int(token_ids[i]), bool(has_alternatives[i])) for i in key_nodes],
+                              dtype=np.int32)
+        widths = key_widths[key_inverse.reshape(-1)]
+
+        self._x.extend(np.zeros(n, dtype=np.int32))
+        self._width.extend(widths)
+        self._has_alternatives.extend(has_alternatives)
+        x = self._x.values
+        width = self._width.values
+
+        # lanes in the order their new nodes start, a chain's parent is laid out before it
+        order = np.argsort(lanes, kind="stable")
+        bounds = np.flatnonzero(np.diff(lanes[order])) + 1
+        groups = sorted(np.split(order, bounds), key=lambda group: group[0])
+        for group in groups:
+            lane = int(lanes[group[0]])
+            while len(self._lane_nodes) <= lane:
+                self._lane_nodes.append(GrowableArray(np.int32, 16))
+                self._lane_x.append(GrowableArray(np.int32, 16))
+            group_nodes = group + first
+            group_parents = parents[group]
+            is_chain = np.array_equal(group_parents[1:], group_nodes[:-1])
+            if is_chain:
+                start = int(x[group_parents[0]] + width[group_parents[0]])
+                x[group_nodes] = start + np.concatenate(([0], np.cumsum(width[group_nodes[:-1]])))
+            else:
+                for node, parent in zip(group_nodes.tolist(), group_parents.tolist()):
+                    x[node] = x[parent] + width[parent]
+            self._lane_nodes[lane].extend(group_nodes)
+            self._lane_x[lane].extend(x[group_nodes])
+        self._extent = max(self._extent, int((x[first:stop] + width[first:stop]).max()))
+        self._update_scroll_ranges()
+        self.viewport().update()
+
+    def _label(self, node: int, token: int) -> str:
+        label = self._labels.get(token)
+        if label is None:
+            label = repr(self.tree.decoded_token(node))
+            self._labels[token] = label
+        return label
+
+    def _node_width(self, node: int, token: int, has_alternatives: bool) -> int:
+        key = (token, has_alternatives)
+        width = self._widths.get(key)
+        if width is None:
+            width = self.fontMetrics().horizontalAdvance(self._label(node, token)) + self.PADDING
+            if has_alternatives:
+                width += self.ARROW_WIDTH
+            self._widths[key] = width
+        return width
+
+    def _row_top(self, row: int) -> int:
+        return self.MARGIN + row * (self.ROW_HEIGHT + self.ROW_SPACING)
+
+    def _content_height(self) -> int:
+        return self._row_top(len(self.tree.lane_order)) + self.MARGIN
+
+    # content rect of a node
+    def node_rect(self, node: int) -> QRect:
+        return QRect(int(self._x[node]), self._row_top(self.tree.row(node)), int(self._width[node]), self.ROW_HEIGHT)
+
+    # the node at a viewport position, -1 if none
+    def node_at(self, pos: QPoint) -> int:
+        x = pos.x() + self.horizontalScrollBar().value()
+        y = pos.y() + self.verticalScrollBar().value() - self.MARGIN
+        row, offset = divmod(y, self.ROW_HEIGHT + self.ROW_SPACING)
+        if y < 0 or offset >= self.ROW_HEIGHT or row >= len(self.tree.lane_order):
+            return -1
+        lane = self.tree.lane_order[row]
+        if lane >= len(self._lane_x):
+            return -1
+        xs = self._lane_x[lane].values
+        i = int(np.searchsorted(xs, x, side="right")) - 1
+        if i < 0:
+            return -1
+        node = int(self._lane_nodes[lane][i])
+        return node if x < xs[i] + self._width[node] else -1
+
+    def _update_scroll_ranges(self):
+        viewport = self.viewport().size()
+        self.horizontalScrollBar().setRange(0, max(0, self._extent + self.MARGIN - viewport.width()))
+        self.horizontalScrollBar().setPageStep(viewport.width())
+        self.verticalScrollBar().setRange(0, max(0, self._content_height() - viewport.height()))
+        self.verticalScrollBar().setPageStep(viewport.height())
+        self.verticalScrollBar().setSingleStep(self.ROW_HEIGHT + self.ROW_SPACING)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._update_scroll_ranges()
+
+    def scrollContentsBy(self, dx: int, dy: int):
+        self._drop_hover_widget()
+        self.viewport().update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        painter.fillRect(self.viewport().rect(), QColor(240, 240, 240))
+        scroll_x = self.horizontalScrollBar().value()
+        scroll_y = self.verticalScrollBar().value()
+        clip = event.rect()
+        left = scroll_x + clip.left()
+        right = scroll_x + clip.right() + 1
+        pitch = self.ROW_HEIGHT + self.ROW_SPACING
+        first_row = max(0, (scroll_y + clip.top() - self.MARGIN) // pitch)
+        last_row = min(len(self.tree.lane_order) - 1, (scroll_y + clip.bottom() - self.MARGIN) // pitch)
+
+        border = QPen(QColor(160, 160, 160))
+        text_color = QColor(0, 0, 0)
+        fill = QColor(255, 255, 255)
+        flags = Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft
+        width = self._width.values
+        has_alternatives = self._has_alternatives.values
+        for row in range(first_row, last_row + 1):
+            lane = self.tree.lane_order[row]
+            if lane >= len(self._lane_x):
+                continue
+            xs = self._lane_x[lane].values
+            nodes = self._lane_nodes[lane].values
+            start = max(0, int(np.searchsorted(xs, left, side="right")) - 1)
+            stop = int(np.searchsorted(xs, right, side="left"))
+            top = self._row_top(row) - scroll_y
+            for i in range(start, stop):
+                node = int(nodes[i])
+                rect = QRect(int(xs[i]) - scroll_x, top, int(width[node]), self.ROW_HEIGHT)
+                painter.fillRect(rect, fill)
+                painter.setPen(border)
+                painter.drawRect(rect.adjusted(0, 0, -1, -1))
+                painter.setPen(text_color)
+                label_rect = rect.adjusted(self.PADDING // 2, 0, -self.PADDING // 2, 0)
+                if has_alternatives[node]:
+                    label_rect.setRight(label_rect.right() - self.ARROW_WIDTH)
+                    painter.drawText(rect.adjusted(rect.width() - self.ARROW_WIDTH, 0, 0, 0), Qt.AlignmentFlag.AlignCenter, "▾")
+                painter.drawText(label_rect, flags, self._label(node, self.tree.token(node)))
+
+    # a Node widget for the node under the cursor, the only interactive part of the canvas
+    def mouseMoveEvent(self, event):
+        self._set_hover_node(self.node_at(event.position().toPoint()))
+        super().mouseMoveEvent(event)
+
+    def leaveEvent(self, event):
+        self._set_hover_node(self.node_at(self.viewport().mapFromGlobal(QCursor.pos())))
+        super().leaveEvent(event)
+
+    def eventFilter(self, watched, event):
+        if watched is self._hover_widget and event.type() == QEvent.Type.Leave:
+            self._set_hover_node(self.node_at(self.viewport().mapFromGlobal(QCursor.pos())))
+        return super().eventFilter(watched, event)
+
+    def _set_hover_node(self, node: int):
+        if node == self._hover_node:
+            return
+        # keep the widget while its dropdown is open
+        if self._hover_widget is not None and self._hover_widget.alternatives_combo.view().isVisible():
+            return
+        self._drop_hover_widget()
+        if node <= ExplorationTree.ROOT:
+            return
+        self._hover_node = node
+        widget = Node(self.tree, node, self.llm, self.viewport())
+        widget.alternatives_combo.currentIndexChanged.connect(lambda index, n=node: self.alternative_selected.emit(n, index))
+        rect = self.node_rect(node)
+        rect.translate(-self.horizontalScrollBar().value(), -self.verticalScrollBar().value())
+        widget.setGeometry(rect)
+        widget.installEventFilter(self)
+        widget.show()
+        self._hover_widget = widget
+
+    def _drop_hover_widget(self):
+        if self._hover_widget is not None:
+            self._hover_widget.removeEventFilter(self)
+            self._hover_widget.hide()
+            self._hover_widget.deleteLater()
+            self._hover_widget = None
+        self._hover_node = -1
@@ -0,0 +1,54 @@
+import numpy as np
+
+from util.growable_array import GrowableArray
+
+
+def read_only(values):
+    values = np.array(values)
+    values.setflags(write=False)
+    return values
+
+
+def test_append_and_extend_grow():
+    array = GrowableArray(np.int32, 2)
+    for i in range(5):
+        array.append(i)
+    array.extend([5, 6, 7])
+    assert array.values.tolist() == list(range(8))
+    assert array.capacity >= 8
+
+
+def test_from_array_copies_on_first_write():
+    source = read_only([1, 2, 3])
+    array = GrowableArray.from_array(source)
+    assert np.shares_memory(array.values, source)
+    array.append(4)
+    assert array.values.tolist() == [1, 2, 3, 4]
+    assert source.tolist() == [1, 2, 3]
+
+
+def test_from_array_extend_empty():
+    array = GrowableArray.from_array(read_only([1, 2, 3]))
+    array.extend(np.frombuffer(b"", dtype=np.int64))
+    array.extend([4])
+    assert array.values.tolist() == [1, 2, 3, 4]
+
+
+def test_from_array_append_after_clear():
+    source = read_only([1, 2, 3])
+    array = GrowableArray.from_array(source)
+    array.clear()
+    array.append(9)
+    assert array.values.tolist() == [9]
+    assert source.tolist() == [1, 2, 3]
+
+
+def test_from_array_memmap(tmp_path):
+    path = tmp_path / "column.npy"
+    np.save(path, np.arange(4, dtype=np.uint8))
+    array = GrowableArray.from_array(np.load(path, mmap_mode="r"))
+    array.extend(np.zeros(0, dtype=np.uint8))
+    array.set(0, 7)
+    array.extend([4, 5])
+    assert array.values.tolist() == [7, 1, 2, 3, 4, 5]
+    assert np.load(path).tolist() == [0, 1, 2, 3]
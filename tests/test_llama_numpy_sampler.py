@@ -0,0 +1,198 @@
+import ctypes
+import importlib.util
+import pathlib
+import types
+
+import numpy as np
+import pytest
+
+# loaded by path: importing the llama_cpp package loads the shared library
+_spec = importlib.util.spec_from_file_location(
+    "llama_numpy_sampler",
+    pathlib.Path(__file__).resolve().parent.parent / "llama_cpp" / "llama_numpy_sampler.py",
+)
+llama_numpy_sampler = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(llama_numpy_sampler)
+LlamaNumpySampler = llama_numpy_sampler.LlamaNumpySampler
+
+# p = 0.1, 0.2, 0.3, 0.4 for the tokens 0 .. 3
+LOGITS = np.log([0.1, 0.2, 0.3, 0.4]).astype(np.single)
+
+
+class Candidates:
+    """The fields of `_LlamaTokenDataArray` the sampler uses, without the ctypes struct."""
+
+    def __init__(self, logits):
+        n_vocab = len(logits)
+        self.candidates_data = np.recarray(
+            (n_vocab,),
+            dtype=np.dtype(
+                [("id", np.intc), ("logit", np.single), ("p", np.single)], align=True
+            ),
+        )
+        self.candidates_data.id[:] = np.arange(n_vocab)
+        self.candidates_data.logit[:] = logits
+        self.candidates_data.p[:] = 0
+        self.candidates = types.SimpleNamespace(size=n_vocab, sorted=False)
+
+    def ids(self):
+        return self.candidates_data.id[: self.candidates.size].tolist()
+
+
+def make(logits=LOGITS, seed=42, capture_stages=False):
+    return (
+        LlamaNumpySampler(n_vocab=len(logits), seed=seed, capture_stages=capture_stages),
+        Candidates(logits),
+    )
+
+
+def test_softmax_sorts_and_normalizes():
+    sampler, c = make()
+    sampler.sample_softmax(c)
+    assert c.ids() == [3, 2, 1, 0]
+    assert c.candidates.sorted
+    np.testing.assert_allclose(c.candidates_data.p, [0.4, 0.3, 0.2, 0.1], rtol=1e-6)
+
+
+def test_top_k():
+    sampler, c = make()
+    sampler.sample_top_k(c, 2, 1)
+    assert c.ids() == [3, 2]
+    sampler, c = make()
+    sampler.sample_top_k(c, 1, 3)
+    assert c.ids() == [3, 2, 1]
+    sampler, c = make()
+    sampler.sample_top_k(c, 0, 1)
+    assert c.ids() == [3, 2, 1, 0]
+
+
+def test_top_k_large_vocab():
+    logits = np.random.default_rng(0).normal(size=5000).astype(np.single)
+    sampler, c = make(logits)
+    sampler.sample_top_k(c, 40, 1)
+    assert c.ids() == np.argsort(-logits)[:40].tolist()
+
+
+def test_top_p():
+    sampler, c = make()
+    sampler.sample_top_p(c, 0.6, 1)
+    assert c.ids() == [3, 2]
+    sampler, c = make()
+    sampler.sample_top_p(c, 0.3, 3)
+    assert c.ids() == [3, 2, 1]
+
+
+def test_min_p():
+    sampler, c = make()
+    # keeps p >= 0.6 * 0.4
+    sampler.sample_min_p(c, 0.6, 1)
+    assert c.ids() == [3, 2]
+
+
+def test_typical():
+    sampler, c = make()
+    # closest to the entropy first: 0.3, 0.2, 0.4, 0.1
+    sampler.sample_typical(c, 0.45, 1)
+    assert c.ids() == [2, 1]
+    assert not c.candidates.sorted
+
+
+def test_tail_free():
+    sampler, c = make(np.log([0.5, 0.25, 0.15, 0.06, 0.04]).astype(np.single))
+    # normalized second derivatives 0.65, 0.04, 0.30
+    sampler.sample_tail_free(c, 0.9, 1)
+    assert c.ids() == [0, 1]
+    sampler, c = make(np.log([0.5, 0.25, 0.15, 0.06, 0.04]).astype(np.single))
+    sampler.sample_tail_free(c, 1.0, 1)
+    assert c.ids() == [0, 1, 2, 3, 4]
+
+
+def test_temp():
+    sampler, c = make()
+    sampler.sample_temp(c, 0.5)
+    np.testing.assert_allclose(c.candidates_data.logit, LOGITS / np.single(0.5))
+
+
+def test_repetition_penalties():
+    logits = np.array([2.0, -1.0, 0.5, 1.0], dtype=np.single)
+    sampler, c = make(logits)
+    sampler.sample_repetition_penalties(c, [0, 1, 1], 3, 2.0, 0.1, 0.2)
+    np.testing.assert_allclose(
+        c.candidates_data.logit, [2.0 / 2 - 0.1 - 0.2, -1.0 * 2 - 0.2 - 0.2, 0.5, 1.0]
+    )
+
+
+def test_greedy():
+    sampler, c = make()
+    assert sampler.sample_token_greedy(c) == 3
+
+
+# the reference draws are from the sampler chain built with libstdc++, MSVC's
+# discrete_distribution draws differently
+def test_sample_token_matches_libstdcxx():
+    sampler, _ = make(seed=42)
+    tokens = []
+    for _ in range(12):
+        c = Candidates(LOGITS)
+        tokens.append(sampler.sample_token(c))
+    assert tokens == [1, 3, 1, 2, 2, 3, 2, 3, 3, 2, 3, 1]
+
+
+def test_set_rng_seed_restarts_the_draws():
+    sampler, _ = make(seed=1)
+    first = [sampler.sample_token(Candidates(LOGITS)) for _ in range(8)]
+    sampler.set_rng_seed(1)
+    assert [sampler.sample_token(Candidates(LOGITS)) for _ in range(8)] == first
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_mirostat_matches_libstdcxx(version):
+    sampler, _ = make(seed=7)
+    mu = ctypes.c_float(10.0)
+    tokens = []
+    for _ in range(6):
+        c = Candidates(LOGITS)
+        if version == 1:
+            tokens.append(sampler.sample_token_mirostat(c, 5.0, 0.1, 100, ctypes.pointer(mu)))
+        else:
+            tokens.append(sampler.sample_token_mirostat_v2(c, 5.0, 0.1, ctypes.pointer(mu)))
+    assert tokens == [3, 3, 0, 2, 3, 3]
+    assert mu.value == pytest.approx(11.9653406, abs=1e-5)
+
+
+def test_mirostat_v2_truncates_by_surprise():
+    sampler, c = make(capture_stages=True)
+    # surprises are 1.32, 1.74, 2.32 and 3.32 bits
+    mu = ctypes.c_float(2.0)
+    token = sampler.sample_token_mirostat_v2(c, 5.0, 0.1, ctypes.pointer(mu))
+    assert token in (3, 2)
+    assert [(stage, ids.tolist()) for stage, ids in sampler.stages] == [("mirostat", [3, 2])]
+
+
+def test_capture_stages():
+    sampler, c = make(capture_stages=True)
+    sampler.sample_top_k(c, 3, 1)
+    sampler.sample_tail_free(c, 1.0, 1)
+    sampler.sample_typical(c, 1.0, 1)
+    sampler.sample_top_p(c, 0.6, 1)
+    sampler.sample_min_p(c, 0.05, 1)
+    assert [(stage, ids.tolist()) for stage, ids in sampler.stages] == [
+        ("top_k", [3, 2, 1]),
+        ("tail_free", [3, 2, 1]),
+        ("typical", [3, 2, 1]),
+        ("top_p", [3, 2]),
+        ("min_p", [3, 2]),
+    ]
+    # the captured ids are copies
+    sampler.sample_temp(c, 2.0)
+    c.candidates_data.id[:] = 0
+    assert sampler.stages[0][1].tolist() == [3, 2, 1]
+    sampler.clear_stages()
+    assert sampler.stages == []
+
+
+def test_stages_not_captured_by_default():
+    sampler, c = make()
+    sampler.sample_top_k(c, 2, 1)
+    sampler.sample_top_p(c, 0.9, 1)
+    assert sampler.stages == []
@@ -0,0 +1,137 @@
+import contextlib
+import ctypes
+import types
+
+import numpy as np
+import pytest
+
+try:
+    from llama_cpp.llama import Llama
+    from llama_cpp.llama_logits import LlamaLogitsStore
+except OSError:
+    pytest.skip("llama shared library not available", allow_module_level=True)
+
+N_VOCAB = 20
+
+
+class FakeBatch:
+    batch = True
+
+    def __init__(self):
+        self.items = []
+
+    def reset(self):
+        self.items = []
+
+    def n_tokens(self):
+        return len(self.items)
+
+    def add_token(self, token, pos, seq_ids, logits):
+        self.items.append((token, pos, seq_ids[0], logits))
+
+    def set_batch(self, batch, n_past, logits_all):
+        self.items = [
+            (token, n_past + i, 0, logits_all or i == len(batch) - 1)
+            for i, token in enumerate(batch)
+        ]
+
+
+class FakeContext:
+    """Next token logits depend only on the previous token; tracks the KV cache per sequence."""
+
+    ctx = True
+
+    def __init__(self, weights, n_seq_max):
+        self.weights = weights
+        self._n_seq_max = n_seq_max
+        self.seqs = {}
+        self.out = None
+
+    def n_seq_max(self):
+        return self._n_seq_max
+
+    def kv_cache_seq_rm(self, seq_id, p0, p1):
+        assert seq_id < self._n_seq_max
+        for k in [seq_id] if seq_id != -1 else list(self.seqs):
+            self.seqs[k] = self.seqs.get(k, [])[:p0] if p0 >= 0 else []
+
+    def kv_cache_seq_cp(self, src, dst, p0, p1):
+        assert src < self._n_seq_max and dst < self._n_seq_max
+        self.seqs[dst] = list(self.seqs.get(src, []))
+
+    def decode(self, batch):
+        out = []
+        for token, pos, seq_id, logits in batch.items:
+            assert 0 <= seq_id < self._n_seq_max
+            cache = self.seqs.setdefault(seq_id, [])
+            assert pos == len(cache)
+            cache.append(token)
+            if logits:
+                out.append(self.weights[token])
+        self.out = np.ascontiguousarray(out, dtype=np.single)
+
+    def get_logits(self):
+        return self.out.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+
+def make_llama(n_batch, n_seq_max=1, n_ctx=64, seed=0):
+    weights = np.random.default_rng(seed).normal(size=(N_VOCAB, N_VOCAB)).astype(np.single)
+    llm = object.__new__(Llama)
+    llm._stack = contextlib.ExitStack()
+    llm._ctx = FakeContext(weights, n_seq_max)
+    llm._batch = FakeBatch()
+    llm.n_batch = n_batch
+    llm._n_ctx = n_ctx
+    llm._n_vocab = N_VOCAB
+    llm.n_tokens = 0
+    llm.input_ids = np.zeros(n_ctx, dtype=np.intc)
+    llm.logits_retention = "dense"
+    llm._logits = LlamaLogitsStore(n_ctx, N_VOCAB, "dense")
+    llm.context_params = types.SimpleNamespace(logits_all=False)
+    return llm, weights
+
+
+def reference_logprobs(weights, prompt, tokens):
+    prev = prompt[-1]
+    logprobs = []
+    for token in tokens:
+        logits = weights[prev].astype(np.float64)
+        logits = logits - logits.max()
+        logprobs.append(logits[token] - np.log(np.exp(logits).sum()))
+        prev = token
+    return np.array(logprobs)
+
+
+def test_score_matches_teacher_forcing():
+    llm, weights = make_llama(n_batch=7, n_seq_max=64)
+    prompt = [1, 2, 3, 4]
+    continuations = [[6, 7, 8], [], [9], list(range(15)), [2] * 10]
+    results = llm.score(prompt, continuations)
+    for result, tokens in zip(results, continuations):
+        assert result.tokens.tolist() == tokens
+        np.testing.assert_allclose(
+            result.logprobs, reference_logprobs(weights, prompt, tokens), atol=1e-5
+        )
+    # only the prompt is left in the cache
+    assert {k: v for k, v in llm._ctx.seqs.items() if v} == {0: prompt}
+
+
+@pytest.mark.parametrize("n_seq_max", [64, 5, 2])
+def test_score_more_continuations_than_batch(n_seq_max):
+    # the first continuation ends exactly on a flush; its id must be freed by that flush.
+    # With fewer sequences than n_batch the batch is decoded early when they run out
+    llm, weights = make_llama(n_batch=4, n_seq_max=n_seq_max)
+    prompt = [1, 2, 3]
+    continuations = [[1, 2, 3, 4, 5]] + [[6, 7]] * 4 + [[8, 9, 10]] * 6
+    results = llm.score(prompt, continuations)
+    for result, tokens in zip(results, continuations):
+        np.testing.assert_allclose(
+            result.logprobs, reference_logprobs(weights, prompt, tokens), atol=1e-5
+        )
+    assert {k: v for k, v in llm._ctx.seqs.items() if v} == {0: prompt}
+
+
+def test_score_needs_a_second_sequence():
+    llm, _ = make_llama(n_batch=4, n_seq_max=1)
+    with pytest.raises(ValueError, match="n_seq_max"):
+        llm.score([1, 2, 3], [[4, 5]])
@@ -0,0 +1,57 @@
+import pytest
+
+try:
+    from llama_cpp.llama_tokenizer import LlamaHFTokenizer, LlamaStreamingDetokenizer
+except OSError:
+    pytest.skip("llama shared library not available", allow_module_level=True)
+
+
+class FakeHFTokenizer:
+    """Sentencepiece like: pieces mark spaces with "▁", the text's leading space is
+    dropped and byte tokens join into characters, a split character decodes to U+FFFD."""
+
+    def __init__(self):
+        self.vocab = ["▁the", "▁quick", "▁brown", "▁fox", "s", ".", "\n", "<0xC3>", "<0xA9>", "▁caf"]
+        self.decoded_tokens = []
+
+    def decode(self, ids):
+        self.decoded_tokens.append(len(ids))
+        data = b""
+        for i in ids:
+            piece = self.vocab[i]
+            if piece.startswith("<0x"):
+                data += bytes([int(piece[3:5], 16)])
+            else:
+                data += piece.replace("▁", " ").encode("utf-8")
+        text = data.decode("utf-8", errors="replace")
+        return text[1:] if text.startswith(" ") else text
+
+
+def test_streaming_hf_matches_full_decode():
+    hf = FakeHFTokenizer()
+    tokens = [0, 1, 2, 3, 4, 5, 9, 7, 8, 6] * 50
+    detokenizer = LlamaStreamingDetokenizer(LlamaHFTokenizer(hf))
+    for token in tokens:
+        detokenizer.append(token)
+    assert bytes(detokenizer.text) == hf.decode(tokens).encode("utf-8")
+    assert "é" in detokenizer.text.decode("utf-8")
+    assert detokenizer.offset(len(tokens)) == len(detokenizer.text)
+
+
+def test_streaming_hf_work_per_token_is_bounded():
+    hf = FakeHFTokenizer()
+    detokenizer = LlamaStreamingDetokenizer(LlamaHFTokenizer(hf), prev_tokens=[0, 1] * 100)
+    for token in [0, 1, 2, 3, 4, 5, 9, 7, 8, 6] * 200:
+        detokenizer.append(token)
+    # a window of a few tokens, however long the completion and its prompt
+    assert max(hf.decoded_tokens) <= 6
+    assert sum(hf.decoded_tokens) <= 2000 * 6
+
+
+def test_streaming_hf_continues_prev_tokens():
+    hf = FakeHFTokenizer()
+    detokenizer = LlamaStreamingDetokenizer(LlamaHFTokenizer(hf), prev_tokens=[0, 1])
+    for token in [2, 3]:
+        detokenizer.append(token)
+    # the space of the first token is kept after the previous tokens
+    assert bytes(detokenizer.text) == b" brown fox"
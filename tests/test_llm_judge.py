@@ -0,0 +1,96 @@
+import ctypes
+
+import numpy as np
+import pytest
+
+try:
+    from llm_judge import final_logits
+except OSError:
+    pytest.skip("llama shared library not available", allow_module_level=True)
+
+N_VOCAB = 8
+
+
+class FakeBatch:
+    def __init__(self):
+        self.items = []
+
+    def reset(self):
+        self.items = []
+
+    def n_tokens(self):
+        return len(self.items)
+
+    def add_token(self, token, pos, seq_ids, logits):
+        self.items.append((token, pos, seq_ids[0], logits))
+
+
+class FakeContext:
+    """The logits after a sequence are a function of all of its tokens."""
+
+    def __init__(self, n_seq_max):
+        self._n_seq_max = n_seq_max
+        self.seqs = {}
+        self.out = {}
+        self.decodes = 0
+
+    def n_seq_max(self):
+        return self._n_seq_max
+
+    def kv_cache_seq_rm(self, seq_id, p0, p1):
+        assert seq_id < self._n_seq_max
+        self.seqs[seq_id] = self.seqs.get(seq_id, [])[:p0] if p0 >= 0 else []
+
+    def kv_cache_seq_cp(self, src, dst, p0, p1):
+        assert dst < self._n_seq_max
+        self.seqs[dst] = list(self.seqs.get(src, []))[:p1]
+
+    def decode(self, batch):
+        self.decodes += 1
+        self.out = {}
+        for row, (token, pos, seq_id, logits) in enumerate(batch.items):
+            assert seq_id < self._n_seq_max
+            cache = self.seqs.setdefault(seq_id, [])
+            assert pos == len(cache)
+            cache.append(token)
+            if logits:
+                self.out[row] = expected_logits(cache)
+
+    def get_logits_ith(self, row):
+        return self.out[row].ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+
+def expected_logits(tokens):
+    return np.cos(np.arange(N_VOCAB) * (1 + sum(t * (i + 1) for i, t in enumerate(tokens)))).astype(np.single)
+
+
+class FakeLlama:
+    def __init__(self, n_batch, n_seq_max):
+        self.n_batch = n_batch
+        self._ctx = FakeContext(n_seq_max)
+        self._batch = FakeBatch()
+        self.n_tokens = 0
+        self._input_ids = np.zeros(0, dtype=np.intc)
+
+    def n_vocab(self):
+        return N_VOCAB
+
+    def eval(self, tokens):
+        self._ctx.seqs.setdefault(0, []).extend(tokens)
+        self.n_tokens += len(tokens)
+        self._input_ids = np.array(self._ctx.seqs[0], dtype=np.intc)
+
+
+@pytest.mark.parametrize("n_seq_max", [64, 3, 2])
+def test_final_logits_within_sequence_limit(n_seq_max):
+    llm = FakeLlama(n_batch=4, n_seq_max=n_seq_max)
+    token_lists = [[1, 2, 3, 4 + i, 5, 6][: 4 + i % 3] for i in range(7)]
+    logits = final_logits(llm, token_lists)
+    for row, tokens in zip(logits, token_lists):
+        np.testing.assert_array_equal(row, expected_logits(tokens))
+    assert {k: v for k, v in llm._ctx.seqs.items() if v} == {0: [1, 2, 3]}
+
+
+def test_final_logits_needs_a_second_sequence():
+    with pytest.raises(ValueError, match="n_seq_max"):
+        final_logits(FakeLlama(n_batch=4, n_seq_max=1), [[1, 2], [1, 3]])
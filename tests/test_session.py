@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+try:
+    from exploration_tree import ExplorationTree
+    from llm_generator import ResponseTrace, SampleSettings
+    from llm_session import Session, load_session, save_session
+except OSError:
+    pytest.skip("llama shared library not available", allow_module_level=True)
+
+
+def make_tree():
+    trace = ResponseTrace()
+    ids = np.array([5, 6, 7], dtype=np.intc)
+    logits = np.array([3.0, 2.0, 1.0], dtype=np.single)
+    p = np.array([0.6, 0.3, 0.1], dtype=np.single)
+    for token, piece in [(5, b"Hello"), (6, b" world")]:
+        trace.append_candidates(token, piece, ids, logits, p)
+    tree = ExplorationTree("prompt")
+    lane = tree.new_lane()
+    node = ExplorationTree.ROOT
+    for i in range(len(trace)):
+        node = tree.add_sample(node, trace.sample(i), lane)
+    return tree
+
+
+def test_session_round_trip(tmp_path):
+    path = str(tmp_path / "session.npz")
+    tree = make_tree()
+    save_session(path, Session(tree, SampleSettings()))
+    loaded = load_session(path).tree
+    assert len(loaded) == len(tree)
+    assert loaded.text(len(loaded) - 1) == tree.text(len(tree) - 1)
+
+
+def test_extend_loaded_session(tmp_path):
+    path = str(tmp_path / "session.npz")
+    save_session(path, Session(make_tree(), SampleSettings()))
+    tree = load_session(path).tree
+    last = len(tree) - 1
+    # a token with an empty piece (a control token) extends the memory mapped text column by nothing
+    empty = tree.add_alternative(last, 2, b"", tree.lane(last))
+    assert tree.decoded_bytes(empty) == b""
+    other = tree.add_alternative(last, 0, b" there", tree.new_lane(tree.lane(last)))
+    assert tree.decoded_bytes(other) == b" there"
+    assert tree.decoded_bytes(last) == b" world"
@@ -0,0 +1,131 @@
+import numpy as np
+
+from typing import Callable, Dict, List
+from PySide6.QtWidgets import QTextEdit, QToolTip
+from PySide6.QtGui import QColor, QTextCharFormat, QTextCursor
+
+from exploration_tree import ExplorationTree
+from util.growable_array import GrowableArray
+
+# metric -> heat in 0..1 from the per token values, nan is no heat
+HEATMAP_METRICS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    "p": lambda p: 1.0 - p,
+    "entropy": lambda entropy: entropy / 4.0,
+    "surprisal": lambda surprisal: surprisal / 8.0,
+}
+HEATMAP_NAMES = ["none"] + list(HEATMAP_METRICS)
+
+class TranscriptView(QTextEdit):
+    # the chat transcript with the response tokens as a heatmap of p, entropy or surprisal. Heat is
+    # quantized to LEVELS background colors and neighbouring tokens on the same level are one
+    # QTextCharFormat run, tokens are inserted and recolored run by run inside one edit block.
+    # The metric values are copied per token when it is inserted, so recoloring does not need the tree
+    # the tokens came from, and where each token starts is kept for a binary searched hover lookup
+    LEVELS = 16
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setReadOnly(True)
+        self.viewport().setMouseTracking(True)
+        self.heatmap_metric = "p"
+        # per token, positions are in the document's utf-16 units
+        self._starts = GrowableArray(np.int64)
+        self._ends = GrowableArray(np.int64)
+        self._values = {name: GrowableArray(np.single) for name in HEATMAP_METRICS}
+        self._backgrounds: List[QTextCharFormat] = []
+        for level in range(self.LEVELS):
+            fade = round(130 * level / (self.LEVELS - 1))
+            background = QTextCharFormat()
+            background.setBackground(QColor(255, 255 - fade, 255 - fade, 255 if level > 0 else 0))
+            self._backgrounds.append(background)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def clear(self):
+        super().clear()
+        self._clear_tokens()
+
+    # a loaded transcript is plain text, its tokens are not known
+    def setHtml(self, html: str):
+        super().setHtml(html)
+        self._clear_tokens()
+
+    def _clear_tokens(self):
+        self._starts.clear()
+        self._ends.clear()
+        for values in self._values.values():
+            values.clear()
+
+    def _levels(self, first: int = 0) -> np.ndarray:
+        heat_of = HEATMAP_METRICS.get(self.heatmap_metric)
+        if heat_of is None:
+            return np.zeros(len(self) - first, dtype=np.int64)
+        heat = np.nan_to_num(heat_of(self._values[self.heatmap_metric].values[first:]), nan=0.0)
+        return np.rint(np.clip(heat, 0.0, 1.0) * (self.LEVELS - 1)).astype(np.int64)
+
+    # [start, end) token ranges that are one run, the same level and adjacent in the document
+    def _runs(self, levels: np.ndarray, first: int = 0):
+        starts = self._starts.values[first:]
+        ends = self._ends.values[first:]
+        breaks = np.flatnonzero((levels[1:] != levels[:-1]) | (starts[1:] != ends[:-1])) + 1
+        return zip(np.concatenate(([0], breaks)).tolist(), np.concatenate((breaks, [levels.size])).tolist())
+
+    # appends the tokens of nodes to the end of the transcript
+    def append_tokens(self, tree: ExplorationTree, nodes):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if nodes.size == 0:
+            return
+        pieces = [tree.decoded_token(node) for node in nodes.tolist()]
+        lengths = np.array([len(piece.encode("utf-16-le")) // 2 for piece in pieces], dtype=np.int64)
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        first = len(self)
+        offsets = cursor.position() + np.concatenate(([0], np.cumsum(lengths)))
+        self._starts.extend(offsets[:-1])
+        self._ends.extend(offsets[1:])
+        for name, values in self._values.items():
+            values.extend(tree.sample_values(nodes, name))
+
+        levels = self._levels(first)
+        base = cursor.charFormat()
+        cursor.beginEditBlock()
+        for start, end in self._runs(levels, first):
+            run_format = QTextCharFormat(base)
+            run_format.merge(self._backgrounds[levels[start]])
+            cursor.insertText("".join(pieces[start:end]), run_format)
+        cursor.endEditBlock()
+
+    # recolors every token, one format merge per run
+    def set_heatmap_metric(self, metric: str):
+        self.heatmap_metric = metric
+        if len(self) == 0:
+            return
+        levels = self._levels()
+        starts = self._starts.values
+        ends = self._ends.values
+        cursor = QTextCursor(self.document())
+        cursor.beginEditBlock()
+        for start, end in self._runs(levels):
+            cursor.setPosition(int(starts[start]))
+            cursor.setPosition(int(ends[end - 1]), QTextCursor.MoveMode.KeepAnchor)
+            cursor.mergeCharFormat(self._backgrounds[levels[start]])
+        cursor.endEditBlock()
+
+    # token under a document position, -1 if none
+    def token_at(self, position: int) -> int:
+        i = int(np.searchsorted(self._starts.values, position, side="right")) - 1
+        return i if i >= 0 and position < self._ends[i] else -1
+
+    def mouseMoveEvent(self, event):
+        super().mouseMoveEvent(event)
+        point = event.position().toPoint()
+        i = self.token_at(self.cursorForPosition(point).position())
+        if i < 0:
+            QToolTip.hideText()
+            return
+        cursor = QTextCursor(self.document())
+        cursor.setPosition(int(self._starts[i]))
+        cursor.setPosition(int(self._ends[i]), QTextCursor.MoveMode.KeepAnchor)
+        values = " ".join(f"{name}={values[i]:.2f}" for name, values in self._values.items())
+        QToolTip.showText(event.globalPosition().toPoint(), f"{cursor.selectedText()!r} {values}", self.viewport())
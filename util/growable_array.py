@@ -0,0 +1,79 @@
+import numpy as np
+
+from typing import Any, Iterable
+
+class GrowableArray:
+    # 1d numpy array with amortized O(1) appends, the capacity doubles when full so an append
+    # never copies the whole array except on the (logarithmically rare) growth steps
+    def __init__(self, dtype: Any, capacity: int = 64):
+        self._data: np.ndarray = np.empty(max(1, capacity), dtype=dtype)
+        self._size: int = 0
+
+    @classmethod
+    def from_array(cls, values: np.ndarray) -> "GrowableArray":
+        # wraps values without copying (e.g. a read only memory map), the first append or set copies
+        # it into a writable buffer
+        array = cls(values.dtype, 1)
+        array._data = values.reshape(-1)
+        array._size = array._data.size
+        return array
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    @property
+    def values(self) -> np.ndarray:
+        # view of the used part of the buffer, no copy
+        return self._data[:self._size]
+
+    @property
+    def capacity(self) -> int:
+        return self._data.size
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+    def reserve(self, capacity: int):
+        # a read only buffer (see from_array) is copied even when it is large enough
+        if capacity <= self._data.size and self._data.flags.writeable:
+            return
+        new_capacity = max(1, self._data.size)
+        while new_capacity < capacity:
+            new_capacity *= 2
+        data = np.empty(new_capacity, dtype=self._data.dtype)
+        data[:self._size] = self._data[:self._size]
+        # swap only after the copy, readers on other threads always see a complete buffer
+        self._data = data
+
+    def append(self, value):
+        self.reserve(self._size + 1)
+        self._data[self._size] = value
+        self._size += 1
+
+    def set(self, index: int, value):
+        if not self._data.flags.writeable:
+            self._data = self._data.copy()
+        self._data[index] = value
+
+    def extend(self, values: Iterable):
+        values = np.asarray(values, dtype=self._data.dtype)
+        n = values.size
+        self.reserve(self._size + n)
+        self._data[self._size:self._size + n] = values
+        self._size += n
+
+    def clear(self):
+        self._size = 0
+
+    def trim(self) -> np.ndarray:
+        # release the unused capacity, returns the compacted values
+        self._data = self._data[:self._size].copy() if self._size > 0 else np.empty(1, dtype=self._data.dtype)
+        return self.values